@@ -0,0 +1,117 @@
+"""
+Alert rules evaluated over floor_plan_events.
+
+Each rule keeps a cursor over the transactions that wrote the events (floor_plan_events.xid), so an evaluation only
+reads events it hasn't seen (an index range scan on floor_plan_events.xid) and never rescans floor_plans.
+The cursor only moves up to the oldest transaction still running, so events that concurrent sweep writers commit late
+are evaluated on a later run instead of being skipped.
+"""
+from typing import List, Optional
+
+import pandas as pd
+from psycopg2.extras import RealDictCursor
+
+
+class AlertEvaluator:
+    def __init__(self, db_connection):
+        self.conn = db_connection
+
+    def add_rule(
+        self,
+        name: str,
+        apt_id: Optional[int] = None,
+        event_types: List[str] = ("new_unit", "price_change"),
+        min_bedrooms: Optional[float] = None,
+        max_bedrooms: Optional[float] = None,
+        max_price: Optional[int] = None,
+    ) -> int:
+        """
+        Add an alert rule, e.g. "2BR under $3,000 at building X":
+        add_rule("2BR under 3k", apt_id=x, min_bedrooms=2, max_bedrooms=2, max_price=3000).
+        The rule only fires on events created after it was added.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO alert_rules (
+                    name, apt_id, event_types, min_bedrooms, max_bedrooms, max_price, last_event_id, last_xid
+                )
+                VALUES (
+                    %s, %s, %s, %s, %s, %s,
+                    (SELECT COALESCE(MAX(id), 0) FROM floor_plan_events),
+                    pg_snapshot_xmin(pg_current_snapshot())
+                )
+                RETURNING id
+                """,
+                (name, apt_id, list(event_types), min_bedrooms, max_bedrooms, max_price),
+            )
+            rule_id = cur.fetchone()[0]
+        self.conn.commit()
+        return rule_id
+
+    def deactivate_rule(self, rule_id: int):
+        with self.conn.cursor() as cur:
+            cur.execute("UPDATE alert_rules SET active = FALSE WHERE id = %s", (rule_id,))
+        self.conn.commit()
+
+    def evaluate(self) -> pd.DataFrame:
+        """
+        Match every active rule against the events it hasn't seen yet, record the alerts and return the new ones as a df.
+        Events of transactions that are still running when this is called are left for the next evaluation.
+        """
+        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                WITH watermark AS (
+                    -- Every transaction below the xmin has committed or aborted, so no event below it can still appear.
+                    SELECT pg_snapshot_xmin(pg_current_snapshot()) AS xmin
+                ),
+                matches AS (
+                    SELECT r.id AS rule_id, r.name AS rule_name, e.*
+                    FROM alert_rules r
+                    CROSS JOIN watermark w
+                    JOIN floor_plan_events e
+                        ON e.xid >= r.last_xid
+                        AND e.xid < w.xmin
+                        AND e.id > r.last_event_id
+                        AND (r.apt_id IS NULL OR e.apt_id = r.apt_id)
+                        AND e.event_type = ANY (r.event_types)
+                        AND (r.min_bedrooms IS NULL OR e.bedrooms >= r.min_bedrooms)
+                        AND (r.max_bedrooms IS NULL OR e.bedrooms <= r.max_bedrooms)
+                        AND (r.max_price IS NULL OR e.price <= r.max_price)
+                    WHERE r.active
+                ),
+                recorded AS (
+                    INSERT INTO alerts (rule_id, event_id)
+                    SELECT rule_id, id FROM matches
+                    ON CONFLICT (rule_id, event_id) DO NOTHING
+                    RETURNING rule_id, event_id
+                ),
+                advanced AS (
+                    UPDATE alert_rules r
+                    SET last_xid = w.xmin
+                    FROM watermark w
+                    WHERE r.active AND r.last_xid < w.xmin
+                )
+                SELECT m.rule_id, m.rule_name, a.building_name, m.unit_number, m.event_type,
+                    m.bedrooms, m.bathrooms, m.sq_ft, m.price, m.previous_price, m.created_at
+                FROM matches m
+                JOIN recorded ON recorded.rule_id = m.rule_id AND recorded.event_id = m.id
+                JOIN apts a ON a.id = m.apt_id
+                ORDER BY m.rule_id, m.id
+                """
+            )
+            alerts = pd.DataFrame(cur.fetchall())
+        self.conn.commit()
+        return alerts
+
+
+def print_alerts(alerts: pd.DataFrame):
+    for alert in alerts.itertuples():
+        if alert.event_type == "price_change":
+            change = f"price changed from ${alert.previous_price:.0f} to ${alert.price:.0f}"
+        elif alert.event_type == "new_unit":
+            change = f"new unit listed at ${alert.price:.0f}"
+        else:
+            change = "unit no longer listed"
+        print(f"[{alert.rule_name}] {alert.building_name} unit {alert.unit_number} ({alert.bedrooms} bed): {change}")
@@ -1,23 +1,60 @@
-import time
 import sys
 import os
-import requests
-from selenium import webdriver
-from bs4 import BeautifulSoup
-from webdriver_manager.chrome import ChromeDriverManager
+import json
+from bs4 import BeautifulSoup, SoupStrainer
 import pandas as pd
-import numpy as np
-from io import StringIO
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional
 from dotenv import load_dotenv
 
-from configs.schema_config import WEBSITE_ERROR_MESSAGES
+from http_cache import FetchedPage, ResponseCache
+from html_parsing import (
+    STREAM_CHUNK_ROWS,
+    extract_table_df,
+    iter_fp_block_elements,
+    iter_table_row_chunks,
+    iter_text_chunks,
+    make_soup,
+    rows_to_df,
+    table_rows_from_tag,
+)
+from metrics import timed
+from unit_records import UnitRecords
+
+if TYPE_CHECKING:
+    from browser_pool import BrowserPool
 
 load_dotenv()
 UTILS_PATH = os.getenv("UTILS_FOLDER_PATH")
 sys.path.insert(0, UTILS_PATH)
 
-from utils.string_utils import extract_digits_from_text, contains_digits  # noqa: E402
-from utils.pd_df_ops import cast_df_and_rename_cols  # noqa: E402
+from utils.string_utils import (  # noqa: E402
+    contains_digits,
+    extract_digits_from_text,
+    extract_float_from_text,
+    extract_int_from_text,
+)
+from parser_engine import get_site_config  # noqa: E402
+from fetcher import (  # noqa: E402
+    ErrorPageError,
+    find_error_signature,
+    get_default_fetcher,
+    get_json_endpoint_fetcher,
+    raise_for_error_page,
+)
+from json_endpoints import JsonEndpoint, json_to_df  # noqa: E402
+from page_archive import get_page_archive  # noqa: E402
+
+
+def fetch_page(url: str, cache: ResponseCache = None) -> Optional[FetchedPage]:
+    """
+    Given a url, make a get request and return the fetched page.
+    If a ResponseCache is given, a conditional request is made and None is returned when the page hasn't changed.
+    The page is not stored in the cache: call cache.store(page) once its units are upserted, so a building whose
+    parse or upsert fails is fetched and scraped again on the next sweep.
+    Requests have timeouts and retries, and fail fast for websites whose circuit is open (see fetcher.py).
+    """
+    with timed("fetch") as record:
+        return get_default_fetcher().fetch(url, cache=cache, record=record)
 
 
 def get_soup(url: str) -> BeautifulSoup:
@@ -25,45 +62,36 @@ def get_soup(url: str) -> BeautifulSoup:
     Given a url, make a get request and return the BeautifulSoup object of the response content.
     This function is for websites that don't require any clicking to get all of the apartment data.
     """
-    # Fetch the HTML content
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, "html.parser")
-    return soup
+    return make_soup(fetch_page(url).text)
 
 
-def parse_table_from_html(soup: BeautifulSoup, div_id: str) -> pd.DataFrame:
+def parse_table_from_html(soup: BeautifulSoup, div_id: str, url: str = "") -> pd.DataFrame:
     """
     Given the html of a webpage and a div id, extract a table as a pandas df.
-    Note: this assumes a table is nested inside a div id.
+    Note: this assumes a table is nested inside a div id. The url selects the website's error page signatures.
     """
     div_apts = soup.find("div", id=div_id)
     if div_apts is None:
         raise ValueError(f"Div with id {div_id} not found")
     table = div_apts.find("table")
-    # TODO: improve website error handling/make this more robust
     if table is None:
-        if div_apts in WEBSITE_ERROR_MESSAGES:
-            print("Not finding a table with div_id {div_id}. This is what bs4 is finding with specified div_id:", div_apts)
+        signature = find_error_signature(url, str(div_apts))
+        if signature:
+            raise ErrorPageError(f"Website shows an error instead of the table in div {div_id} ({signature!r})")
         raise ValueError(f"No table found inside div with id {div_id}")
-    df = pd.read_html(StringIO(str(table)))[0]
+    # Read the cells straight from the parsed tree instead of serializing the table and re-parsing it with pd.read_html.
+    with timed("parse") as record:
+        df = rows_to_df(*table_rows_from_tag(table))
+        record.rows = len(df)
     return df
 
 
 def clean_df_by_url(df: pd.DataFrame, url: str) -> pd.DataFrame:
     """
     Cleans the Pandas df based on the provided url.
-    Handles bespoke data cleaning and processing.
-    """
-    if "lydianlyric" in url:
-        df["bedrooms"], df["bathrooms"] = zip(*df["BED/BATH"].str.split(" / ", n=1))
-        df = df.drop(columns=["DETAILS", "APPLY NOW", "BED/BATH", "Building"])
-        cols_to_extract_digits = ["RENT *", "bedrooms", "bathrooms", "SQ FT **"]
-        df[cols_to_extract_digits] = df[cols_to_extract_digits].map(
-            extract_digits_from_text
-        )
-    else:
-        raise ValueError(f"URL '{url}' is not recognized.")
-    return df
+    The cleaning rules for each website are defined in configs/website_config.yaml.
+    """
+    return get_site_config(url).clean(df)
 
 
 def scrape_parse_and_read_html(url: str, div_id: str) -> pd.DataFrame:
@@ -71,143 +99,195 @@ def scrape_parse_and_read_html(url: str, div_id: str) -> pd.DataFrame:
     Scrapes, parses, and reads HTML content from a given URL and extracts data into a Pandas df.
     Through the url, set a schema and a dictionary of columns to be renamed. This needs to be done for each new url.
     """
-    if "lydianlyric" in url:
-        # TODO: rework this to rename columns and then set schema at end? Important to make sure unit number stays as a string.
-        schema = {
-            "UNIT NUMBER": str,
-            "RENT *": int,
-            "SQ FT **": int,
-            "bedrooms": np.float16,
-            "bathrooms": np.float16,
-        }
-        col_rename_mapping = {
-            "RENT *": "price",
-        }
-    else:
-        raise ValueError(f"URL '{url}' is not recognized.")
     soup = get_soup(url)
-    df = parse_table_from_html(soup, div_id)
-    df_cleaned = clean_df_by_url(df, url)
-    df_cleaned = cast_df_and_rename_cols(df_cleaned, schema, col_rename_mapping)
-    return df_cleaned
+    return parse_and_clean_soup(soup, url, div_id)
 
 
-def interact_and_scrape_website(url: str) -> BeautifulSoup:
+def parse_and_clean_soup(soup: BeautifulSoup, url: str, div_id: str) -> pd.DataFrame:
     """
-    Depending on what website, take action to show all apt data, and return a BeautifulSoup object.
+    Given the BeautifulSoup object of a table website, parse the table in div_id and return a cleaned, typed df.
+    The schema and column renames for each website are defined in configs/website_config.yaml.
     """
-    driver_options = webdriver.chrome.options.Options()
-    driver_options.add_argument("--headless=new")
-    driver = webdriver.Chrome(ChromeDriverManager().install(), options=driver_options)
+    site_config = get_site_config(url)
+    df = parse_table_from_html(soup, div_id, url)
+    return site_config.clean_and_cast(df)
+
+
+def parse_and_clean_html(html: str, url: str, div_id: str) -> pd.DataFrame:
+    """
+    Given raw html already fetched for a url, parse the table in div_id and return a cleaned df.
+    Kept at module level (and free of network calls) so it can be sent to a process pool.
+    """
+    site_config = get_site_config(url)
+    with timed("parse") as record:
+        df = extract_table_df(html, div_id)
+        record.rows = len(df)
+    return site_config.clean_and_cast(df)
+
+
+FP_BLOCK_SELECTOR = "div.fp_lists div.fp_block"
 
+
+def load_more_fp_blocks(driver, url: str):
+    """Interaction for floor plan list websites (e.g. 450k) that only show 6 floor plans until load more is clicked."""
+    from selenium.webdriver.common.by import By
+
+    from browser_pool import wait_for_clickable, wait_for_element, wait_for_stable_count
+
+    available_apts_header = wait_for_element(driver, (By.CLASS_NAME, "available_apartmnt")).text.strip()
+    available_apts_str = available_apts_header.split(sep=" ")[0]
     try:
-        driver.get(url)
-        time.sleep(3)
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-
-        if "450k" in url:
-            available_apts_header = soup.find("div", class_="available_apartmnt").get_text(strip=True)
-
-            if available_apts_header is None:
-                raise ValueError("Could not find the 'available_apartmnt' div")
-        
-            available_apts_str = available_apts_header.strip().split(sep=" ")[0]
-            try:
-                available_apts = int(available_apts_str)
-            except ValueError as e:
-                raise ValueError(f"Failed to convert '{available_apts}' to an integer: {str(e)}") from e
-
-            if available_apts == 0:
-                print(f"No available apartments found at {url}")
-            elif available_apts > 6:
-                time.sleep(1)
-                # Scroll to the bottom to force cookie pop up to minimize.
-                driver.execute_script("window.scrollBy(0, 1800);")
-                # driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                time.sleep(1)
-                try:
-                    # Finding by element works more reliably than by xpath.
-                    load_more_button = driver.find_element_by_id("btn_loadmore")
-                    load_more_button.click()
-                    # Need to wait for additional data to load after clicking button.
-                    time.sleep(3)
-                except Exception as e:
-                    print(f"Could not click load more button. Error: {e}")
-
-            elif available_apts <= 6:
-                print(f"Don't need to load more since only {available_apts} available apartments at {url}")
-            else:
-                raise ValueError(f"URL '{url}' is not recognized.")
-            
-        return soup
-
-    except Exception as e:
-        print(f"Error during scraping url {url}. Error: {e}")
-        print(f"Page source: {driver.page_source[:500]}...") 
-
-    finally:
-        driver.quit()
+        available_apts = int(available_apts_str)
+    except ValueError as e:
+        raise ValueError(f"Failed to convert '{available_apts_str}' to an integer: {str(e)}") from e
+
+    if available_apts == 0:
+        print(f"No available apartments found at {url}")
+    elif available_apts > 6:
+        # Scroll to the bottom to force cookie pop up to minimize.
+        driver.execute_script("window.scrollBy(0, 1800);")
+        fp_blocks_before = len(driver.find_elements_by_css_selector(FP_BLOCK_SELECTOR))
+        try:
+            # Finding by element works more reliably than by xpath.
+            load_more_button = wait_for_clickable(driver, (By.ID, "btn_loadmore"))
+            load_more_button.click()
+            # Wait for additional data to load after clicking button.
+            fp_blocks = wait_for_stable_count(
+                driver, FP_BLOCK_SELECTOR, expected_count=available_apts, min_count=fp_blocks_before
+            )
+        except Exception as e:
+            raise RuntimeError(f"Could not load more apartments at {url}. Error: {e}") from e
+        # A partial page would be upserted as every other unit having been removed.
+        if fp_blocks < available_apts:
+            raise ValueError(f"Only {fp_blocks} of {available_apts} available apartments loaded at {url}")
+    else:
+        print(f"Don't need to load more since only {available_apts} available apartments at {url}")
+
+
+# Browser interactions that a website's config can refer to by name.
+INTERACTIONS = {
+    "load_more_fp_blocks": load_more_fp_blocks,
+}
+
+
+def render_page_source(url: str, pool: "BrowserPool" = None) -> str:
+    """
+    Depending on what website, take action to show all apt data, and return the page source.
+    Uses a warm driver from the browser pool (the default pool if none is given) and waits on page conditions instead of fixed sleeps.
+    Selenium is only imported here, so table websites are scraped without loading it.
+    When a page archive is replaying, the recorded page source is returned instead and no browser is started.
+    """
+    site_config = get_site_config(url)
+    archive = get_page_archive()
+    if archive is not None and archive.replaying:
+        return archive.replay_text(url, "browser")
+
+    from browser_pool import get_default_browser_pool
+
+    pool = pool or get_default_browser_pool()
+    breaker = get_default_fetcher().breaker
+    # A domain that keeps failing is skipped before a driver is even checked out.
+    breaker.check(url)
+    with pool.driver() as driver:
+        try:
+            with timed("render") as record:
+                driver.get(url)
+                # Check for an error page before interacting, rather than waiting for elements that will never show up.
+                raise_for_error_page(url, driver.page_source)
+                if site_config.interaction:
+                    INTERACTIONS[site_config.interaction](driver, url)
+                # Read the page source after interacting so units loaded by the load more button are included.
+                page_source = driver.page_source
+                record.bytes = len(page_source.encode())
+            if archive is not None and archive.recording:
+                archive.record(url, "browser", page_source.encode())
+            breaker.record_success(url)
+            return page_source
+
+        except Exception as e:
+            breaker.record_failure(url)
+            print(f"Error during scraping url {url}. Error: {e}")
+            print(f"Page source: {driver.page_source[:500]}...")
+            raise
+
+
+def interact_and_scrape_website(url: str, pool: "BrowserPool" = None) -> BeautifulSoup:
+    """Render the website in a browser (see render_page_source) and return a BeautifulSoup object of the part its parser reads."""
+    page_source = render_page_source(url, pool)
+    # Only the subtree the website's parser needs is kept.
+    with timed("parse"):
+        return make_soup(page_source, parse_only=PARSER_SUBTREES.get(get_site_config(url).parser))
+
+
+def parse_fp_blocks_to_df(soup: BeautifulSoup) -> pd.DataFrame:
+    """
+    Parse floor plan list websites (e.g. 450k), where each unit is a div.fp_block inside div.fp_lists.
+    Values go straight into typed columns (APT_DF_SCHEMA), so the df needs no cast afterwards.
+    """
+    div_class_450k = "fp_lists"
+    soup_floor_plans = soup.find("div", class_=div_class_450k)
+    fp_blocks = soup_floor_plans.find_all("div", class_="fp_block")
+    units = UnitRecords(capacity=len(fp_blocks))
+    # Extract apartment data from html by iterating through each floor plan (fp) block.
+    # FPs after "loading more" don't have <p> classes to reference like other FPs.
+    for fp_block in fp_blocks:
+        append_fp_block(units, [p.text for p in fp_block.find_all("p")], fp_block.find("p", class_="fp_no").text)
+    return units.to_df()
+
+
+def append_fp_block(units: UnitRecords, description: list, fp_no: str):
+    """Add one floor plan block to units, given the text of each of its <p> tags and of its p.fp_no tag."""
+    bed_and_bath = description[1].split("+")
+    # Studios have no number of bedrooms.
+    bedrooms, bathrooms = [extract_float_from_text(b) if contains_digits(b) else 0 for b in bed_and_bath]
+    units.append(
+        unit_number=extract_digits_from_text(fp_no),
+        bedrooms=bedrooms,
+        bathrooms=bathrooms,
+        sq_ft=extract_int_from_text(description[3].split()[0]),
+        floor_plan_type=description[2].strip(),
+        price=extract_int_from_text(description[4]),
+        date_available=description[5].strip().replace("AVAILABLE ", ""),
+    )
+
+
+def iter_fp_block_chunks(html_chunks: Iterable[str], chunk_rows: int = STREAM_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Streaming version of parse_fp_blocks_to_df: yield typed dfs of at most chunk_rows units while the page is read."""
+    units = UnitRecords(capacity=chunk_rows)
+    for fp_block in iter_fp_block_elements(html_chunks):
+        description = [p.text_content() for p in fp_block.iter("p")]
+        fp_no = fp_block.xpath("string(.//p[contains(concat(' ', normalize-space(@class), ' '), ' fp_no ')])")
+        append_fp_block(units, description, fp_no)
+        if len(units) >= chunk_rows:
+            yield units.to_df()
+            units = UnitRecords(capacity=chunk_rows)
+    if len(units):
+        yield units.to_df()
+
+
+# HTML parsers for interactive websites that a website's config can refer to by name,
+# and the part of the page each one reads.
+PARSERS = {
+    "fp_blocks": parse_fp_blocks_to_df,
+}
+PARSER_SUBTREES = {
+    "fp_blocks": SoupStrainer("div", class_="fp_lists"),
+}
+# Streaming versions of PARSERS, for websites configured with streaming: true.
+STREAM_PARSERS = {
+    "fp_blocks": iter_fp_block_chunks,
+}
 
 
 def parse_html_to_df(url: str, soup: BeautifulSoup) -> pd.DataFrame:
     """Given BeautifulSoup object, parse by url and return a cleaned df of apartment information."""
-    if "450k" in url:
-        div_class_450k = "fp_lists"
-        soup_floor_plans = soup.find("div", class_=div_class_450k)
-        # Extract apartment data from html by iterating through each floor plan (fp) block.
-        # FPs after "loading more" don't have <p> classes to reference like other FPs.
-        apartments = []
-        for fp_block in soup_floor_plans.find_all("div", class_="fp_block"):
-            unit_number = fp_block.find("p", class_="fp_no").text.strip()
-            unit_number_extracted = extract_digits_from_text(unit_number)
-            description = fp_block.find_all("p")
-            bed_and_bath = description[1].text.strip().split("+")
-            bedrooms, bathrooms = [
-                extract_digits_from_text(b) if contains_digits(b) else 0
-                for b in bed_and_bath
-            ]
-            floor_plan_type = description[2].text.strip()
-            sq_ft = description[3].text.strip().split(" ")[0]
-            price_string = description[4].text.strip().replace(",", "")
-            price_extracted = extract_digits_from_text(price_string)
-            date_available = description[5].text.strip().replace("AVAILABLE ", "")
-            apartments.append(
-                (
-                    unit_number_extracted,
-                    bedrooms,
-                    bathrooms,
-                    sq_ft,
-                    floor_plan_type,
-                    price_extracted,
-                    date_available,
-                )
-            )
-
-        # Convert to dataframe, set types
-        # All of these columns should always have the same types. Can have global dict with types?
-        df_450k = pd.DataFrame(
-            apartments,
-            columns=[
-                "unit_number",
-                "bedrooms",
-                "bathrooms",
-                "sq_ft",
-                "floor_plan_type",
-                "price",
-                "date_available",
-            ],
-        )
-        df_450k = df_450k.astype(
-            {
-                "bedrooms": np.float16,
-                "bathrooms": np.float16,
-                "sq_ft": int,
-                "price": int,
-            }
-        )
-        return df_450k
-    else:
-        raise ValueError(f"URL '{url}' is not recognized.")
+    site_config = get_site_config(url)
+    if site_config.parser not in PARSERS:
+        raise ValueError(f"URL '{url}' has no parser configured.")
+    with timed("parse") as record:
+        df = PARSERS[site_config.parser](soup)
+        record.rows = len(df)
+    return site_config.clean_and_cast(df)
 
 
 def interact_scrape_and_get_df(url: str) -> pd.DataFrame:
@@ -217,22 +297,84 @@ def interact_scrape_and_get_df(url: str) -> pd.DataFrame:
     return df
 
 
-def given_url_get_latest_scraped_data(url: str, div_id: str = None) -> pd.DataFrame:
-    """Dispatcher function that takes a url, determines how it needs to be scraped, calls the necessary functions, and returns a cleaned df."""
+def parse_and_clean_json(text: str, url: str, json_endpoint: dict) -> pd.DataFrame:
+    """
+    Given the response of a building url's JSON endpoint (apts.json_endpoint), map its records to a cleaned df.
+    Kept at module level (and free of network calls) so it can be sent to a process pool.
+    """
+    site_config = get_site_config(url)
+    with timed("parse") as record:
+        df = json_to_df(json.loads(text), JsonEndpoint.from_dict(json_endpoint))
+        record.rows = len(df)
+    return site_config.clean_and_cast(df)
+
+
+def scrape_json_endpoint(url: str, json_endpoint: dict) -> pd.DataFrame:
+    """Get the floor plans of an interactive website from the JSON endpoint the page loads them from, without a browser."""
+    with timed("fetch") as record:
+        page = get_json_endpoint_fetcher().fetch(json_endpoint["url"], record=record)
+    return parse_and_clean_json(page.text, url, json_endpoint)
+
+
+def given_url_get_latest_scraped_data(url: str, div_id: str = None, json_endpoint: dict = None) -> pd.DataFrame:
+    """
+    Dispatcher function that takes a url, determines how it needs to be scraped, calls the necessary functions, and returns a cleaned df.
+    With a json_endpoint (see json_endpoints.py), the endpoint is tried first and the browser is only used if it fails.
+    """
     # TODO: make this function more robust for other cases/websites
     # TODO: Add unit test/checks/raise errors
     if div_id:
         df = scrape_parse_and_read_html(url, div_id)
         return df
-    elif "450k" in url:
+    if json_endpoint:
+        try:
+            return scrape_json_endpoint(url, json_endpoint)
+        except Exception as e:
+            print(f"JSON endpoint of {url} failed, falling back to the browser. Error: {e}")
+    if get_site_config(url).scrape_method == "interactive":
         df = interact_scrape_and_get_df(url)
         return df
-    elif not div_id:
+    else:
         raise ValueError(
             f"Don't recognize url: {url}. Did you mean to specify a div_id?"
         )
+
+
+def clean_chunks(url: str, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """Clean and cast each chunk of a streamed page with the website's config, timing how long each took to read."""
+    site_config = get_site_config(url)
+    while True:
+        with timed("stream") as record:
+            df = next(chunks, None)
+            record.rows = 0 if df is None else len(df)
+        if df is None:
+            return
+        yield site_config.clean_and_cast(df)
+
+
+def is_streamed(url: str, json_endpoint: dict = None) -> bool:
+    """Whether a building is scraped with stream_scraped_data. A captured JSON endpoint is used instead, if there is one."""
+    return get_site_config(url).streaming and not json_endpoint
+
+
+def stream_scraped_data(
+    url: str, div_id: str = None, chunk_rows: int = STREAM_CHUNK_ROWS, html_chunks: Iterable[str] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Streaming version of given_url_get_latest_scraped_data, for websites with streaming: true in their config.
+    Yields cleaned dfs of at most chunk_rows units as the page is parsed, so the page is never held as a tree or one df.
+    Table pages are parsed while they download (from html_chunks, if the caller is already downloading the page);
+    interactive websites are parsed from the browser's page source.
+    """
+    site_config = get_site_config(url)
+    if div_id:
+        html_chunks = html_chunks if html_chunks is not None else get_default_fetcher().stream_text(url)
+        chunks = iter_table_row_chunks(html_chunks, div_id, chunk_rows)
+    elif site_config.scrape_method == "interactive" and site_config.parser in STREAM_PARSERS:
+        chunks = STREAM_PARSERS[site_config.parser](iter_text_chunks(render_page_source(url)), chunk_rows)
     else:
-        raise ValueError(f"Don't recognize url: {url}.")
+        raise ValueError(f"URL '{url}' has no streaming parser. Did you mean to specify a div_id?")
+    yield from clean_chunks(url, chunks)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,366 @@
+"""
+Concurrent scrape runner for sweeping every building in the apts table.
+
+Static table websites are fetched with aiohttp (bounded globally and per host, with connect/read timeouts, retries
+and a per domain circuit breaker, see fetcher.py),
+parsed in a process pool (or on a thread, with parse_workers=0) so parsing overlaps with network I/O, and upserted in batches of buildings on DB writer threads
+(one per connection in the config manager's pool).
+Websites that need a browser (e.g. 450k) run in a small thread pool alongside the static fetches, unless the building
+has a captured JSON endpoint (see json_endpoints.py), which is fetched and parsed like a static page instead.
+With a ResponseCache, static pages are fetched conditionally and skipped entirely (no parse, no upsert) when unchanged.
+With a SnapshotStore, every building is also archived for price history analytics once its upsert committed (so a
+retried upsert isn't archived twice), and unchanged pages archive the building's previous snapshot again.
+With a UnitHashCache, only units that changed since the last write are sent to the DB.
+Websites configured with streaming: true are parsed in chunks as they download (aiohttp, within the same connection
+limits, feeding a parse thread) and spooled to a temporary file, then upserted on a DB writer thread, so the writer's
+transaction never waits on the website (see apt_webscraper.stream_scraped_data and store_in_db.ChunkSpool). Deferred
+upserts are written by another process, so those buildings are parsed in one piece instead.
+When a page archive is recording or replaying (see page_archive.py), pages are saved to or served from it.
+Every stage of every building (fetch, render, parse, clean, cast, upsert) is recorded in the runner's PipelineMetrics.
+A failing building is recorded in its result and never aborts the rest of the sweep.
+"""
+import asyncio
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import pandas as pd
+
+from apt_webscraper import (
+    given_url_get_latest_scraped_data,
+    is_streamed,
+    parse_and_clean_html,
+    parse_and_clean_json,
+    stream_scraped_data,
+)
+from browser_pool import BROWSER_POOL_SIZE
+from fetcher import Fetcher, get_default_fetcher, get_json_endpoint_fetcher
+from http_cache import FetchedPage, ResponseCache
+from metrics import METRICS_TEXTFILE_PATH, PipelineMetrics, StageRecord, call_with_timings, timed
+from page_archive import get_page_archive
+from snapshot_store import SnapshotStore
+from store_in_db import ChunkSpool, spool_chunks
+from unit_hash_cache import UnitHashCache
+
+
+GLOBAL_CONCURRENCY_LIMIT = 20
+PER_HOST_CONCURRENCY_LIMIT = 2
+# Interactive scrapes each hold a driver from the browser pool, so more threads than drivers would just queue.
+INTERACTIVE_CONCURRENCY_LIMIT = BROWSER_POOL_SIZE
+REQUEST_TIMEOUT_SECONDS = 30
+PARSE_WORKERS = os.cpu_count() or 1
+# Number of scraped buildings to collect before writing them to the DB in one bulk upsert.
+UPSERT_BATCH_SIZE = 25
+
+
+@dataclass
+class BuildingScrapeResult:
+    building_name: str
+    apt_id: int
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: bool = False
+    error: Optional[str] = None
+
+
+class AsyncScrapeRunner:
+    def __init__(
+        self,
+        config_manager,
+        global_limit: int = GLOBAL_CONCURRENCY_LIMIT,
+        per_host_limit: int = PER_HOST_CONCURRENCY_LIMIT,
+        interactive_limit: int = INTERACTIVE_CONCURRENCY_LIMIT,
+        request_timeout: float = REQUEST_TIMEOUT_SECONDS,
+        parse_workers: int = PARSE_WORKERS,
+        cache: Optional[ResponseCache] = None,
+        upsert_batch_size: int = UPSERT_BATCH_SIZE,
+        snapshot_store: Optional[SnapshotStore] = None,
+        metrics: Optional[PipelineMetrics] = None,
+        metrics_textfile_path: Optional[str] = METRICS_TEXTFILE_PATH,
+        defer_upserts: bool = False,
+        fetcher: Optional[Fetcher] = None,
+        unit_cache: Optional[UnitHashCache] = None,
+        json_endpoint_fetcher: Optional[Fetcher] = None,
+    ):
+        """With defer_upserts, scraped buildings are only collected (see take_pending_upserts) and nothing is written to the DB."""
+        self.config_manager = config_manager
+        self.global_limit = global_limit
+        self.per_host_limit = per_host_limit
+        self.interactive_limit = interactive_limit
+        self.request_timeout = request_timeout
+        self.parse_workers = parse_workers
+        self.cache = cache
+        self.upsert_batch_size = upsert_batch_size
+        self.snapshot_store = snapshot_store
+        self.metrics = metrics or PipelineMetrics()
+        self.metrics_textfile_path = metrics_textfile_path
+        self.defer_upserts = defer_upserts
+        # The default fetcher is shared by every runner in the process, so open circuits carry over between sweeps.
+        self.fetcher = fetcher or get_default_fetcher()
+        # JSON endpoints have their own circuits, so a failing endpoint doesn't keep its browser fallback from running.
+        self.json_endpoint_fetcher = json_endpoint_fetcher or get_json_endpoint_fetcher()
+        self.unit_cache = unit_cache
+        self._pending_upserts = []
+
+    async def fetch_page(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        record: Optional[StageRecord] = None,
+        fetcher: Optional[Fetcher] = None,
+    ) -> Optional[FetchedPage]:
+        """
+        Make a get request (with retries, see fetcher.py) and return the fetched page. Connection limits are enforced by the session's connector.
+        Returns None if there's a cache and the page hasn't changed since the last successful sweep.
+        """
+        return await (fetcher or self.fetcher).fetch_async(session, url, cache=self.cache, record=record)
+
+    async def scrape_building(
+        self, session: aiohttp.ClientSession, building: Dict
+    ) -> Tuple[Optional[pd.DataFrame], Optional[FetchedPage]]:
+        """
+        Given a row of the apts table, fetch and parse the building's website.
+        Returns a df tagged with its apt_id (None if the page is unchanged) and the fetched page, if there was one.
+        """
+        url, div_id, building_name = building["url"], building["div_id"], building["building_name"]
+        json_endpoint = building.get("json_endpoint")
+        page = None
+        if div_id:
+            # Includes any time spent waiting for a free connection, since that is sweep time too.
+            with self.metrics.stage(building_name, "fetch") as record:
+                page = await self.fetch_page(session, url, record)
+            if page is None:
+                return None, None
+            df = await self._run_with_timings(self._parse_pool, building_name, parse_and_clean_html, page.text, url, div_id)
+        elif json_endpoint:
+            try:
+                with self.metrics.stage(building_name, "fetch") as record:
+                    page = await self.fetch_page(session, json_endpoint["url"], record, self.json_endpoint_fetcher)
+                if page is None:
+                    return None, None
+                df = await self._run_with_timings(
+                    self._parse_pool, building_name, parse_and_clean_json, page.text, url, json_endpoint
+                )
+            except Exception as e:
+                print(f"JSON endpoint of {building_name} failed, falling back to the browser. Error: {e}")
+                page, df = None, await self.scrape_in_browser(building)
+        else:
+            df = await self.scrape_in_browser(building)
+        df["apt_id"] = building["id"]
+        return df, page
+
+    async def scrape_in_browser(self, building: Dict) -> pd.DataFrame:
+        """Websites without a div_id need a browser, which blocks, so run them on their own threads."""
+        return await self._run_with_timings(
+            self._interactive_pool, building["building_name"], given_url_get_latest_scraped_data, building["url"], None
+        )
+
+    async def _run_with_timings(self, executor, building_name: str, func, *args):
+        """Run func in an executor and record the stages it timed in the worker, even if it fails."""
+        loop = asyncio.get_running_loop()
+        try:
+            result, timings = await loop.run_in_executor(executor, call_with_timings, func, *args)
+        except Exception as e:
+            self.metrics.merge(building_name, getattr(e, "stage_timings", []))
+            raise
+        self.metrics.merge(building_name, timings)
+        return result
+
+    async def process_building(self, session: aiohttp.ClientSession, building: Dict) -> BuildingScrapeResult:
+        """Scrape a single building and queue it for upserting, capturing any error in the returned result."""
+        result = BuildingScrapeResult(building_name=building["building_name"], apt_id=building["id"])
+        try:
+            # Deferred upserts are written by another process, so those buildings are parsed in one piece instead.
+            if not self.defer_upserts and is_streamed(building["url"], building.get("json_endpoint")):
+                scraped_at = datetime.now(timezone.utc)
+                spool = await self.spool_building(session, building)
+                try:
+                    result.rows = spool.rows
+                    counts = await self._run_with_timings(
+                        self._db_pool, building["building_name"], self.upsert_spool, building, spool
+                    )
+                    if self.snapshot_store:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.archive_spool, building, spool, scraped_at
+                        )
+                finally:
+                    spool.close()
+                apt_counts = counts.set_index("apt_id").to_dict("index").get(building["id"], {})
+                result.inserted = apt_counts.get("inserted", 0)
+                result.updated = apt_counts.get("updated", 0)
+                result.removed = apt_counts.get("removed", 0)
+                return result
+            df, page = await self.scrape_building(session, building)
+            if df is None:
+                result.unchanged = True
+                if self.snapshot_store:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.archive_unchanged, building["building_name"]
+                    )
+                return result
+            result.rows = len(df)
+            self._pending_upserts.append((result, df, page))
+            if len(self._pending_upserts) >= self.upsert_batch_size:
+                await self.flush_upserts()
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+            print(f"Error scraping building {building['building_name']} ({building['url']}). Error: {e}")
+        return result
+
+    async def spool_building(self, session: aiohttp.ClientSession, building: Dict) -> ChunkSpool:
+        """
+        Read a streamed building into a ChunkSpool without holding a DB connection. A table page is downloaded with aiohttp and parsed on a thread as it arrives; a website that needs a
+        browser is rendered and parsed on a browser thread.
+        """
+        url, div_id, building_name = building["url"], building["div_id"], building["building_name"]
+        if not div_id:
+            return await self._run_with_timings(
+                self._interactive_pool, building_name, spool_chunks, stream_scraped_data(url)
+            )
+        with self.metrics.stage(building_name, "fetch") as record:
+            stream = await self.fetcher.stream_async(session, url, record=record)
+        try:
+            chunks = stream_scraped_data(url, div_id, html_chunks=stream.iter_text())
+            # Not the parse pool, which may be processes: the parser reads the download from this event loop.
+            return await self._run_with_timings(None, building_name, spool_chunks, chunks)
+        finally:
+            await stream.aclose()
+
+    def upsert_spool(self, building: Dict, spool: ChunkSpool) -> pd.DataFrame:
+        """Upsert a spooled building (see DBConfigManager.stream_upsert_floor_plans). Blocks, so it runs on a DB writer thread."""
+        with timed("upsert") as record:
+            counts = self.config_manager.stream_upsert_floor_plans(building["id"], spool, unit_cache=self.unit_cache)
+            record.rows = spool.rows
+        return counts
+
+    def archive_snapshot(self, df: pd.DataFrame, building_name: str, scraped_at: Optional[datetime] = None):
+        """Write an upserted df to the snapshot store. A failed write is logged but doesn't fail the building."""
+        try:
+            self.snapshot_store.append(df, building_name, scraped_at=scraped_at)
+        except Exception as e:
+            print(f"Error archiving snapshot of building {building_name}. Error: {e}")
+
+    def archive_spool(self, building: Dict, spool: ChunkSpool, scraped_at: datetime):
+        """
+        Write an upserted streamed building to the snapshot store, one file per chunk. Every chunk gets the same
+        scraped_at, so the files read back as one snapshot of the building.
+        """
+        for df in spool:
+            df["apt_id"] = building["id"]
+            self.archive_snapshot(df, building["building_name"], scraped_at)
+
+    def archive_unchanged(self, building_name: str):
+        """Archive a building whose page was unchanged since its last sweep as its previous snapshot."""
+        try:
+            self.snapshot_store.append_unchanged(building_name)
+        except Exception as e:
+            print(f"Error archiving snapshot of building {building_name}. Error: {e}")
+
+    async def flush_upserts(self):
+        """Write every queued building to the DB."""
+        if self.defer_upserts:
+            return
+        batch, self._pending_upserts = self._pending_upserts, []
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(self._db_pool, self.upsert_batch, batch)
+
+    def take_pending_upserts(self) -> List[Tuple[BuildingScrapeResult, pd.DataFrame, Optional[FetchedPage]]]:
+        """Return (and forget) the scraped buildings that haven't been upserted yet."""
+        batch, self._pending_upserts = self._pending_upserts, []
+        return batch
+
+    def upsert_batch(self, batch: List[Tuple[BuildingScrapeResult, pd.DataFrame, Optional[FetchedPage]]]):
+        """
+        Bulk upsert a batch of buildings, one statement per distinct set of columns.
+        If a bulk upsert fails, retry its buildings one at a time so only the bad building is marked as failed.
+        """
+        batches_by_columns = defaultdict(list)
+        for item in batch:
+            batches_by_columns[frozenset(item[1].columns)].append(item)
+
+        for items in batches_by_columns.values():
+            start = time.perf_counter()
+            try:
+                counts = self.write_floor_plans([df for _, df, _ in items], [result.apt_id for result, _, _ in items])
+                succeeded = items
+                self._observe_upsert(items, time.perf_counter() - start)
+            except Exception as e:
+                self._observe_upsert(items, time.perf_counter() - start, error=type(e).__name__)
+                print(f"Bulk upsert of {len(items)} buildings failed, retrying one at a time. Error: {e}")
+                counts, succeeded = [], []
+                for item in items:
+                    result = item[0]
+                    start = time.perf_counter()
+                    try:
+                        counts.append(self.write_floor_plans([item[1]], [result.apt_id]))
+                        succeeded.append(item)
+                        self._observe_upsert([item], time.perf_counter() - start, retries=1)
+                    except Exception as e:
+                        self._observe_upsert([item], time.perf_counter() - start, retries=1, error=type(e).__name__)
+                        result.error = f"{type(e).__name__}: {e}"
+                        print(f"Error upserting building {result.building_name}. Error: {e}")
+                counts = pd.concat(counts) if counts else None
+
+            counts_by_apt_id = {} if counts is None else counts.set_index("apt_id").to_dict("index")
+            for result, df, page in succeeded:
+                apt_counts = counts_by_apt_id.get(result.apt_id, {})
+                result.inserted = apt_counts.get("inserted", 0)
+                result.updated = apt_counts.get("updated", 0)
+                result.removed = apt_counts.get("removed", 0)
+                if self.cache and page is not None:
+                    self.cache.store(page)
+                if self.snapshot_store:
+                    self.archive_snapshot(df, result.building_name)
+
+    def write_floor_plans(self, dfs: List[pd.DataFrame], apt_ids: List[int]) -> pd.DataFrame:
+        """
+        Upsert dfs with the same columns (apt_ids holds the building of each df, which may be empty), sending only
+        changed units if there's a unit cache.
+        """
+        if self.unit_cache is not None:
+            return self.config_manager.upsert_changed_floor_plans(dfs, self.unit_cache, apt_ids=apt_ids)
+        return self.config_manager.bulk_upsert_floor_plans(dfs, apt_ids=apt_ids)
+
+    def _observe_upsert(self, items, seconds: float, retries: int = 0, error: Optional[str] = None):
+        """Record one bulk upsert for each building in it, splitting its time between the buildings by row count."""
+        total_rows = sum(len(df) for _, df, _ in items) or 1
+        for result, df, _ in items:
+            self.metrics.observe(
+                result.building_name,
+                StageRecord("upsert", seconds=seconds * len(df) / total_rows, rows=len(df), retries=retries, error=error),
+            )
+
+    async def run(self, buildings: List[Dict]) -> List[BuildingScrapeResult]:
+        """Scrape and upsert every building concurrently and return one result per building."""
+        archive = get_page_archive()
+        if archive is not None:
+            archive.register_buildings(buildings)
+        timeout = self.fetcher.client_timeout(total=self.request_timeout)
+        connector = aiohttp.TCPConnector(limit=self.global_limit, limit_per_host=self.per_host_limit)
+        # Without parse workers, parsing runs on one thread of this process (e.g. when this process is itself a sweep worker).
+        parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers) if self.parse_workers else ThreadPoolExecutor(max_workers=1)
+        with parse_pool as self._parse_pool, ThreadPoolExecutor(
+            max_workers=self.interactive_limit
+        ) as self._interactive_pool, ThreadPoolExecutor(
+            # One writer thread per DB connection the config manager can hand out at once.
+            max_workers=self.config_manager.max_concurrent_connections
+        ) as self._db_pool:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                results = await asyncio.gather(*(self.process_building(session, b) for b in buildings))
+            await self.flush_upserts()
+        if self.metrics_textfile_path:
+            self.metrics.write_textfile(self.metrics_textfile_path)
+        return results
+
+
+def run_concurrent_sweep(config_manager, buildings: List[Dict], **runner_kwargs) -> List[BuildingScrapeResult]:
+    """Synchronous entry point: sweep the given apts rows (dicts with id, building_name, url, div_id)."""
+    runner = AsyncScrapeRunner(config_manager, **runner_kwargs)
+    return asyncio.run(runner.run(buildings))
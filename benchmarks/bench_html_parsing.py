@@ -0,0 +1,92 @@
+"""
+Compare the original html.parser + pd.read_html path with the lxml backend on saved fixture pages.
+
+Before timing, every table path (html.parser, lxml, streamed) is checked against pd.read_html on each table fixture,
+including one whose body rows start with a <th> row header.
+
+Usage: python benchmarks/bench_html_parsing.py [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import timeit
+from io import StringIO
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(REPO_ROOT, "benchmarks", "fixtures")
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+import pandas as pd  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+from apt_webscraper import PARSER_SUBTREES, parse_fp_blocks_to_df  # noqa: E402
+from html_parsing import extract_table_df, iter_table_row_chunks, iter_text_chunks, make_soup  # noqa: E402
+
+# (fixture, div id) of the table pages.
+TABLE_FIXTURES = [("lydian_floor_plans.html", "floor-plans"), ("row_header_floor_plans.html", "availability")]
+
+
+def original_table_path(html: str, div_id: str) -> pd.DataFrame:
+    """The table path before the lxml backend: full html.parser soup, then serialize the table and re-parse it with pd.read_html."""
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("div", id=div_id).find("table")
+    return pd.read_html(StringIO(str(table)))[0]
+
+
+def original_fp_blocks_path(html: str) -> pd.DataFrame:
+    return parse_fp_blocks_to_df(BeautifulSoup(html, "html.parser"))
+
+
+def lxml_fp_blocks_path(html: str) -> pd.DataFrame:
+    return parse_fp_blocks_to_df(make_soup(html, parse_only=PARSER_SUBTREES["fp_blocks"], backend="lxml"))
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return f.read()
+
+
+def check_table_paths():
+    """Raise AssertionError unless every table path reads the same strings as pd.read_html from each table fixture."""
+    for name, div_id in TABLE_FIXTURES:
+        html = read_fixture(name)
+        expected = original_table_path(html, div_id).astype(str)
+        streamed = pd.concat(list(iter_table_row_chunks(iter_text_chunks(html, 256), div_id, chunk_rows=2)))
+        paths = {
+            "html.parser": extract_table_df(html, div_id, backend="html.parser"),
+            "lxml": extract_table_df(html, div_id, backend="lxml"),
+            "streamed": streamed.reset_index(drop=True),
+        }
+        for path, df in paths.items():
+            pd.testing.assert_frame_equal(df.astype(str), expected, check_dtype=False, obj=f"{name} ({path})")
+
+
+def time_ms(func, repeat: int) -> float:
+    """Best of repeat runs, in milliseconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    check_table_paths()
+
+    lydian_html = read_fixture("lydian_floor_plans.html")
+    fp_blocks_html = read_fixture("450k_floor_plans.html")
+    cases = [
+        ("lydian table", "original (html.parser + read_html)", lambda: original_table_path(lydian_html, "floor-plans")),
+        ("lydian table", "lxml", lambda: extract_table_df(lydian_html, "floor-plans", backend="lxml")),
+        ("450k fp_blocks", "original (html.parser, full page)", lambda: original_fp_blocks_path(fp_blocks_html)),
+        ("450k fp_blocks", "lxml (fp_lists subtree only)", lambda: lxml_fp_blocks_path(fp_blocks_html)),
+    ]
+
+    print(f"{'page':<16} {'path':<36} {'rows':>5} {'best ms':>9}")
+    for page, path, func in cases:
+        rows = len(func())
+        print(f"{page:<16} {path:<36} {rows:>5} {time_ms(func, args.repeat):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
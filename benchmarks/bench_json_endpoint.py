@@ -0,0 +1,99 @@
+"""
+Check and time the JSON endpoint path for browser websites against a local mock website (mock_floor_plans_server.py).
+
+1. Infer the endpoint from the responses a capture would see (fetched directly, since capture itself needs Chrome)
+   and the units parsed from the rendered page.
+2. Compare the JSON path (GET endpoint + map records) with parsing the rendered page: same df, and how long each takes.
+   The html timing leaves out the browser render and load more click, so the real saving is larger.
+3. Make the API fail and check given_url_get_latest_scraped_data falls back to the browser path every time, including
+   after the endpoint has failed often enough to open its circuit. The browser is stood in for by a fetch of the
+   rendered page, after the same circuit check render_page_source makes.
+
+Usage: python benchmarks/bench_json_endpoint.py [--sizes 40 1000 5000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+import pandas as pd  # noqa: E402
+import requests  # noqa: E402
+
+import apt_webscraper  # noqa: E402
+from apt_webscraper import PARSER_SUBTREES, given_url_get_latest_scraped_data, parse_html_to_df, scrape_json_endpoint  # noqa: E402
+from fetcher import CIRCUIT_FAILURE_THRESHOLD, get_default_fetcher, get_json_endpoint_fetcher  # noqa: E402
+from html_parsing import make_soup  # noqa: E402
+from json_endpoints import CapturedResponse, infer_endpoint  # noqa: E402
+from mock_floor_plans_server import API_PATH, PAGE_PATH, RENDERED_PAGE_PATH, MockFloorPlansServer  # noqa: E402
+
+
+def best_of(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def scrape_rendered_page(mock: MockFloorPlansServer, url: str) -> pd.DataFrame:
+    """What the browser path parses: the page after load more, read into the fp_lists subtree soup."""
+    html = requests.get(mock.url(RENDERED_PAGE_PATH), timeout=10).text
+    return parse_html_to_df(url, make_soup(html, parse_only=PARSER_SUBTREES["fp_blocks"]))
+
+
+def run(n_units: int, repeat: int):
+    with MockFloorPlansServer(n_units) as mock:
+        url = mock.url(PAGE_PATH + "?two-bed=1")
+        responses = [
+            CapturedResponse(url=mock.url(path), method="GET", status=200, body=requests.get(mock.url(path), timeout=10).text)
+            for path in ["/api/site-settings", API_PATH + "?beds=2"]
+        ]
+        rendered_df = scrape_rendered_page(mock, url)
+        endpoint = infer_endpoint(responses, rendered_df)
+        assert endpoint is not None, "no endpoint inferred"
+        json_endpoint = endpoint.to_dict()
+
+        json_df = scrape_json_endpoint(url, json_endpoint)
+        pd.testing.assert_frame_equal(json_df, rendered_df)
+        json_seconds = best_of(lambda: scrape_json_endpoint(url, json_endpoint), repeat)
+        html_seconds = best_of(lambda: scrape_rendered_page(mock, url), repeat)
+        print(
+            f"{len(json_df):>6} units: json {json_seconds * 1000:8.1f} ms, rendered html parse {html_seconds * 1000:8.1f} ms "
+            f"({html_seconds / json_seconds:.1f}x), endpoint {endpoint.records_path} {endpoint.fields}"
+        )
+
+        def render_in_stand_in_browser(page_url):
+            # render_page_source skips a website whose circuit is open before checking out a driver.
+            get_default_fetcher().breaker.check(page_url)
+            return make_soup(requests.get(mock.url(RENDERED_PAGE_PATH), timeout=10).text, parse_only=PARSER_SUBTREES["fp_blocks"])
+
+        mock.failing = True
+        original = apt_webscraper.interact_and_scrape_website
+        apt_webscraper.interact_and_scrape_website = render_in_stand_in_browser
+        try:
+            for _ in range(CIRCUIT_FAILURE_THRESHOLD + 1):
+                fallback_df = given_url_get_latest_scraped_data(url, json_endpoint=json_endpoint)
+                pd.testing.assert_frame_equal(fallback_df, rendered_df)
+        finally:
+            apt_webscraper.interact_and_scrape_website = original
+        assert get_json_endpoint_fetcher().breaker.is_open(json_endpoint["url"]), "endpoint circuit didn't open"
+        assert not get_default_fetcher().breaker.is_open(url), "endpoint failures opened the website's circuit"
+        print(
+            f"{len(json_df):>6} units: fell back to the browser path {CIRCUIT_FAILURE_THRESHOLD + 1} times "
+            f"after {mock.api_requests} API requests in total, with the endpoint's circuit open."
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the JSON endpoint path against parsing the rendered page.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.repeat)
@@ -0,0 +1,24 @@
+-- Base tables for a throwaway benchmark database, matching how DBConfigManager uses them
+-- (see media/apt_monitor_db_schema.png). Migrations in migrations/ are applied on top of this.
+
+CREATE TABLE IF NOT EXISTS apts (
+    id SERIAL PRIMARY KEY,
+    building_name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    div_id TEXT,
+    last_updated TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS floor_plans (
+    id SERIAL PRIMARY KEY,
+    apt_id INTEGER NOT NULL REFERENCES apts (id),
+    unit_number TEXT NOT NULL,
+    bedrooms NUMERIC,
+    bathrooms NUMERIC,
+    sq_ft INTEGER,
+    floor_plan_type TEXT,
+    price INTEGER,
+    date_available TEXT,
+    availability_status BOOLEAN NOT NULL DEFAULT TRUE,
+    UNIQUE (apt_id, unit_number)
+);
@@ -0,0 +1,112 @@
+"""
+Check and measure streaming extraction (streaming: true websites) against parsing the whole page, on synthetic pages.
+
+For each page size and parser (lydian table, fp_blocks list), the page is first parsed both ways in this process to
+check the streamed chunks add up to the same df. Then each way runs in a fresh subprocess that builds the page and
+reports its time and how much its peak RSS grew while parsing, which (unlike tracemalloc) includes lxml's C tree.
+
+Usage: python benchmarks/bench_stream_parsing.py [--sizes 2000 8000 32000] [--chunk-rows 500]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+import pandas as pd  # noqa: E402
+
+from apt_webscraper import (  # noqa: E402
+    PARSER_SUBTREES,
+    clean_chunks,
+    iter_fp_block_chunks,
+    parse_and_clean_html,
+    parse_html_to_df,
+)
+from html_parsing import iter_table_row_chunks, iter_text_chunks, make_soup  # noqa: E402
+from synthetic_pages import fp_blocks_page, lydian_page  # noqa: E402
+
+LYDIAN_URL = "https://lydianlyric.com/lydian-floor-plans-2/?type=2BR"
+LYDIAN_DIV_ID = "floor-plans"
+FP_BLOCKS_URL = "https://www.450k.com/floor-plans/apartments?two-bed=1"
+PAGES = {"table": lydian_page, "fp_blocks": fp_blocks_page}
+
+
+def parse_whole(kind: str, html: str) -> pd.DataFrame:
+    if kind == "table":
+        return parse_and_clean_html(html, LYDIAN_URL, LYDIAN_DIV_ID)
+    return parse_html_to_df(FP_BLOCKS_URL, make_soup(html, parse_only=PARSER_SUBTREES["fp_blocks"]))
+
+
+def parse_streamed(kind: str, html: str, chunk_rows: int):
+    if kind == "table":
+        return clean_chunks(LYDIAN_URL, iter_table_row_chunks(iter_text_chunks(html), LYDIAN_DIV_ID, chunk_rows))
+    return clean_chunks(FP_BLOCKS_URL, iter_fp_block_chunks(iter_text_chunks(html), chunk_rows))
+
+
+def peak_rss_mb() -> float:
+    """This process's peak RSS. VmHWM, since ru_maxrss carries over the parent's peak across fork and exec on Linux."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("No VmHWM in /proc/self/status")
+
+
+def measure(kind: str, mode: str, n_units: int, chunk_rows: int) -> dict:
+    """Run in a subprocess: parse one page one way and return units, seconds and peak RSS growth in MB."""
+    html = PAGES[kind](n_units)
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "whole":
+        units = len(parse_whole(kind, html))
+    else:
+        units = sum(len(df) for df in parse_streamed(kind, html, chunk_rows))
+    return {
+        "units": units,
+        "seconds": time.perf_counter() - start,
+        "rss_growth_mb": peak_rss_mb() - baseline,
+    }
+
+
+def measure_in_subprocess(kind: str, mode: str, n_units: int, chunk_rows: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--measure", kind, mode, str(n_units), str(chunk_rows)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(n_units: int, chunk_rows: int):
+    for kind, make_page in PAGES.items():
+        html = make_page(n_units)
+        streamed = pd.concat(list(parse_streamed(kind, html, chunk_rows)), ignore_index=True)
+        pd.testing.assert_frame_equal(streamed, parse_whole(kind, html))
+        whole = measure_in_subprocess(kind, "whole", n_units, chunk_rows)
+        stream = measure_in_subprocess(kind, "stream", n_units, chunk_rows)
+        print(
+            f"{kind:>9} {whole['units']:>6} units ({len(html) / 2 ** 20:5.1f} MB): "
+            f"whole page {whole['seconds']:6.2f}s +{whole['rss_growth_mb']:6.1f} MB RSS, "
+            f"streamed {stream['seconds']:6.2f}s +{stream['rss_growth_mb']:6.1f} MB RSS"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare streaming extraction with parsing the whole page.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 8000, 32000])
+    parser.add_argument("--chunk-rows", type=int, default=500)
+    parser.add_argument("--measure", nargs=4, metavar=("KIND", "MODE", "N_UNITS", "CHUNK_ROWS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        kind, mode, n_units, chunk_rows = args.measure
+        print(json.dumps(measure(kind, mode, int(n_units), int(chunk_rows))))
+    else:
+        for size in args.sizes:
+            run(size, args.chunk_rows)
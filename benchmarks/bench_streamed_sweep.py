@@ -0,0 +1,144 @@
+"""
+Check and time streamed buildings (streaming: true websites) going through AsyncScrapeRunner, against a local website
+that sends its table pages slowly, and Postgres (a throwaway schema, like run_benchmarks.py).
+
+Two buildings of the same host are swept with the lydianlyric config switched to streaming, and the check fails unless:
+1. both buildings upsert every unit of their page, the same units as parsing the whole page,
+2. the pages were downloaded one at a time (the runner's per host limit, which the aiohttp download goes through),
+3. no building's upsert started before its page had finished downloading, so a DB writer never waits on a website.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/bench_streamed_sweep.py [--units 5000] [--send-delay 0.01]
+"""
+import argparse
+import asyncio
+import http.server
+import os
+import sys
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+from apt_webscraper import parse_and_clean_html  # noqa: E402
+from async_scraper import AsyncScrapeRunner  # noqa: E402
+from parser_engine import get_site_config  # noqa: E402
+from run_benchmarks import BENCH_APT_ID, LYDIAN_DIV_ID, postgres_upsert_target  # noqa: E402
+from synthetic_pages import lydian_page  # noqa: E402
+
+PAGE_PATHS = {BENCH_APT_ID: "/lydianlyric/floor-plans-1/", BENCH_APT_ID + 1: "/lydianlyric/floor-plans-2/"}
+SEND_SIZE = 64 * 1024
+
+
+class SlowPageServer:
+    """
+    Serve pages from memory on a local port, sending SEND_SIZE bytes every send_delay seconds. max_active is the most
+    pages that were being sent at once.
+    """
+
+    def __init__(self, pages: dict, send_delay: float):
+        self.active = 0
+        self.max_active = 0
+        self.finished_at = {}
+        lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = pages[self.path]
+                pieces = [body[start:start + SEND_SIZE] for start in range(0, len(body), SEND_SIZE)]
+                with lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                for i, piece in enumerate(pieces):
+                    time.sleep(send_delay)
+                    if i == len(pieces) - 1:
+                        # Once the last piece is sent the client may start its next request, so stop counting this one.
+                        with lock:
+                            server.active -= 1
+                    self.wfile.write(piece)
+                    self.wfile.flush()
+                server.finished_at[self.path] = time.monotonic()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}{path}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def run(dsn: str, n_units: int, send_delay: float):
+    html = lydian_page(n_units)
+    server = SlowPageServer({path: html.encode() for path in PAGE_PATHS.values()}, send_delay)
+    site_config = get_site_config(server.url(PAGE_PATHS[BENCH_APT_ID]))
+    site_config.streaming = True
+    try:
+        with postgres_upsert_target(dsn) as config_manager:
+            with config_manager.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO apts (id, building_name, url, div_id) VALUES (%s, 'Benchmark 2', %s, %s)",
+                    (BENCH_APT_ID + 1, server.url(PAGE_PATHS[BENCH_APT_ID + 1]), LYDIAN_DIV_ID),
+                )
+                conn.commit()
+            upsert_started_at = {}
+            stream_upsert_floor_plans = config_manager.stream_upsert_floor_plans
+
+            def timed_stream_upsert(apt_id, chunks, unit_cache=None):
+                upsert_started_at[apt_id] = time.monotonic()
+                return stream_upsert_floor_plans(apt_id, chunks, unit_cache=unit_cache)
+
+            config_manager.stream_upsert_floor_plans = timed_stream_upsert
+            buildings = [
+                {"id": apt_id, "building_name": f"Benchmark {apt_id}", "url": server.url(path), "div_id": LYDIAN_DIV_ID}
+                for apt_id, path in PAGE_PATHS.items()
+            ]
+            runner = AsyncScrapeRunner(config_manager, per_host_limit=1, parse_workers=0, metrics_textfile_path=None)
+            start = time.perf_counter()
+            results = asyncio.run(runner.run(buildings))
+            seconds = time.perf_counter() - start
+
+            expected = len(parse_and_clean_html(html, buildings[0]["url"], LYDIAN_DIV_ID))
+            with config_manager.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT apt_id, COUNT(*) FROM floor_plans WHERE availability_status GROUP BY apt_id")
+                stored = dict(cur.fetchall())
+    finally:
+        site_config.streaming = False
+        server.close()
+
+    for result in results:
+        assert result.error is None, f"{result.building_name} failed: {result.error}"
+        assert result.rows == result.inserted == stored.get(result.apt_id) == expected, (
+            f"{result.building_name}: {result.rows} rows, {result.inserted} inserted, "
+            f"{stored.get(result.apt_id)} stored, {expected} expected"
+        )
+    assert server.max_active == 1, f"{server.max_active} pages of one host were downloaded at once"
+    for apt_id, path in PAGE_PATHS.items():
+        assert upsert_started_at[apt_id] >= server.finished_at[path], f"apt {apt_id} started upserting mid-download"
+    print(
+        f"{expected:>6} units x {len(buildings)} buildings ({len(html) / 2 ** 20:4.1f} MB pages): "
+        f"swept in {seconds:6.2f}s, one download at a time, every upsert after its download."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check streamed buildings through the concurrent sweep.")
+    parser.add_argument("--units", type=int, default=5000)
+    parser.add_argument("--send-delay", type=float, default=0.01, help="seconds between 64 KiB writes of a page")
+    args = parser.parse_args()
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if not dsn:
+        sys.exit("Set BENCH_DATABASE_URL to a Postgres database to check streamed sweeps against.")
+    run(dsn, args.units, args.send_delay)
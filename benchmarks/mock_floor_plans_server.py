@@ -0,0 +1,140 @@
+"""
+Local stand-in for a 450k style website that renders its floor plans in the browser from its own JSON API.
+
+    /450k/floor-plans/apartments   page whose script GETs the API and renders 6 fp_blocks, plus the rest on "load more"
+    /450k/floor-plans/rendered     the same page as a browser has it after clicking load more (the recorded fixture markup)
+    /api/floor-plans               the units as JSON, nested like a real backend's; 503 while `failing` is set
+    /api/site-settings             unrelated JSON the page also loads, so capture has to pick the right response
+
+The units are the fixture's (scaled with synthetic_pages.fp_blocks_page), so the JSON and the rendered page agree.
+
+Usage: python benchmarks/mock_floor_plans_server.py [--units 40] [--port 8450]   (e.g. to try capture with a real Chrome)
+"""
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+from urllib.parse import urlparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+from apt_webscraper import PARSER_SUBTREES, parse_fp_blocks_to_df  # noqa: E402
+from html_parsing import make_soup  # noqa: E402
+from synthetic_pages import fp_blocks_page  # noqa: E402
+
+
+PAGE_PATH = "/450k/floor-plans/apartments"
+RENDERED_PAGE_PATH = "/450k/floor-plans/rendered"
+API_PATH = "/api/floor-plans"
+
+JS_PAGE = """<!DOCTYPE html>
+<html><head><title>Floor Plans</title></head>
+<body><main id="main"><div class="floorplan_wrap">
+<div class="available_apartmnt"></div>
+<div class="fp_lists"></div>
+<button id="btn_loadmore" style="display: none">Load more</button>
+</div></main>
+<script>
+function fpBlock(u) {
+  var beds = u.layout.beds === 0 ? "STUDIO" : u.layout.beds + " BED";
+  return '<div class="fp_block"><div class="fp_info"><p class="fp_no">UNIT ' + u.unit.label + '</p>'
+    + '<p class="fp_bed">' + beds + ' + ' + u.layout.baths + ' BATH</p><p class="fp_type">' + u.layout.plan + '</p>'
+    + '<p class="fp_sqft">' + u.layout.sqft + ' SQ.FT.</p><p class="fp_price">' + u.pricing.rent + '</p>'
+    + '<p class="fp_date">AVAILABLE ' + u.availableOn + '</p></div></div>';
+}
+fetch("/api/site-settings");
+fetch("/api/floor-plans?beds=2").then(function (r) { return r.json(); }).then(function (body) {
+  var units = body.data.floorPlans, list = document.querySelector(".fp_lists");
+  document.querySelector(".available_apartmnt").textContent = units.length + " Available Apartments";
+  list.innerHTML = units.slice(0, 6).map(fpBlock).join("");
+  var button = document.getElementById("btn_loadmore");
+  if (units.length > 6) { button.style.display = "block"; }
+  button.onclick = function () { list.innerHTML += units.slice(6).map(fpBlock).join(""); button.style.display = "none"; };
+});
+</script></body></html>
+"""
+
+
+def units_as_json(n_units: int = None) -> dict:
+    """The units of the (scaled) fixture page, in the shape of a typical listings API response."""
+    html = fp_blocks_page(n_units)
+    df = parse_fp_blocks_to_df(make_soup(html, parse_only=PARSER_SUBTREES["fp_blocks"]))
+    floor_plans = [
+        {
+            "id": i + 1,
+            "unit": {"label": f"#{row.unit_number}", "floor": None},
+            "layout": {"beds": int(row.bedrooms), "baths": float(row.bathrooms), "plan": row.floor_plan_type, "sqft": int(row.sq_ft)},
+            "pricing": {"rent": f"${row.price:,}", "deposit": 500},
+            "availableOn": row.date_available,
+        }
+        for i, row in enumerate(df.itertuples())
+    ]
+    return {"status": "ok", "data": {"total": len(floor_plans), "floorPlans": floor_plans}}
+
+
+class MockFloorPlansServer:
+    """Serve the mock website on a local port from a daemon thread. Set `failing` to make the API return 503s."""
+
+    def __init__(self, n_units: int = None, port: int = 0):
+        self.failing = False
+        self.api_requests = 0
+        pages = {
+            PAGE_PATH: ("text/html; charset=utf-8", JS_PAGE.encode()),
+            RENDERED_PAGE_PATH: ("text/html; charset=utf-8", fp_blocks_page(n_units).encode()),
+            API_PATH: ("application/json", json.dumps(units_as_json(n_units)).encode()),
+            "/api/site-settings": ("application/json", json.dumps({"theme": "dark", "features": [{"name": "chat"}]}).encode()),
+        }
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == API_PATH:
+                    server.api_requests += 1
+                    if server.failing:
+                        self.send_error(503)
+                        return
+                if path not in pages:
+                    self.send_error(404)
+                    return
+                content_type, body = pages[path]
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}{path}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--units", type=int, default=None, help="number of units (default: the fixture's)")
+    parser.add_argument("--port", type=int, default=8450)
+    args = parser.parse_args()
+    with MockFloorPlansServer(args.units, args.port) as mock:
+        print(f"Serving {mock.url(PAGE_PATH + '?two-bed=1')} (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,365 @@
+"""
+Benchmark each stage of a sweep offline, on recorded and synthetic fixture pages, and save the results as JSON.
+
+Stages:
+    given_url_get_latest_scraped_data  fetch + parse + clean a lydianlyric table page served from a local http server
+    parse_html_to_df                   parse a 450k floor plan page (fp_lists subtree soup + fp_blocks parser + cast)
+    clean_df_by_url                    run the lydianlyric cleaning rules on a raw table df
+    batch_upsert_floor_plans           first load, unchanged re-run and a re-run with 10% changed prices / 5% removed units
+
+Upserts run against a throwaway schema in Postgres when BENCH_DATABASE_URL is set (the real bulk upsert), and against
+an in-memory SQLite stand-in with the same upsert / mark unavailable semantics otherwise.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 1000 5000] [--repeat 5] [--output results.json] [--compare old.json]
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(REPO_ROOT, "benchmarks")
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+BENCH_SCHEMA_PATH = os.path.join(BENCHMARKS_DIR, "bench_schema.sql")
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault("UTILS_FOLDER_PATH", os.path.join(REPO_ROOT, "utils"))
+
+import pandas as pd  # noqa: E402
+
+from apt_webscraper import PARSER_SUBTREES, clean_df_by_url, given_url_get_latest_scraped_data, parse_html_to_df  # noqa: E402
+from benchmarks.synthetic_pages import fp_blocks_page, lydian_page  # noqa: E402
+from html_parsing import extract_table_df, make_soup  # noqa: E402
+
+LYDIAN_URL_PATH = "/lydianlyric.com/lydian-floor-plans-2/"
+LYDIAN_DIV_ID = "floor-plans"
+FP_BLOCKS_URL = "https://www.450k.com/floor-plans/apartments"
+BENCH_APT_ID = 1
+DEFAULT_SIZES = [1000, 5000]
+# Slowdown reported as a regression by --compare, as a fraction of the previous time (0.10 = 10% slower).
+REGRESSION_THRESHOLD = 0.10
+
+
+class FixtureServer:
+    """Serve fixture pages from memory on a local port, so the fetch stage runs without the network."""
+
+    def __init__(self, pages: dict):
+        pages = {path: html.encode() for path, html in pages.items()}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}{path}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class SQLiteFloorPlansStandIn:
+    """
+    In-memory stand-in for the floor_plans table when no Postgres is available. Same semantics as
+    DBConfigManager.batch_upsert_floor_plans: insert new units, update changed ones and mark missing ones unavailable.
+    """
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            """
+            CREATE TABLE floor_plans (
+                id INTEGER PRIMARY KEY,
+                apt_id INTEGER NOT NULL,
+                unit_number TEXT NOT NULL,
+                bedrooms REAL,
+                bathrooms REAL,
+                sq_ft INTEGER,
+                floor_plan_type TEXT,
+                price INTEGER,
+                date_available TEXT,
+                availability_status INTEGER NOT NULL DEFAULT 1,
+                UNIQUE (apt_id, unit_number)
+            )
+            """
+        )
+
+    def batch_upsert_floor_plans(self, df: pd.DataFrame) -> pd.DataFrame:
+        columns = df.columns.to_list()
+        updatable_columns = [col for col in columns if col not in ["apt_id", "unit_number"]]
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE floor_plans_staging AS SELECT " + ", ".join(columns) + " FROM floor_plans WHERE 0")
+        cur.execute("CREATE INDEX floor_plans_staging_unit ON floor_plans_staging (apt_id, unit_number)")
+        cur.executemany(
+            f"INSERT INTO floor_plans_staging VALUES ({', '.join('?' * len(columns))})",
+            df.astype(object).where(df.notna(), None).itertuples(index=False, name=None),
+        )
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM floor_plans_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM floor_plans f WHERE f.apt_id = s.apt_id AND f.unit_number = s.unit_number)
+            """
+        )
+        inserted = cur.fetchone()[0]
+        before = self.conn.total_changes
+        cur.execute(
+            f"""
+            INSERT INTO floor_plans ({', '.join(columns)})
+            SELECT {', '.join(columns)} FROM floor_plans_staging WHERE true
+            ON CONFLICT (apt_id, unit_number) DO UPDATE SET
+                {', '.join(f'{col} = excluded.{col}' for col in updatable_columns)}, availability_status = 1
+            WHERE {' OR '.join(f'excluded.{col} IS NOT floor_plans.{col}' for col in updatable_columns)}
+                OR floor_plans.availability_status IS NOT 1
+            """
+        )
+        updated = self.conn.total_changes - before - inserted
+        cur.execute(
+            """
+            UPDATE floor_plans SET availability_status = 0
+            WHERE apt_id IN (SELECT apt_id FROM floor_plans_staging)
+            AND availability_status IS NOT 0
+            AND NOT EXISTS (
+                SELECT 1 FROM floor_plans_staging s
+                WHERE s.apt_id = floor_plans.apt_id AND s.unit_number = floor_plans.unit_number
+            )
+            """
+        )
+        removed = cur.rowcount
+        cur.execute("DROP TABLE floor_plans_staging")
+        self.conn.commit()
+        return pd.DataFrame(
+            [{"apt_id": int(df["apt_id"].iloc[0]), "inserted": inserted, "updated": updated, "removed": removed}]
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+@contextlib.contextmanager
+def postgres_upsert_target(dsn: str):
+    """A DBConfigManager on a throwaway schema (base tables + migrations) that is dropped afterwards."""
+    import psycopg2
+
+    from db_migrations import apply_migrations
+    from store_in_db import DBConfigManager
+
+    schema = f"bench_{uuid.uuid4().hex[:12]}"
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur, open(BENCH_SCHEMA_PATH) as f:
+            cur.execute(f"CREATE SCHEMA {schema}")
+            cur.execute(f"SET search_path TO {schema}")
+            cur.execute(f.read())
+            cur.execute(
+                "INSERT INTO apts (id, building_name, url, div_id) VALUES (%s, 'Benchmark', 'https://lydianlyric.com/', %s)",
+                (BENCH_APT_ID, LYDIAN_DIV_ID),
+            )
+        conn.commit()
+        with contextlib.redirect_stdout(io.StringIO()):
+            apply_migrations(conn)
+        yield DBConfigManager(db_connection=conn)
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+def measure(func, repeat: int) -> dict:
+    """Best wall time of repeat runs, then one extra run under tracemalloc for the peak Python memory."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"result": result, "seconds": min(timings), "peak_memory_mb": peak / 2**20}
+
+
+def record(results: list, stage: str, size: str, rows: int, measured: dict, **extra):
+    seconds = measured["seconds"]
+    results.append(
+        {
+            "stage": stage,
+            "size": size,
+            "rows": rows,
+            "seconds": round(seconds, 6),
+            "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+            "peak_memory_mb": round(measured["peak_memory_mb"], 3),
+            **extra,
+        }
+    )
+    print(f"{stage:<38} {size:>9} {rows:>7} {seconds * 1000:>10.2f} {results[-1]['rows_per_sec'] or 0:>12.0f} {measured['peak_memory_mb']:>9.2f}")
+
+
+def upsert_rounds(df: pd.DataFrame):
+    """The dfs of three scrapes of a building: the first load, an unchanged re-scrape and one with some changes."""
+    changed = df.copy()
+    n = len(changed)
+    changed.loc[changed.index[: max(n // 10, 1)], "price"] += 25
+    changed = changed.iloc[: n - max(n // 20, 1)]
+    return [("first_load", df), ("unchanged", df), ("changed", changed)]
+
+
+def bench_upserts(results: list, size: str, df: pd.DataFrame, upsert_target_factory, backend: str, repeat: int):
+    """
+    Every run of a round gets a fresh target with the rounds before it already applied,
+    so each timed run (and the tracemalloc run) starts from the same table state.
+    """
+    df = df.assign(apt_id=BENCH_APT_ID)
+    rounds = upsert_rounds(df)
+    for i, (round_name, round_df) in enumerate(rounds):
+        timings, peak = [], 0
+        for traced in [False] * repeat + [True]:
+            with upsert_target_factory() as target, contextlib.redirect_stdout(io.StringIO()):
+                for _, previous_df in rounds[:i]:
+                    target.batch_upsert_floor_plans(previous_df)
+                if traced:
+                    tracemalloc.start()
+                    target.batch_upsert_floor_plans(round_df)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                else:
+                    start = time.perf_counter()
+                    target.batch_upsert_floor_plans(round_df)
+                    timings.append(time.perf_counter() - start)
+        measured = {"seconds": min(timings), "peak_memory_mb": peak / 2**20}
+        record(results, f"batch_upsert_floor_plans[{round_name}]", size, len(round_df), measured, backend=backend)
+
+
+@contextlib.contextmanager
+def sqlite_upsert_target():
+    target = SQLiteFloorPlansStandIn()
+    try:
+        yield target
+    finally:
+        target.close()
+
+
+def run_benchmarks(sizes: list, repeat: int) -> list:
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if dsn:
+        backend = "postgres"
+        upsert_target_factory = lambda: postgres_upsert_target(dsn)  # noqa: E731
+    else:
+        backend = "sqlite"
+        upsert_target_factory = sqlite_upsert_target
+
+    size_labels = ["recorded"] + [str(n) for n in sizes]
+    lydian_pages = {label: lydian_page(None if label == "recorded" else int(label)) for label in size_labels}
+    fp_blocks_pages = {label: fp_blocks_page(None if label == "recorded" else int(label)) for label in size_labels}
+
+    results = []
+    print(f"{'stage':<38} {'size':>9} {'rows':>7} {'best ms':>10} {'rows/sec':>12} {'peak MB':>9}")
+    with FixtureServer({f"{LYDIAN_URL_PATH}?units={label}": html for label, html in lydian_pages.items()}) as server:
+        for label in size_labels:
+            url = server.url(f"{LYDIAN_URL_PATH}?units={label}")
+            measured = measure(lambda: given_url_get_latest_scraped_data(url, div_id=LYDIAN_DIV_ID), repeat)
+            cleaned_df = measured["result"]
+            record(results, "given_url_get_latest_scraped_data", label, len(cleaned_df), measured)
+
+            raw_df = extract_table_df(lydian_pages[label], LYDIAN_DIV_ID)
+            measured = measure(lambda: clean_df_by_url(raw_df.copy(), url), repeat)
+            record(results, "clean_df_by_url", label, len(raw_df), measured)
+
+            html = fp_blocks_pages[label]
+            measured = measure(
+                lambda: parse_html_to_df(FP_BLOCKS_URL, make_soup(html, parse_only=PARSER_SUBTREES["fp_blocks"])), repeat
+            )
+            record(results, "parse_html_to_df", label, len(measured["result"]), measured)
+
+            bench_upserts(results, label, cleaned_df, upsert_target_factory, backend, repeat)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(previous_path: str, current: dict):
+    """Print the change in best time of every stage/size found in both runs, flagging regressions."""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    # Upsert results are only compared with runs on the same backend.
+    previous_results = {(r["stage"], r["size"], r.get("backend")): r for r in previous["results"]}
+    print(f"\nCompared with {previous.get('commit')} ({previous.get('created_at')}):")
+    print(f"{'stage':<38} {'size':>9} {'old ms':>10} {'new ms':>10} {'change':>8}")
+    for r in current["results"]:
+        old = previous_results.get((r["stage"], r["size"], r.get("backend")))
+        if old is None or not old["seconds"]:
+            continue
+        change = r["seconds"] / old["seconds"] - 1
+        flag = "  REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        print(f"{r['stage']:<38} {r['size']:>9} {old['seconds'] * 1000:>10.2f} {r['seconds'] * 1000:>10.2f} {change:>+8.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="synthetic page sizes, in units")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="results JSON path (default benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    created_at = datetime.now(timezone.utc)
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created_at": created_at.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandas": pd.__version__,
+        "results": run_benchmarks(args.sizes, args.repeat),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{created_at:%Y%m%dT%H%M%S}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved results to {output}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
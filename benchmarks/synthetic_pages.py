@@ -0,0 +1,57 @@
+"""
+Scale the recorded fixture pages up to any number of units, keeping the recorded markup.
+
+Rows (or fp_blocks) of the recorded page are repeated with new unique unit numbers, so the synthetic pages
+go through exactly the same parsing and cleaning code as the real ones.
+"""
+import copy
+import os
+
+import lxml.html
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+LYDIAN_FIXTURE = "lydian_floor_plans.html"
+FP_BLOCKS_FIXTURE = "450k_floor_plans.html"
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return f.read()
+
+
+def _scale_children(html: str, container_xpath: str, child_xpath: str, unit_xpath: str, unit_format: str, n_units: int) -> str:
+    tree = lxml.html.fromstring(html)
+    container = tree.xpath(container_xpath)[0]
+    templates = container.xpath(child_xpath)
+    for child in templates:
+        container.remove(child)
+    for i in range(n_units):
+        child = copy.deepcopy(templates[i % len(templates)])
+        unit = child.xpath(unit_xpath)[0]
+        unit.text = unit_format.format(i + 1)
+        container.append(child)
+    return lxml.html.tostring(tree, encoding="unicode", doctype="<!DOCTYPE html>")
+
+
+def lydian_page(n_units: int = None) -> str:
+    """The recorded Lydian table page, or a copy scaled to n_units table rows."""
+    html = read_fixture(LYDIAN_FIXTURE)
+    if n_units is None:
+        return html
+    return _scale_children(html, "//div[@id='floor-plans']//tbody", "./tr", "./td[1]", "{:05d}", n_units)
+
+
+def fp_blocks_page(n_units: int = None) -> str:
+    """The recorded 450k floor plan page, or a copy scaled to n_units fp_blocks."""
+    html = read_fixture(FP_BLOCKS_FIXTURE)
+    if n_units is None:
+        return html
+    return _scale_children(
+        html,
+        "//div[contains(@class, 'fp_lists')]",
+        "./div[contains(@class, 'fp_block')]",
+        ".//p[contains(@class, 'fp_no')]",
+        "UNIT #{:05d}",
+        n_units,
+    )
@@ -0,0 +1,208 @@
+"""
+Pool of warm headless Chrome drivers for websites that need interaction (e.g. clicking a load more button).
+
+Drivers are handed out to scrape jobs with BrowserPool.driver() and recycled after a configurable number
+of pages or after a crash. Also has condition based waits to use instead of fixed time.sleep() calls.
+"""
+import atexit
+import functools
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from webdriver_manager.chrome import ChromeDriverManager
+
+
+BROWSER_POOL_SIZE = 2
+MAX_PAGES_PER_DRIVER = 50
+WAIT_TIMEOUT_SECONDS = 15
+# A website that never finishes loading fails instead of holding a driver forever.
+PAGE_LOAD_TIMEOUT_SECONDS = 30
+WAIT_POLL_SECONDS = 0.25
+# Number of consecutive polls a row count must stay the same before it's considered loaded.
+STABLE_COUNT_POLLS = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_chromedriver_path() -> str:
+    """Install (or find the cached) chromedriver once per process instead of once per url."""
+    return ChromeDriverManager().install()
+
+
+def create_driver(capture_network: bool = False) -> webdriver.Chrome:
+    """With capture_network, every network event of the page is kept in the driver's "performance" log."""
+    driver_options = webdriver.chrome.options.Options()
+    driver_options.add_argument("--headless=new")
+    capabilities = None
+    if capture_network:
+        capabilities = webdriver.DesiredCapabilities.CHROME.copy()
+        capabilities["goog:loggingPrefs"] = {"performance": "ALL"}
+    driver = webdriver.Chrome(get_chromedriver_path(), options=driver_options, desired_capabilities=capabilities)
+    driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT_SECONDS)
+    return driver
+
+
+def quit_driver(driver: webdriver.Chrome):
+    try:
+        driver.quit()
+    except Exception as e:
+        print(f"Error quitting driver. Error: {e}")
+
+
+def is_driver_alive(driver: webdriver.Chrome) -> bool:
+    """Cheap round trip to the driver to check the browser hasn't crashed."""
+    try:
+        driver.window_handles
+        return True
+    except WebDriverException:
+        return False
+
+
+class _PooledDriver:
+    __slots__ = ("driver", "pages")
+
+    def __init__(self, driver: webdriver.Chrome):
+        self.driver = driver
+        self.pages = 0
+
+
+class BrowserPool:
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_pages_per_driver: int = MAX_PAGES_PER_DRIVER, warm: bool = True):
+        self.size = size
+        self.max_pages_per_driver = max_pages_per_driver
+        self._closed = False
+        self._lock = threading.Lock()
+        self._all = set()
+        # None marks an empty slot, which gets a new driver the next time it's handed out.
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._new_pooled_driver() if warm else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_pooled_driver(self) -> _PooledDriver:
+        pooled = _PooledDriver(create_driver())
+        with self._lock:
+            self._all.add(pooled)
+        return pooled
+
+    def _retire(self, pooled: _PooledDriver):
+        with self._lock:
+            self._all.discard(pooled)
+        quit_driver(pooled.driver)
+
+    @contextmanager
+    def driver(self, timeout: Optional[float] = None):
+        """Check out a driver for the duration of a scrape job. Blocks until one is free."""
+        if self._closed:
+            raise RuntimeError("BrowserPool is closed")
+        pooled = self._idle.get(timeout=timeout)
+        try:
+            if pooled is None:
+                pooled = self._new_pooled_driver()
+        except Exception:
+            self._idle.put(None)
+            raise
+
+        crashed = False
+        try:
+            yield pooled.driver
+        except Exception:
+            crashed = not is_driver_alive(pooled.driver)
+            raise
+        finally:
+            pooled.pages += 1
+            if self._closed or crashed or pooled.pages >= self.max_pages_per_driver:
+                self._retire(pooled)
+                self._idle.put(None)
+            else:
+                self._idle.put(pooled)
+
+    def close(self):
+        """Quit every driver, including ones that are still checked out."""
+        self._closed = True
+        with self._lock:
+            pooled_drivers = list(self._all)
+            self._all.clear()
+        for pooled in pooled_drivers:
+            quit_driver(pooled.driver)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_browser_pool() -> BrowserPool:
+    """Lazily create a process wide pool, so importing this module doesn't start any browsers."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = BrowserPool(warm=False)
+            atexit.register(_default_pool.close)
+        return _default_pool
+
+
+def close_default_browser_pool():
+    """
+    Quit the process wide pool's browsers, if it was ever created. Worker processes must call this themselves,
+    since they exit without running atexit handlers.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+            _default_pool = None
+
+
+def wait_for_element(driver: webdriver.Chrome, locator: tuple, timeout: float = WAIT_TIMEOUT_SECONDS) -> WebElement:
+    """Wait until an element is present, e.g. locator=(By.ID, "btn_loadmore"), and return it."""
+    return WebDriverWait(driver, timeout, poll_frequency=WAIT_POLL_SECONDS).until(
+        EC.presence_of_element_located(locator)
+    )
+
+
+def wait_for_clickable(driver: webdriver.Chrome, locator: tuple, timeout: float = WAIT_TIMEOUT_SECONDS) -> WebElement:
+    return WebDriverWait(driver, timeout, poll_frequency=WAIT_POLL_SECONDS).until(
+        EC.element_to_be_clickable(locator)
+    )
+
+
+def wait_for_stable_count(
+    driver: webdriver.Chrome,
+    css_selector: str,
+    expected_count: Optional[int] = None,
+    min_count: int = 0,
+    timeout: float = WAIT_TIMEOUT_SECONDS,
+    stable_polls: int = STABLE_COUNT_POLLS,
+) -> int:
+    """
+    Wait until the number of elements matching css_selector reaches expected_count,
+    or stops changing for stable_polls polls in a row. Returns the final count.
+    A count only counts as stable once it is above min_count, e.g. the count from before clicking load more,
+    so the wait doesn't return before the click's request has added anything.
+    """
+    state = {"count": -1, "unchanged_polls": 0}
+
+    def count_is_stable(d) -> bool:
+        count = len(d.find_elements_by_css_selector(css_selector))
+        if expected_count is not None and count >= expected_count:
+            state["count"] = count
+            return True
+        if count == state["count"]:
+            state["unchanged_polls"] += 1
+        else:
+            state["count"], state["unchanged_polls"] = count, 0
+        return count > min_count and state["unchanged_polls"] >= stable_polls
+
+    WebDriverWait(driver, timeout, poll_frequency=WAIT_POLL_SECONDS).until(count_is_stable)
+    return state["count"]
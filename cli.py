@@ -0,0 +1,217 @@
+"""
+Command line entry point for the apartment monitor.
+
+Usage:
+    python cli.py sweep [--workers N] [--sequential]         scrape every building in apts and upsert its floor plans
+                        [--record | --replay [--as-of TIME]] [--archive-dir DIR]
+    python cli.py scrape-one <building name> [--upsert]      scrape one building and print its units
+    python cli.py add-config <building name> <url> [--div-id ID]
+    python cli.py query-history <building name> [--unit UNIT] [--days 30] [--limit 100]
+    python cli.py reparse [--building NAME ...] [--since TIME] [--until TIME] [--snapshots] [--archive-dir DIR]
+
+sweep --record saves every fetched page and browser page source to the page archive, and sweep --replay runs the
+sweep from the archive with no network or browser (see page_archive.py). A replayed sweep only reads the apts table
+and prints what every building parsed to: it writes nothing to the database, the caches or the snapshot store, and
+--workers and --sequential don't apply. reparse runs the current parsers over archived pages, without the database.
+
+Every subcommand imports only what it uses: add-config and query-history only need psycopg2, so they start in tens
+of milliseconds instead of loading pandas, the parsers and selenium.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+from typing import List, Optional
+
+
+def sweep(args, config_manager):
+    from alerts import AlertEvaluator, print_alerts
+    from db_migrations import apply_migrations
+    from metrics import configure_stage_log
+    from page_archive import PAGE_ARCHIVE_DIR, configure_page_archive
+    from store_in_db import (
+        replay_all_buildings_in_db,
+        scrape_all_buildings_in_db,
+        scrape_all_buildings_in_db_concurrently,
+    )
+
+    # Through the environment, so sweep worker processes record or replay too.
+    configure_page_archive(
+        args.archive_mode, args.archive_dir or PAGE_ARCHIVE_DIR, args.as_of.isoformat() if args.as_of else None
+    )
+    if args.archive_mode == "replay":
+        replay_all_buildings_in_db(config_manager)
+        return
+    configure_stage_log()
+    with config_manager.connection() as conn:
+        apply_migrations(conn)
+    if args.sequential:
+        scrape_all_buildings_in_db(config_manager)
+    else:
+        scrape_all_buildings_in_db_concurrently(config_manager, workers=args.workers)
+    config_manager.refresh_listing_stats()
+    with config_manager.connection() as conn:
+        print_alerts(AlertEvaluator(conn).evaluate())
+
+
+def scrape_one(args, config_manager):
+    import pandas as pd
+
+    from apt_webscraper import given_url_get_latest_scraped_data
+
+    scraping_info = config_manager.get_apt_scraping_info_given_building(args.building_name)
+    if scraping_info.empty:
+        sys.exit(f"No building named {args.building_name!r} in the apts table.")
+    for row in scraping_info.itertuples():
+        df = given_url_get_latest_scraped_data(url=row.url, div_id=row.div_id, json_endpoint=row.json_endpoint)
+        df["apt_id"] = row.id
+        with pd.option_context("display.max_rows", None, "display.width", None):
+            print(df)
+        if args.upsert:
+            config_manager.batch_upsert_floor_plans(df, apt_id=row.id)
+
+
+def add_config(args, config_manager):
+    apt_id = config_manager.add_building(args.building_name, args.url, args.div_id)
+    print(f"Added {args.building_name} ({args.url}) to the apts table with id {apt_id}.")
+
+
+def query_history(args, config_manager):
+    events = config_manager.get_floor_plan_history(args.building_name, args.unit, days=args.days, limit=args.limit)
+    if not events:
+        print(f"No floor plan events for {args.building_name} in the last {args.days} days.")
+        return
+    for e in events:
+        price = f"${e['price']:,}" if e["price"] is not None else "-"
+        if e["event_type"] == "price_change" and e["previous_price"] is not None:
+            price = f"${e['previous_price']:,} -> {price}"
+        print(
+            f"{e['created_at']:%Y-%m-%d %H:%M}  unit {e['unit_number']:<8} {e['event_type']:<13} "
+            f"{e['bedrooms']} bed / {e['bathrooms']} bath, {e['sq_ft']} sq ft, {price}"
+        )
+
+
+def reparse(args):
+    from collections import Counter
+
+    from page_archive import PAGE_ARCHIVE_DIR, PageArchive, backfill_snapshots, reparse_pages
+
+    archive = PageArchive(args.archive_dir or PAGE_ARCHIVE_DIR)
+    filters = {"building_names": args.building, "start": args.since, "end": args.until}
+    workers = os.cpu_count() if args.workers is None else args.workers
+    if args.snapshots:
+        from snapshot_store import SnapshotStore
+
+        written, failed = backfill_snapshots(archive, SnapshotStore(), workers=workers, **filters)
+        print(f"Wrote {written} snapshots from archived pages, {failed} pages failed.")
+        return
+    pages = Counter()
+    rows = Counter()
+    failures = []
+    for page, df in reparse_pages(archive, workers=workers, **filters):
+        building_name = page.meta.get("building_name") or page.url
+        if isinstance(df, Exception):
+            failures.append((page, df))
+            continue
+        pages[building_name] += 1
+        rows[building_name] += len(df)
+    for building_name in sorted(pages):
+        print(f"{building_name}: {pages[building_name]} pages, {rows[building_name]} units")
+    for page, e in failures:
+        print(f"Failed: {page.url} ({page.kind}, recorded {page.recorded_at:%Y-%m-%d %H:%M}): {type(e).__name__}: {e}")
+    print(f"Re-parsed {sum(pages.values())} archived pages, {len(failures)} failed.")
+
+
+def parse_time(value: str) -> datetime:
+    """An ISO date or time, in UTC unless it has an offset."""
+    t = datetime.fromisoformat(value)
+    return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+
+# The default comes from page_archive.PAGE_ARCHIVE_DIR, which is only imported by the subcommands that use it.
+ARCHIVE_DIR_HELP = "page archive directory (default: $PAGE_ARCHIVE_DIR, or page_archive)"
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="Apartment monitor.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sweep_parser = subparsers.add_parser("sweep", help="scrape every building in the apts table and upsert its floor plans")
+    sweep_parser.add_argument(
+        "--workers", type=int, default=1, help="number of processes to split the buildings across (default 1)"
+    )
+    sweep_parser.add_argument("--sequential", action="store_true", help="scrape one building at a time")
+    archive_mode = sweep_parser.add_mutually_exclusive_group()
+    archive_mode.add_argument(
+        "--record", dest="archive_mode", action="store_const", const="record", help="save every fetched page to the page archive"
+    )
+    archive_mode.add_argument(
+        "--replay",
+        dest="archive_mode",
+        action="store_const",
+        const="replay",
+        help="parse the page archive offline, without writing anything",
+    )
+    sweep_parser.add_argument("--as-of", type=parse_time, help="with --replay, use the pages recorded at or before this ISO time")
+    sweep_parser.add_argument("--archive-dir", help=ARCHIVE_DIR_HELP)
+    sweep_parser.set_defaults(func=sweep)
+
+    scrape_parser = subparsers.add_parser("scrape-one", help="scrape one building and print its units")
+    scrape_parser.add_argument("building_name")
+    scrape_parser.add_argument("--upsert", action="store_true", help="also upsert the units into floor_plans")
+    scrape_parser.set_defaults(func=scrape_one)
+
+    config_parser = subparsers.add_parser("add-config", help="add a building's website to the apts table")
+    config_parser.add_argument("building_name")
+    config_parser.add_argument("url")
+    config_parser.add_argument("--div-id", help="id of the div holding the floor plans table (table websites only)")
+    config_parser.set_defaults(func=add_config)
+
+    history_parser = subparsers.add_parser("query-history", help="print a building's recent floor plan events")
+    history_parser.add_argument("building_name")
+    history_parser.add_argument("--unit", help="only this unit number")
+    history_parser.add_argument("--days", type=int, default=30)
+    history_parser.add_argument("--limit", type=int, default=100)
+    history_parser.set_defaults(func=query_history)
+
+    reparse_parser = subparsers.add_parser("reparse", help="run the current parsers over archived pages")
+    reparse_parser.add_argument("--building", action="append", help="only this building (repeatable)")
+    reparse_parser.add_argument("--since", type=parse_time, help="only pages recorded at or after this ISO time")
+    reparse_parser.add_argument("--until", type=parse_time, help="only pages recorded at or before this ISO time")
+    reparse_parser.add_argument(
+        "--snapshots", action="store_true", help="write the dfs to the snapshot store, as of when each page was recorded"
+    )
+    reparse_parser.add_argument("--workers", type=int, help="parse processes (default: one per CPU)")
+    reparse_parser.add_argument("--archive-dir", help=ARCHIVE_DIR_HELP)
+    reparse_parser.set_defaults(func=reparse, needs_db=False)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    if not getattr(args, "needs_db", True):
+        args.func(args)
+        return
+
+    import psycopg2
+
+    from store_in_db import DBConfigManager, create_connection_pool, db_params
+
+    try:
+        # Only the sweep writes from several threads at once.
+        if args.command == "sweep":
+            config_manager = DBConfigManager(pool=create_connection_pool())
+        else:
+            config_manager = DBConfigManager(db_connection=psycopg2.connect(**db_params))
+    except psycopg2.Error as e:
+        sys.exit(f"Error connecting to the database: {e}")
+    try:
+        args.func(args, config_manager)
+    except psycopg2.Error as e:
+        sys.exit(f"Database error: {e}")
+    finally:
+        config_manager.close_connection()
+
+
+if __name__ == "__main__":
+    main()
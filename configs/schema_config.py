@@ -1,17 +1,25 @@
 import numpy as np
 
-# TODO: incorporate this into scraping script
+# Canonical columns and dtypes of a scraped building's df, named after the floor_plans table's columns.
+# Parsers that build typed unit records (see unit_records.py) fill exactly these columns.
 # TODO: think of better name for this
 APT_DF_SCHEMA = {
-    'unit_id': str,
-    'price': int,
-    'square_feet': int,
+    'unit_number': str,
     'bedrooms': np.float16,
     'bathrooms': np.float16,
+    'sq_ft': int,
     'floor_plan_type': str,
+    'price': int,
     'date_available': str
 }
 
+# Error page signatures checked on every fetched page (case insensitive). Signatures that only apply to one
+# website go in its error_signatures in website_config.yaml.
 WEBSITE_ERROR_MESSAGES = [
-    '<div class="error" id="floor-plans">Unable to load apartments at this time. Please try again.</div>'
+    'Unable to load apartments at this time',
+    '<title>Access Denied</title>',
+    '<title>Attention Required! | Cloudflare</title>',
+    '<title>Just a moment...</title>',
+    '<title>503 Service Temporarily Unavailable</title>',
+    '<title>429 Too Many Requests</title>',
 ]
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+Apply the numbered SQL files in migrations/ that haven't been applied to the database yet.
+
+Usage: python db_migrations.py
+"""
+import os
+
+import psycopg2
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+
+def apply_migrations(conn, migrations_dir: str = MIGRATIONS_DIR) -> list:
+    """Run every migration file not yet recorded in schema_migrations, in filename order. Returns the applied filenames."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                filename TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cur.execute("SELECT filename FROM schema_migrations")
+        already_applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    applied = []
+    for filename in sorted(f for f in os.listdir(migrations_dir) if f.endswith(".sql")):
+        if filename in already_applied:
+            continue
+        with open(os.path.join(migrations_dir, filename)) as f:
+            migration_sql = f.read()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(migration_sql)
+                cur.execute("INSERT INTO schema_migrations (filename) VALUES (%s)", (filename,))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        applied.append(filename)
+        print(f"Applied migration {filename}")
+    return applied
+
+
+if __name__ == "__main__":
+    from store_in_db import db_params
+
+    conn = psycopg2.connect(**db_params)
+    try:
+        apply_migrations(conn)
+    finally:
+        conn.close()
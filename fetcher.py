@@ -0,0 +1,453 @@
+"""
+Resilient page fetching shared by the sequential and concurrent sweeps.
+
+Every request has separate connect and read timeouts, so a hanging website fails within seconds instead of stalling
+a sweep. Connection errors, timeouts and 408/429/5xx responses are retried with exponential backoff (full jitter).
+Failures count against the website's domain: after CIRCUIT_FAILURE_THRESHOLD consecutive failures its circuit opens,
+and requests to it fail immediately with CircuitOpenError until CIRCUIT_COOLDOWN_SECONDS have passed, when one trial
+request is let through. Fetched pages are also checked for error page signatures (WEBSITE_ERROR_MESSAGES plus a
+website's error_signatures in configs/website_config.yaml) with one precompiled regex, so a website answering
+200 with a "try again later" page fails fast too.
+
+When a page archive is recording, every fetched page is saved to it, and when it is replaying, pages come from the
+archive instead of the network (see page_archive.py).
+"""
+import asyncio
+import codecs
+import contextlib
+import functools
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+
+from configs.schema_config import WEBSITE_ERROR_MESSAGES
+from html_parsing import STREAM_READ_SIZE
+from http_cache import FetchedPage, ResponseCache
+from metrics import StageRecord
+from page_archive import get_page_archive
+from parser_engine import get_site_config
+
+
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 20
+MAX_RETRIES = 2
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+RETRY_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_COOLDOWN_SECONDS = 10 * 60
+# How many chunks of a streamed page (STREAM_READ_SIZE each) aiohttp may download ahead of the parser.
+STREAM_QUEUE_CHUNKS = 16
+
+
+class CircuitOpenError(Exception):
+    """A domain failed too many times in a row, so it is skipped without making a request."""
+
+
+class ErrorPageError(Exception):
+    """A website returned an error page instead of its listings."""
+
+
+def domain_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retry number attempt + 1: random, up to BACKOFF_BASE_SECONDS * 2 ** attempt (capped)."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Per domain consecutive failure counts. Thread safe, so browser threads and the event loop can share one."""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+
+    def check(self, url: str):
+        """Raise CircuitOpenError if the url's domain is cooling down."""
+        domain = domain_of(url)
+        with self._lock:
+            open_until = self._open_until.get(domain)
+            if open_until is None:
+                return
+            now = time.monotonic()
+            if now < open_until:
+                raise CircuitOpenError(
+                    f"Skipping {domain} for another {open_until - now:.0f}s after {self._failures[domain]} consecutive failures"
+                )
+            # Cool down is over: let this request through as a trial, and keep the circuit open for everyone else until it finishes.
+            self._open_until[domain] = now + self.cooldown_seconds
+
+    def is_open(self, url: str) -> bool:
+        with self._lock:
+            return time.monotonic() < self._open_until.get(domain_of(url), 0)
+
+    def record_success(self, url: str):
+        domain = domain_of(url)
+        with self._lock:
+            self._failures.pop(domain, None)
+            self._open_until.pop(domain, None)
+
+    def record_failure(self, url: str):
+        domain = domain_of(url)
+        with self._lock:
+            failures = self._failures.get(domain, 0) + 1
+            self._failures[domain] = failures
+            if failures >= self.failure_threshold:
+                already_open = domain in self._open_until
+                self._open_until[domain] = time.monotonic() + self.cooldown_seconds
+                if not already_open:
+                    print(f"Circuit opened for {domain} after {failures} consecutive failures, skipping it for {self.cooldown_seconds}s.")
+
+
+class ErrorPageClassifier:
+    """Case insensitive search for any of a set of error page signatures, compiled into a single regex."""
+
+    def __init__(self, signatures: Iterable[str]):
+        # Longest first, so the most specific signature is the one reported.
+        signatures = sorted({s for s in signatures if s}, key=len, reverse=True)
+        self._pattern = re.compile("|".join(map(re.escape, signatures)), re.IGNORECASE) if signatures else None
+
+    def match(self, text: str) -> Optional[str]:
+        """Return the signature found in text, if any."""
+        match = self._pattern.search(text) if self._pattern else None
+        return match.group() if match else None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_classifier(site_signatures: Tuple[str, ...]) -> ErrorPageClassifier:
+    return ErrorPageClassifier(list(WEBSITE_ERROR_MESSAGES) + list(site_signatures))
+
+
+def find_error_signature(url: str, text: str) -> Optional[str]:
+    """Return the error page signature found in a page of url, if any."""
+    try:
+        site_signatures = tuple(get_site_config(url).error_signatures)
+    except ValueError:
+        site_signatures = ()
+    return _get_classifier(site_signatures).match(text)
+
+
+def raise_for_error_page(url: str, text: str):
+    signature = find_error_signature(url, text)
+    if signature:
+        raise ErrorPageError(f"{url} returned an error page ({signature!r})")
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code in RETRY_STATUS_CODES
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in RETRY_STATUS_CODES
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class Fetcher:
+    def __init__(
+        self,
+        breaker: Optional[CircuitBreaker] = None,
+        max_retries: int = MAX_RETRIES,
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = READ_TIMEOUT_SECONDS,
+    ):
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # requests.Session isn't thread-safe, and one fetcher is shared by every thread, so each thread gets its own.
+        self._local = threading.local()
+
+    @property
+    def _session(self) -> requests.Session:
+        """This thread's session, which keeps its connections to each website open between requests."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def fetch(self, url: str, cache: Optional[ResponseCache] = None, record: Optional[StageRecord] = None) -> Optional[FetchedPage]:
+        """
+        Get a page with timeouts, retries and the circuit breaker. With a cache, the request is conditional and None is
+        returned if the page hasn't changed since it was last stored. Retries and bytes are added to record, if given.
+        """
+        archive = get_page_archive()
+        if archive is not None and archive.replaying:
+            return archive.replay_page(url)
+        self.breaker.check(url)
+        for attempt in range(self.max_retries + 1):
+            try:
+                headers = cache.conditional_headers(url) if cache else {}
+                response = self._session.get(url, headers=headers, timeout=(self.connect_timeout, self.read_timeout))
+                if cache and response.status_code == 304 and cache.is_unchanged(url, response.status_code):
+                    self.breaker.record_success(url)
+                    return None
+                response.raise_for_status()
+                if cache and cache.is_unchanged(url, response.status_code, response.content):
+                    self.breaker.record_success(url)
+                    return None
+                encoding = response.encoding or response.apparent_encoding or "utf-8"
+                page = FetchedPage(
+                    url=url,
+                    body=response.content,
+                    text=response.text,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
+                raise_for_error_page(url, page.text)
+            except Exception as e:
+                # No more retries once the domain's circuit has opened (e.g. from failures of concurrent requests).
+                if attempt < self.max_retries and _is_retryable(e) and not self.breaker.is_open(url):
+                    if record:
+                        record.retries += 1
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                self.breaker.record_failure(url)
+                raise
+            self.breaker.record_success(url)
+            if record:
+                record.bytes = len(page.body)
+            if archive is not None and archive.recording:
+                archive.record(url, "http", page.body, encoding)
+            return page
+
+    async def fetch_async(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        cache: Optional[ResponseCache] = None,
+        record: Optional[StageRecord] = None,
+    ) -> Optional[FetchedPage]:
+        """Same as fetch, with aiohttp. Timeouts and connection limits come from the session."""
+        archive = get_page_archive()
+        if archive is not None and archive.replaying:
+            return archive.replay_page(url)
+        self.breaker.check(url)
+        for attempt in range(self.max_retries + 1):
+            try:
+                headers = cache.conditional_headers(url) if cache else {}
+                async with session.get(url, headers=headers) as response:
+                    if cache and response.status == 304 and cache.is_unchanged(url, response.status):
+                        self.breaker.record_success(url)
+                        return None
+                    response.raise_for_status()
+                    body = await response.read()
+                    if cache and cache.is_unchanged(url, response.status, body):
+                        self.breaker.record_success(url)
+                        return None
+                    encoding = response.get_encoding()
+                    page = FetchedPage(
+                        url=url,
+                        body=body,
+                        text=body.decode(encoding, errors="replace"),
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+                raise_for_error_page(url, page.text)
+            except Exception as e:
+                if attempt < self.max_retries and _is_retryable(e) and not self.breaker.is_open(url):
+                    if record:
+                        record.retries += 1
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+                self.breaker.record_failure(url)
+                raise
+            self.breaker.record_success(url)
+            if record:
+                record.bytes = len(page.body)
+            if archive is not None and archive.recording:
+                archive.record(url, "http", page.body, encoding)
+            return page
+
+    def stream_text(self, url: str, chunk_size: int = STREAM_READ_SIZE, record: Optional[StageRecord] = None) -> Iterator[str]:
+        """
+        Get a page like fetch, but yield its text in pieces as it downloads, for the streaming parsers in html_parsing.py.
+        Only getting the response is retried, and the first piece is checked for error page signatures (error pages
+        are short, so that's usually all of them). There's no conditional request: streaming is for pages too big to hold.
+        """
+        archive = get_page_archive()
+        if archive is not None and archive.replaying:
+            page = archive.replay(url, "http")
+            decoder = codecs.getincrementaldecoder(page.encoding)(errors="replace")
+            for chunk in archive.read_chunks(page, chunk_size):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b"", final=True)
+            return
+        self.breaker.check(url)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._session.get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout))
+                response.raise_for_status()
+                break
+            except Exception as e:
+                if attempt < self.max_retries and _is_retryable(e) and not self.breaker.is_open(url):
+                    if record:
+                        record.retries += 1
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                self.breaker.record_failure(url)
+                raise
+        with response:
+            # Without a charset in the headers requests assumes ISO-8859-1, but the page can't be sniffed before it
+            # is read, so assume UTF-8 like almost every website uses.
+            has_charset = "charset" in response.headers.get("Content-Type", "").lower()
+            encoding = response.encoding if has_charset and response.encoding else "utf-8"
+            yield from self._decode_stream(url, response.iter_content(chunk_size), encoding, record)
+
+    def _decode_stream(
+        self, url: str, chunks: Iterator[bytes], encoding: str, record: Optional[StageRecord] = None
+    ) -> Iterator[str]:
+        """Decode a streamed body as it is read, archiving it when recording and counting it against the url's circuit."""
+        archive = get_page_archive()
+        if archive is not None and archive.recording:
+            chunks = archive.record_chunks(url, "http", chunks, encoding)
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        first = True
+        try:
+            for chunk in chunks:
+                if record:
+                    record.bytes = (record.bytes or 0) + len(chunk)
+                text = decoder.decode(chunk)
+                if first:
+                    raise_for_error_page(url, text)
+                    first = False
+                yield text
+            yield decoder.decode(b"", final=True)
+        except GeneratorExit:
+            # The reader stopped early, e.g. once it had every unit.
+            chunks.close()
+            self.breaker.record_success(url)
+            raise
+        except Exception:
+            self.breaker.record_failure(url)
+            raise
+        self.breaker.record_success(url)
+
+    async def stream_async(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        chunk_size: int = STREAM_READ_SIZE,
+        record: Optional[StageRecord] = None,
+    ) -> "AsyncTextStream":
+        """
+        Same as stream_text, with aiohttp, so the download counts against the session's connection limits. Returns once
+        the response has started (getting it is retried); read the page with the stream's iter_text on another thread.
+        """
+        archive = get_page_archive()
+        if archive is not None and archive.replaying:
+            return AsyncTextStream(self, url, chunk_size=chunk_size, record=record)
+        self.breaker.check(url)
+        for attempt in range(self.max_retries + 1):
+            try:
+                # No total timeout: the download only goes as fast as the page is parsed.
+                response = await session.get(url, timeout=self.client_timeout())
+                response.raise_for_status()
+                break
+            except Exception as e:
+                if attempt < self.max_retries and _is_retryable(e) and not self.breaker.is_open(url):
+                    if record:
+                        record.retries += 1
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+                self.breaker.record_failure(url)
+                raise
+        # Like stream_text, assume UTF-8 when the headers have no charset.
+        encoding = response.charset or "utf-8"
+        return AsyncTextStream(self, url, response, encoding, chunk_size=chunk_size, record=record)
+
+    def client_timeout(self, total: Optional[float] = None) -> aiohttp.ClientTimeout:
+        """aiohttp timeouts matching this fetcher's, for the session passed to fetch_async."""
+        return aiohttp.ClientTimeout(total=total, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+
+
+class AsyncTextStream:
+    """
+    A page that aiohttp downloads on the event loop, for a streaming parser running on another thread. The download
+    only gets STREAM_QUEUE_CHUNKS chunks ahead of the parser, so the page is never held whole. Call aclose() on the
+    event loop once the parser is done, to stop a download that it didn't read to the end.
+    """
+
+    def __init__(
+        self,
+        fetcher: Fetcher,
+        url: str,
+        response: Optional[aiohttp.ClientResponse] = None,
+        encoding: str = "utf-8",
+        chunk_size: int = STREAM_READ_SIZE,
+        record: Optional[StageRecord] = None,
+    ):
+        """Without a response (when the page archive is replaying), iter_text reads the page with stream_text instead."""
+        self.fetcher = fetcher
+        self.url = url
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.record = record
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        self._download = self._loop.create_task(self._read(response)) if response is not None else None
+
+    async def _read(self, response: aiohttp.ClientResponse):
+        try:
+            async with response:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await self._queue.put(chunk)
+            await self._queue.put(None)
+        except Exception as e:
+            await self._queue.put(e)
+
+    def _iter_chunks(self) -> Iterator[bytes]:
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop).result()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def iter_text(self) -> Iterator[str]:
+        """Yield the page's text as it downloads. Blocks, so call it from a thread other than the event loop's."""
+        if self._download is None:
+            return self.fetcher.stream_text(self.url, self.chunk_size, self.record)
+        return self.fetcher._decode_stream(self.url, self._iter_chunks(), self.encoding, self.record)
+
+    async def aclose(self):
+        if self._download is not None and not self._download.done():
+            self._download.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._download
+
+
+_default_fetcher = None
+_json_endpoint_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher() -> Fetcher:
+    """Process wide fetcher, so circuit breaker state is shared by every sweep in the process."""
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = Fetcher()
+        return _default_fetcher
+
+
+def get_json_endpoint_fetcher() -> Fetcher:
+    """
+    Process wide fetcher for JSON endpoints (apts.json_endpoint), with its own circuit breaker: a failing endpoint falls
+    back to the browser, which must not find the website's circuit opened by the endpoint's failures.
+    """
+    global _json_endpoint_fetcher
+    with _default_fetcher_lock:
+        if _json_endpoint_fetcher is None:
+            _json_endpoint_fetcher = Fetcher()
+        return _json_endpoint_fetcher
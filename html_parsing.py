@@ -0,0 +1,220 @@
+"""
+Pluggable HTML parsing backends.
+
+The "lxml" backend (the default) parses a page once with lxml and only walks the target subtree:
+tables are read straight into a df from the <td> text, with no serialize/re-parse through pd.read_html,
+and BeautifulSoup objects are built with lxml and a SoupStrainer so only the needed div is kept.
+The "html.parser" backend builds the full tree with BeautifulSoup's pure-Python parser, like the original code did.
+
+For very large pages, iter_table_row_chunks and iter_element_stream read the html incrementally with lxml's pull
+parser instead: each table row or unit element is handed over as soon as its end tag is parsed and then dropped from
+the tree, so memory stays flat however many units the page has.
+"""
+import os
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import lxml.etree
+import lxml.html
+import pandas as pd
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+
+
+HTML_PARSER_BACKENDS = ("lxml", "html.parser")
+HTML_PARSER_BACKEND = os.getenv("HTML_PARSER_BACKEND", "lxml")
+# Rows per df handed to cleaning and upserting when streaming, and characters per piece of html fed to the parser.
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", 500))
+STREAM_READ_SIZE = 64 * 1024
+
+
+def get_backend(backend: Optional[str] = None) -> str:
+    backend = backend or HTML_PARSER_BACKEND
+    if backend not in HTML_PARSER_BACKENDS:
+        raise ValueError(f"Unknown HTML parser backend '{backend}'. Expected one of {HTML_PARSER_BACKENDS}")
+    return backend
+
+
+def make_soup(html: str, parse_only: Optional[SoupStrainer] = None, backend: Optional[str] = None) -> BeautifulSoup:
+    """Build a BeautifulSoup object with the configured backend, optionally keeping only the subtree matched by parse_only."""
+    backend = get_backend(backend)
+    if backend == "html.parser":
+        # parse_only is ignored so the legacy path builds the full tree, exactly like it used to.
+        return BeautifulSoup(html, "html.parser")
+    return BeautifulSoup(html, "lxml", parse_only=parse_only)
+
+
+def _clean_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _add_table_row(header: List[str], rows: List[List[str]], cells: List[str], is_header: bool) -> None:
+    """
+    Add the cells of a <tr> to header or rows. The header is the first header row (in <thead>, or without <td> cells);
+    other rows without <td> cells (e.g. a second header row) are skipped.
+    """
+    if not cells:
+        return
+    if not is_header:
+        rows.append(cells)
+    elif not header:
+        header.extend(cells)
+
+
+def table_rows_from_tag(table: Tag) -> Tuple[List[str], List[List[str]]]:
+    """
+    Given a bs4 <table> tag, return its header and the text of every body row. A body row's <th> cells (e.g. the
+    unit number as a row header) are read along with its <td> cells, in document order.
+    """
+    header, rows = [], []
+    for tr in table.find_all("tr"):
+        cells = tr.find_all(["th", "td"], recursive=False)
+        is_header = tr.parent.name == "thead" or all(cell.name == "th" for cell in cells)
+        _add_table_row(header, rows, [_clean_text(cell.get_text()) for cell in cells], is_header)
+    return header, rows
+
+
+def _element_row_cells(tr: lxml.html.HtmlElement) -> Tuple[List[str], bool]:
+    """Return the text of an lxml <tr>'s <th> and <td> cells in document order, and whether it is a header row."""
+    cells = [cell for cell in tr if cell.tag in ("th", "td")]
+    is_header = tr.getparent().tag == "thead" or all(cell.tag == "th" for cell in cells)
+    return [_clean_text(cell.text_content()) for cell in cells], is_header
+
+
+def table_rows_from_element(table: lxml.html.HtmlElement) -> Tuple[List[str], List[List[str]]]:
+    """Given an lxml <table> element, return its header and the text of every body row, like table_rows_from_tag."""
+    header, rows = [], []
+    for tr in table.iter("tr"):
+        _add_table_row(header, rows, *_element_row_cells(tr))
+    return header, rows
+
+
+def rows_to_df(header: List[str], rows: List[List[str]]) -> pd.DataFrame:
+    """Build a df of strings from table rows. Types are set afterwards from the website's schema."""
+    if not header and rows:
+        header, rows = rows[0], rows[1:]
+    return pd.DataFrame(rows, columns=header, dtype=object)
+
+
+def find_table_in_div(html: str, div_id: str) -> Optional[lxml.html.HtmlElement]:
+    """Parse html with lxml and return the first <table> inside the div with div_id. Raises ValueError if the div is missing."""
+    tree = lxml.html.fromstring(html)
+    divs = tree.xpath("//div[@id=$div_id]", div_id=div_id)
+    if not divs:
+        raise ValueError(f"Div with id {div_id} not found")
+    return divs[0].find(".//table")
+
+
+def extract_table_df(html: str, div_id: str, backend: Optional[str] = None) -> pd.DataFrame:
+    """Given the html of a webpage and a div id, extract the table nested inside the div as a pandas df."""
+    backend = get_backend(backend)
+    if backend == "html.parser":
+        soup = BeautifulSoup(html, "html.parser")
+        div_apts = soup.find("div", id=div_id)
+        if div_apts is None:
+            raise ValueError(f"Div with id {div_id} not found")
+        table = div_apts.find("table")
+        if table is None:
+            raise ValueError(f"No table found inside div with id {div_id}")
+        return rows_to_df(*table_rows_from_tag(table))
+
+    table = find_table_in_div(html, div_id)
+    if table is None:
+        raise ValueError(f"No table found inside div with id {div_id}")
+    return rows_to_df(*table_rows_from_element(table))
+
+
+def iter_text_chunks(text: str, size: int = STREAM_READ_SIZE) -> Iterator[str]:
+    """Split a page that is already in memory (e.g. a browser's page source) into pieces for the streaming parsers."""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def _has_class(element: lxml.html.HtmlElement, class_name: str) -> bool:
+    return class_name in (element.get("class") or "").split()
+
+
+def iter_element_stream(
+    html_chunks: Iterable[Union[str, bytes]],
+    is_container: Callable[[lxml.html.HtmlElement], bool],
+    is_item: Callable[[lxml.html.HtmlElement], bool],
+    container_name: str = "container",
+) -> Iterator[lxml.html.HtmlElement]:
+    """
+    Parse html incrementally and yield every complete item element inside the first container element.
+    Once the caller moves on, the item and everything parsed before it is removed from the tree, so only the current
+    item is ever held. Raises ValueError if the page has no container.
+    """
+    parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+    # Build lxml.html elements (with text_content etc.), like lxml.html.fromstring does.
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    container = None
+    container_done = False
+    html_chunks = iter(html_chunks)
+    for html in html_chunks:
+        parser.feed(html)
+        for event, element in parser.read_events():
+            if container_done:
+                continue
+            if container is None:
+                if event == "start" and is_container(element):
+                    container = element
+                continue
+            if event == "end" and element is container:
+                container_done = True
+            elif event == "end" and is_item(element):
+                yield element
+                element.clear()
+                # Drop the items (and anything else) already read, keeping the path from the root to the next item.
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        if container_done:
+            # Nothing more to parse, but read the rest of the page, so that e.g. a recording of it is complete.
+            for _ in html_chunks:
+                pass
+            break
+    if container is None:
+        raise ValueError(f"{container_name} not found")
+
+
+def iter_fp_block_elements(html_chunks: Iterable[Union[str, bytes]]) -> Iterator[lxml.html.HtmlElement]:
+    """Stream the div.fp_block elements of a floor plan list website (see apt_webscraper.parse_fp_blocks_to_df)."""
+    return iter_element_stream(
+        html_chunks,
+        is_container=lambda e: e.tag == "div" and _has_class(e, "fp_lists"),
+        is_item=lambda e: e.tag == "div" and _has_class(e, "fp_block"),
+        container_name="Div with class fp_lists",
+    )
+
+
+def iter_table_row_chunks(
+    html_chunks: Iterable[Union[str, bytes]], div_id: str, chunk_rows: int = STREAM_CHUNK_ROWS
+) -> Iterator[pd.DataFrame]:
+    """
+    Streaming version of extract_table_df: yield the rows of the table inside the div with div_id as dfs of strings
+    with at most chunk_rows rows each, while the rest of the page is still being read.
+    """
+    header, rows = [], []
+    found_table = False
+
+    def is_row(element) -> bool:
+        nonlocal found_table
+        if element.tag == "table":
+            found_table = True
+        return element.tag == "tr"
+
+    for tr in iter_element_stream(
+        html_chunks,
+        is_container=lambda e: e.tag == "div" and e.get("id") == div_id,
+        is_item=is_row,
+        container_name=f"Div with id {div_id}",
+    ):
+        _add_table_row(header, rows, *_element_row_cells(tr))
+        if len(rows) >= chunk_rows:
+            # Like rows_to_df, a table without <th> uses its first row as the header.
+            if not header:
+                header, rows = rows[0], rows[1:]
+            yield pd.DataFrame(rows, columns=header, dtype=object)
+            rows = []
+    if not found_table:
+        raise ValueError(f"No table found inside div with id {div_id}")
+    if rows:
+        yield rows_to_df(header, rows)
@@ -0,0 +1,186 @@
+"""
+On-disk cache of fetched pages so unchanged websites can be skipped before parsing and upserting.
+
+For each url it keeps the ETag/Last-Modified validators and a hash of the body (plus the gzipped body itself).
+Conditional request headers come from conditional_headers(), and a page counts as unchanged when the
+server answers 304 or the body hashes to the same value as last time. Bodies are evicted least recently
+used first once the cache is over max_bytes.
+
+Sweep worker processes open the cache with defer_writes: they only read it, and the urls they found unchanged are
+sent back with their scraped dfs and touched by the parent (see sharded_sweep.py), which is the only writer.
+"""
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", ".http_cache")
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+
+@dataclass
+class FetchedPage:
+    url: str
+    body: bytes
+    text: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def hash_content(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, cache_dir: str = HTTP_CACHE_DIR, max_bytes: int = HTTP_CACHE_MAX_BYTES, defer_writes: bool = False):
+        """With defer_writes, nothing is written: store() raises and touches are collected (see take_pending_touches)."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.defer_writes = defer_writes
+        self._pending_touches = []
+        os.makedirs(os.path.join(cache_dir, "bodies"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _body_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, "bodies", f"{content_hash}.html.gz")
+
+    def _get_entry(self, url: str) -> Optional[tuple]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT etag, last_modified, content_hash FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """Return If-None-Match/If-Modified-Since headers for a url, or an empty dict if it hasn't been cached."""
+        entry = self._get_entry(url)
+        if entry is None:
+            return {}
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def is_unchanged(self, url: str, status_code: int, body: Optional[bytes] = None) -> bool:
+        """Given a response for a url, check if it's a 304 or has the same content as the cached body."""
+        if status_code == 304:
+            self._touch(url)
+            return True
+        entry = self._get_entry(url)
+        if entry is None or body is None:
+            return False
+        unchanged = entry[2] == hash_content(body)
+        if unchanged:
+            self._touch(url)
+        return unchanged
+
+    def get_body(self, url: str) -> Optional[bytes]:
+        entry = self._get_entry(url)
+        if entry is None:
+            return None
+        try:
+            with gzip.open(self._body_path(entry[2]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, page: FetchedPage):
+        """
+        Save a page's validators and body. Call this only after the page was processed successfully,
+        so a failed parse/upsert isn't skipped as unchanged on the next run.
+        """
+        if self.defer_writes:
+            raise RuntimeError("Pages are stored by the process that upserts them, not by a cache with defer_writes")
+        content_hash = hash_content(page.body)
+        body_path = self._body_path(content_hash)
+        if not os.path.exists(body_path):
+            with gzip.open(body_path, "wb") as f:
+                f.write(page.body)
+        size = os.path.getsize(body_path)
+        with self._lock:
+            previous = self._db.execute("SELECT content_hash FROM responses WHERE url = ?", (page.url,)).fetchone()
+            self._db.execute(
+                """
+                INSERT INTO responses (url, etag, last_modified, content_hash, size, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    content_hash = excluded.content_hash,
+                    size = excluded.size,
+                    last_used = excluded.last_used
+                """,
+                (page.url, page.etag, page.last_modified, content_hash, size, time.time()),
+            )
+            self._db.commit()
+            if previous and previous[0] != content_hash:
+                self._remove_body_if_unused(previous[0])
+            self._evict()
+
+    def _touch(self, url: str):
+        if self.defer_writes:
+            with self._lock:
+                self._pending_touches.append(url)
+            return
+        self.touch([url])
+
+    def touch(self, urls: Iterable[str]):
+        """Mark urls as just used, so they are evicted last."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany("UPDATE responses SET last_used = ? WHERE url = ?", [(now, url) for url in urls])
+            self._db.commit()
+
+    def take_pending_touches(self) -> List[str]:
+        """Return the urls found unchanged since the last call, for the writing process to touch."""
+        with self._lock:
+            touches, self._pending_touches = self._pending_touches, []
+        return touches
+
+    def _remove_body_if_unused(self, content_hash: str):
+        in_use = self._db.execute("SELECT 1 FROM responses WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+        if in_use is None:
+            try:
+                os.remove(self._body_path(content_hash))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes. Caller must hold the lock."""
+        total_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for url, content_hash, size in self._db.execute(
+            "SELECT url, content_hash, size FROM responses ORDER BY last_used"
+        ).fetchall():
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self._remove_body_if_unused(content_hash)
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+        self._db.commit()
+
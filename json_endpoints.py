@@ -0,0 +1,269 @@
+"""
+Scrape websites that render their floor plans from their own JSON backend by calling that backend directly.
+
+Capture (once per building, needs a browser): load the page with Chrome's performance log on, run the website's
+interaction and collect every JSON response the page received. The list of records whose values match the units
+parsed from the rendered page identifies the endpoint, and a mapping from each df column to the record key holding
+it. Both are stored in apts.json_endpoint, and sweeps then GET the endpoint and map its records straight into typed
+columns (see apt_webscraper.scrape_json_endpoint), only rendering the page when that fails.
+
+Usage: python json_endpoints.py <building name>
+"""
+import base64
+import json
+import sys
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from configs.schema_config import APT_DF_SCHEMA
+from unit_records import UnitRecords
+from utils.string_utils import extract_digits_from_text, extract_float_from_text
+
+
+# Share of the rendered units (and of their values, per column) a JSON list must match to be taken as their source.
+MIN_MATCH_SHARE = 0.8
+# Columns the html parsers reduce to their digits (e.g. 'UNIT #0215' -> '0215'), so JSON values are reduced the same way.
+DIGITS_ONLY_COLUMNS = {"unit_number"}
+
+
+@dataclass
+class JsonEndpoint:
+    url: str
+    # Keys (and list indexes) from the top of the response down to the list of unit records.
+    records_path: List[Union[str, int]] = field(default_factory=list)
+    # df column -> dotted key of the value in a record, e.g. {"price": "pricing.rent"}.
+    fields: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "JsonEndpoint":
+        return cls(url=d["url"], records_path=list(d.get("records_path", [])), fields=dict(d["fields"]))
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class CapturedResponse:
+    url: str
+    method: str
+    status: int
+    body: str
+
+
+def get_path(obj: Any, path: List[Union[str, int]]) -> Any:
+    """Follow keys and list indexes down a parsed JSON document. Returns None if the path doesn't exist."""
+    for key in path:
+        if isinstance(obj, dict):
+            obj = obj.get(key)
+        elif isinstance(obj, list) and isinstance(key, int) and -len(obj) <= key < len(obj):
+            obj = obj[key]
+        else:
+            return None
+    return obj
+
+
+def flatten_record(record: Dict, prefix: str = "") -> Dict[str, Any]:
+    """Scalar values of a record keyed by dotted key, e.g. {"pricing": {"rent": 1}} -> {"pricing.rent": 1}."""
+    flat = {}
+    for key, value in record.items():
+        key = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f"{key}."))
+        elif not isinstance(value, list):
+            flat[key] = value
+    return flat
+
+
+def find_record_lists(data: Any, path: Tuple = ()) -> Iterator[Tuple[Tuple, List[Dict]]]:
+    """Yield (path, list) for every non-empty list of objects anywhere in a parsed JSON document."""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from find_record_lists(value, path + (key,))
+    elif isinstance(data, list):
+        if data and all(isinstance(item, dict) for item in data):
+            yield path, data
+        for i, item in enumerate(data):
+            yield from find_record_lists(item, path + (i,))
+
+
+def to_column_value(value: Any, column: str):
+    """Convert a JSON value to what the html parsers put in column, e.g. '$3,500' -> 3500.0 for price."""
+    if value is None or isinstance(value, (bool, dict, list)):
+        return None
+    if APT_DF_SCHEMA[column] is str:
+        text = str(value).strip()
+        return extract_digits_from_text(text) if column in DIGITS_ONLY_COLUMNS else text
+    if isinstance(value, (int, float)):
+        return value
+    return extract_float_from_text(str(value).replace(",", ""))
+
+
+def json_to_df(data: Any, endpoint: JsonEndpoint) -> pd.DataFrame:
+    """Map the records of an endpoint's parsed response to a df with the endpoint's columns, in typed columns."""
+    records = get_path(data, endpoint.records_path)
+    if not isinstance(records, list):
+        raise ValueError(f"No list of records at {endpoint.records_path} in the response of {endpoint.url}")
+    units = UnitRecords(capacity=len(records), schema={c: APT_DF_SCHEMA[c] for c in endpoint.fields})
+    paths = {column: key.split(".") for column, key in endpoint.fields.items()}
+    for record in records:
+        units.append(**{column: to_column_value(get_path(record, path), column) for column, path in paths.items()})
+    df = units.to_df()
+    # Every record failing means the response changed shape, not that the building has bad units.
+    if records and df.empty:
+        raise ValueError(f"None of the {len(records)} records of {endpoint.url} match the endpoint's fields")
+    return df
+
+
+def _values_match(value, expected) -> bool:
+    if value is None or pd.isna(expected):
+        return False
+    if isinstance(expected, str):
+        return value == expected
+    try:
+        return abs(float(value) - float(expected)) < 1e-3
+    except (TypeError, ValueError):
+        return False
+
+
+def match_fields(records: List[Dict], rendered_df: pd.DataFrame, min_share: float = MIN_MATCH_SHARE) -> Tuple[Dict[str, str], int]:
+    """
+    Find the key holding each column of rendered_df in a list of JSON records. Records are joined to the rendered
+    units on the key matching the most unit numbers. Returns the mapping (columns with no key matching at least
+    min_share of the units are left out) and the number of units matched.
+    """
+    flat_records = [flatten_record(r) for r in records]
+    keys = sorted(set().union(*flat_records))
+    rendered = rendered_df.drop_duplicates("unit_number").set_index("unit_number")
+
+    unit_key, matched = None, {}
+    for key in keys:
+        by_unit = {}
+        for record in flat_records:
+            unit = to_column_value(record.get(key), "unit_number")
+            if unit in rendered.index:
+                by_unit[unit] = record
+        if len(by_unit) > len(matched):
+            unit_key, matched = key, by_unit
+    if not matched or len(matched) < min_share * len(rendered):
+        return {}, len(matched)
+
+    fields = {"unit_number": unit_key}
+    for column in rendered.columns:
+        if column not in APT_DF_SCHEMA:
+            continue
+        expected = rendered[column]
+        # Ties (e.g. bedrooms and bathrooms of 2 bed / 2 bath units) go to a key that isn't used yet and is named like the column.
+        hint = column.replace("_", "")[:3]
+        best_key, best_score = None, None
+        for key in keys:
+            agreeing = sum(_values_match(to_column_value(record.get(key), column), expected[unit]) for unit, record in matched.items())
+            score = (agreeing, key not in fields.values(), hint in key.lower())
+            if best_score is None or score > best_score:
+                best_key, best_score = key, score
+        if best_score and best_score[0] >= min_share * len(matched):
+            fields[column] = best_key
+    return fields, len(matched)
+
+
+def infer_endpoint(responses: List[CapturedResponse], rendered_df: pd.DataFrame) -> Optional[JsonEndpoint]:
+    """
+    Pick the captured GET response (and list in it) that the rendered units came from. Every column of rendered_df
+    must be mapped, so the endpoint's df has the same columns as the browser's. Returns None if no response qualifies.
+    """
+    columns = [c for c in rendered_df.columns if c in APT_DF_SCHEMA]
+    best, best_score, closest = None, None, None
+    for response in responses:
+        if response.method != "GET" or response.status != 200:
+            continue
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            continue
+        for path, records in find_record_lists(data):
+            fields, matched = match_fields(records, rendered_df)
+            if not fields:
+                continue
+            if set(fields) != set(columns):
+                closest = closest or (response.url, sorted(set(columns) - set(fields)))
+                continue
+            score = (matched, -len(path))
+            if best_score is None or score > best_score:
+                best = JsonEndpoint(url=response.url, records_path=list(path), fields={c: fields[c] for c in columns})
+                best_score = score
+    if best is None and closest:
+        print(f"Closest JSON response {closest[0]} has no values matching columns {closest[1]}.")
+    return best
+
+
+def read_json_responses(driver) -> List[CapturedResponse]:
+    """Bodies of the XHR/fetch and JSON responses in a capturing driver's performance log (see browser_pool.create_driver)."""
+    from selenium.common.exceptions import WebDriverException
+
+    requests_by_id, responses = {}, []
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        params = message.get("params", {})
+        if message.get("method") == "Network.requestWillBeSent":
+            requests_by_id[params["requestId"]] = params["request"]
+        elif message.get("method") == "Network.responseReceived":
+            response = params["response"]
+            if params.get("type") not in ("XHR", "Fetch") and "json" not in response.get("mimeType", ""):
+                continue
+            try:
+                body = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params["requestId"]})
+            except WebDriverException:
+                # The body is gone from the browser's buffer (e.g. a redirect or an evicted response).
+                continue
+            text = base64.b64decode(body["body"]).decode(errors="replace") if body.get("base64Encoded") else body["body"]
+            request = requests_by_id.get(params["requestId"], {})
+            responses.append(
+                CapturedResponse(url=response["url"], method=request.get("method", "GET"), status=response["status"], body=text)
+            )
+    return responses
+
+
+def capture_json_endpoint(url: str) -> Optional[JsonEndpoint]:
+    """Render url in a network capturing browser, as a sweep would, and find the JSON endpoint its units came from."""
+    from apt_webscraper import INTERACTIONS, PARSER_SUBTREES, PARSERS
+    from browser_pool import create_driver, quit_driver
+    from html_parsing import make_soup
+    from parser_engine import get_site_config
+
+    site_config = get_site_config(url)
+    if site_config.parser not in PARSERS:
+        raise ValueError(f"URL '{url}' has no parser configured.")
+    driver = create_driver(capture_network=True)
+    try:
+        driver.get(url)
+        if site_config.interaction:
+            INTERACTIONS[site_config.interaction](driver, url)
+        soup = make_soup(driver.page_source, parse_only=PARSER_SUBTREES.get(site_config.parser))
+        responses = read_json_responses(driver)
+    finally:
+        quit_driver(driver)
+    rendered_df = site_config.clean_and_cast(PARSERS[site_config.parser](soup))
+    print(f"Captured {len(responses)} JSON responses and {len(rendered_df)} rendered units at {url}.")
+    return infer_endpoint(responses, rendered_df)
+
+
+if __name__ == "__main__":
+    import psycopg2
+
+    from store_in_db import DBConfigManager, db_params
+
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    config_manager = DBConfigManager(db_connection=psycopg2.connect(**db_params))
+    try:
+        scraping_info = config_manager.get_apt_scraping_info_given_building(sys.argv[1])
+        for apt_id, url in zip(scraping_info["id"], scraping_info["url"]):
+            endpoint = capture_json_endpoint(url)
+            if endpoint is None:
+                print(f"No JSON endpoint found for {url}, it will keep being scraped in a browser.")
+                continue
+            config_manager.set_json_endpoint(int(apt_id), endpoint.to_dict())
+            print(f"Stored JSON endpoint {endpoint.url} for {url}: {endpoint.fields}")
+    finally:
+        config_manager.close_connection()
@@ -0,0 +1,256 @@
+"""
+Per-building, per-stage instrumentation for the scrape pipeline.
+
+Stages (fetch, render, parse, clean, cast, upsert, and stream for the interleaved fetch and parse of a streamed
+page) are wrapped in `timed(stage)` wherever they run. Each record
+goes to the collector of the building currently being scraped (see collect_timings), which is a plain list so it
+can be returned from a process pool worker. The sweep merges every building's records into a PipelineMetrics,
+which logs one JSON line per stage and keeps running totals that are exported in the Prometheus text format,
+to a file (e.g. for node_exporter's textfile collector) and/or over HTTP.
+"""
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+
+METRICS_TEXTFILE_PATH = os.getenv("METRICS_TEXTFILE_PATH")
+METRICS_PORT = os.getenv("METRICS_PORT")
+# JSON lines file for the structured per-stage log, used by configure_stage_log.
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH")
+METRIC_PREFIX = "apt_scrape"
+
+logger = logging.getLogger("apt_monitor.metrics")
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    seconds: float = 0.0
+    rows: Optional[int] = None
+    bytes: Optional[int] = None
+    retries: int = 0
+    error: Optional[str] = None
+
+
+_current_timings: ContextVar[Optional[List[StageRecord]]] = ContextVar("stage_timings", default=None)
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Time a stage and add it to the current building's records, if something is collecting them.
+    Yields the StageRecord so the caller can fill in rows, bytes and retries. An exception is recorded by class name and re-raised.
+    """
+    record = StageRecord(stage)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.append(record)
+
+
+@contextmanager
+def collect_timings():
+    """Collect the records of every timed stage run inside the with block (in this thread or task)."""
+    timings = []
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def call_with_timings(func, *args):
+    """
+    Call func(*args) and return (result, records of its timed stages). Module level so it can be sent to a process pool.
+    If func raises, the records collected so far are attached to the exception as stage_timings.
+    """
+    with collect_timings() as timings:
+        try:
+            return func(*args), timings
+        except Exception as e:
+            e.stage_timings = timings
+            raise
+
+
+def configure_stage_log(path: Optional[str] = METRICS_LOG_PATH):
+    """Append the structured per-stage log (one JSON object per line) to path. Does nothing if path isn't set."""
+    if not path:
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class PipelineMetrics:
+    """Running totals per building and stage. Thread safe, so DB writer and browser threads can report into it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._errors = defaultdict(int)
+
+    def __getstate__(self):
+        # Picklable, so worker processes can send their metrics back to be merged.
+        with self._lock:
+            return {"totals": {key: dict(values) for key, values in self._totals.items()}, "errors": dict(self._errors)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for key, values in state["totals"].items():
+            self._totals[key].update(values)
+        self._errors.update(state["errors"])
+
+    def update(self, other: "PipelineMetrics"):
+        """Add another PipelineMetrics' totals (e.g. from a worker process) to these."""
+        state = other.__getstate__()
+        with self._lock:
+            for key, values in state["totals"].items():
+                totals = self._totals[key]
+                for name, value in values.items():
+                    totals[name] = max(totals[name], value) if name == "max_seconds" else totals[name] + value
+            for key, count in state["errors"].items():
+                self._errors[key] += count
+
+    def observe(self, building: str, record: StageRecord):
+        with self._lock:
+            totals = self._totals[(building, record.stage)]
+            totals["runs"] += 1
+            totals["seconds"] += record.seconds
+            totals["max_seconds"] = max(totals["max_seconds"], record.seconds)
+            totals["rows"] += record.rows or 0
+            totals["bytes"] += record.bytes or 0
+            totals["retries"] += record.retries
+            if record.error:
+                self._errors[(building, record.stage, record.error)] += 1
+        event = {"event": "scrape_stage", "building": building, **asdict(record)}
+        event["seconds"] = round(record.seconds, 6)
+        logger.info(json.dumps(event))
+
+    def merge(self, building: str, records: Iterable[StageRecord]):
+        for record in records:
+            self.observe(building, record)
+
+    @contextmanager
+    def stage(self, building: str, stage: str):
+        """Time a stage run by the caller itself (rather than in a worker) and record it for building."""
+        record = StageRecord(stage)
+        try:
+            with timed(stage) as record:
+                yield record
+        finally:
+            self.observe(building, record)
+
+    def summary(self) -> pd.DataFrame:
+        """Totals per building and stage, slowest first."""
+        with self._lock:
+            rows = [
+                {"building": building, "stage": stage, **totals}
+                for (building, stage), totals in self._totals.items()
+            ]
+            errors = defaultdict(int)
+            for (building, stage, _), count in self._errors.items():
+                errors[(building, stage)] += count
+        df = pd.DataFrame(rows, columns=["building", "stage", "runs", "seconds", "max_seconds", "rows", "bytes", "retries"])
+        df["errors"] = [errors[(b, s)] for b, s in zip(df["building"], df["stage"])]
+        return df.sort_values("seconds", ascending=False, ignore_index=True)
+
+    def to_prometheus(self) -> str:
+        """Render the totals in the Prometheus text exposition format."""
+        counters = [
+            ("runs", "stage_runs_total", "Number of times a stage ran."),
+            ("seconds", "stage_seconds_total", "Total seconds spent in a stage."),
+            ("rows", "stage_rows_total", "Rows produced by a stage."),
+            ("bytes", "stage_bytes_total", "Bytes downloaded by a stage."),
+            ("retries", "stage_retries_total", "Retries made by a stage."),
+        ]
+        with self._lock:
+            totals = {key: dict(values) for key, values in self._totals.items()}
+            errors = dict(self._errors)
+
+        lines = []
+        for key, name, help_text in counters:
+            lines += [f"# HELP {METRIC_PREFIX}_{name} {help_text}", f"# TYPE {METRIC_PREFIX}_{name} counter"]
+            for (building, stage), values in sorted(totals.items()):
+                labels = f'building="{_escape_label(building)}",stage="{_escape_label(stage)}"'
+                lines.append(f"{METRIC_PREFIX}_{name}{{{labels}}} {_format_value(values.get(key, 0))}")
+
+        name = f"{METRIC_PREFIX}_stage_max_seconds"
+        lines += [f"# HELP {name} Slowest single run of a stage.", f"# TYPE {name} gauge"]
+        for (building, stage), values in sorted(totals.items()):
+            labels = f'building="{_escape_label(building)}",stage="{_escape_label(stage)}"'
+            lines.append(f"{name}{{{labels}}} {_format_value(values.get('max_seconds', 0))}")
+
+        name = f"{METRIC_PREFIX}_stage_errors_total"
+        lines += [f"# HELP {name} Stage failures by exception class.", f"# TYPE {name} counter"]
+        for (building, stage, error), count in sorted(errors.items()):
+            labels = f'building="{_escape_label(building)}",stage="{_escape_label(stage)}",error="{_escape_label(error)}"'
+            lines.append(f"{name}{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str = METRICS_TEXTFILE_PATH):
+        """Write the metrics to path atomically, so a scraper of the file never reads a half written file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int = METRICS_PORT, host: str = "") -> http.server.ThreadingHTTPServer:
+        """Serve the metrics at http://<host>:<port>/metrics from a daemon thread. Returns the server (call shutdown() to stop)."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def print_stage_summary(metrics: PipelineMetrics, top: int = 10):
+    """Print where the sweep time went: the slowest building/stage pairs."""
+    summary = metrics.summary()
+    if summary.empty:
+        return
+    print("Slowest stages:")
+    for row in summary.head(top).itertuples():
+        errors = f", {row.errors} errors" if row.errors else ""
+        print(f"  {row.building} {row.stage}: {row.seconds:.2f}s over {row.runs:.0f} runs, {row.rows:.0f} rows{errors}")
@@ -0,0 +1,41 @@
+-- Append-only history of changes to floor_plans, written by DBConfigManager.bulk_upsert_floor_plans,
+-- plus user alert rules that are evaluated incrementally over new events.
+
+CREATE TABLE IF NOT EXISTS floor_plan_events (
+    id BIGSERIAL PRIMARY KEY,
+    apt_id INTEGER NOT NULL REFERENCES apts (id),
+    unit_number TEXT NOT NULL,
+    event_type TEXT NOT NULL CHECK (event_type IN ('new_unit', 'price_change', 'unit_removed')),
+    bedrooms NUMERIC,
+    bathrooms NUMERIC,
+    sq_ft INTEGER,
+    price INTEGER,
+    previous_price INTEGER,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS floor_plan_events_apt_id_id_idx ON floor_plan_events (apt_id, id);
+CREATE INDEX IF NOT EXISTS floor_plan_events_apt_id_unit_number_idx ON floor_plan_events (apt_id, unit_number);
+
+CREATE TABLE IF NOT EXISTS alert_rules (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    -- NULL matches every building.
+    apt_id INTEGER REFERENCES apts (id),
+    event_types TEXT[] NOT NULL DEFAULT ARRAY['new_unit', 'price_change'],
+    min_bedrooms NUMERIC,
+    max_bedrooms NUMERIC,
+    max_price INTEGER,
+    -- Highest floor_plan_events.id this rule has been evaluated against.
+    last_event_id BIGINT NOT NULL DEFAULT 0,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS alerts (
+    id BIGSERIAL PRIMARY KEY,
+    rule_id INTEGER NOT NULL REFERENCES alert_rules (id),
+    event_id BIGINT NOT NULL REFERENCES floor_plan_events (id),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (rule_id, event_id)
+);
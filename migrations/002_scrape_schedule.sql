@@ -0,0 +1,16 @@
+-- Per building scheduler state, so the scrape scheduler daemon resumes where it stopped after a restart.
+
+CREATE TABLE IF NOT EXISTS scrape_schedule (
+    apt_id INTEGER PRIMARY KEY REFERENCES apts (id),
+    next_due_at TIMESTAMPTZ NOT NULL,
+    interval_seconds INTEGER NOT NULL,
+    -- Exponentially weighted share of scrapes that found a change.
+    change_rate DOUBLE PRECISION NOT NULL DEFAULT 0.5,
+    consecutive_errors INTEGER NOT NULL DEFAULT 0,
+    last_scraped_at TIMESTAMPTZ,
+    last_changed_at TIMESTAMPTZ,
+    last_error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS scrape_schedule_next_due_at_idx ON scrape_schedule (next_due_at);
@@ -0,0 +1,4 @@
+-- JSON endpoint a building's website loads its floor plans from, found by `python json_endpoints.py <building name>`.
+-- {"url": ..., "records_path": [...], "fields": {column: dotted key}}. Sweeps GET it instead of rendering the page in a browser.
+
+ALTER TABLE apts ADD COLUMN IF NOT EXISTS json_endpoint JSONB;
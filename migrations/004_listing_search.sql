@@ -0,0 +1,70 @@
+-- Indexes for DBConfigManager.search_listings / iter_listings, and per building aggregates for dashboards.
+-- Searches almost always ask for available units, so the indexes are partial: units marked unavailable (which pile up
+-- as history grows) are never in them.
+
+CREATE INDEX IF NOT EXISTS floor_plans_available_bedrooms_price_idx
+    ON floor_plans (bedrooms, price) WHERE availability_status;
+CREATE INDEX IF NOT EXISTS floor_plans_available_apt_id_bedrooms_price_idx
+    ON floor_plans (apt_id, bedrooms, price) WHERE availability_status;
+CREATE INDEX IF NOT EXISTS floor_plans_available_price_idx
+    ON floor_plans (price) WHERE availability_status;
+CREATE INDEX IF NOT EXISTS floor_plans_available_sq_ft_idx
+    ON floor_plans (sq_ft) WHERE availability_status;
+CREATE INDEX IF NOT EXISTS floor_plan_events_created_at_idx
+    ON floor_plan_events (created_at);
+
+-- date_available is scraped text: 'MM/DD/YYYY', or 'Now' for units that are available now (-infinity here).
+-- Anything else is NULL, so a search by availability date skips it instead of failing.
+CREATE OR REPLACE FUNCTION floor_plan_available_on(date_available TEXT) RETURNS DATE
+LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+    IF date_available ~* '^\s*(available\s+)?now\s*$' THEN
+        RETURN '-infinity'::DATE;
+    END IF;
+    IF date_available ~ '^\s*\d{1,2}/\d{1,2}/\d{4}\s*$' THEN
+        RETURN make_date(
+            split_part(trim(date_available), '/', 3)::INT,
+            split_part(trim(date_available), '/', 1)::INT,
+            split_part(trim(date_available), '/', 2)::INT
+        );
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$;
+
+-- Available units per building and bedroom count. Refreshed after every sweep (DBConfigManager.refresh_listing_stats).
+CREATE MATERIALIZED VIEW IF NOT EXISTS building_listing_stats AS
+SELECT
+    fp.apt_id,
+    a.building_name,
+    fp.bedrooms::FLOAT8 AS bedrooms,
+    COUNT(*) AS available_units,
+    MIN(fp.price) AS min_price,
+    AVG(fp.price)::FLOAT8 AS avg_price,
+    MAX(fp.price) AS max_price,
+    (SUM(fp.price)::FLOAT8 / NULLIF(SUM(fp.sq_ft), 0)) AS price_per_sq_ft
+FROM floor_plans fp
+JOIN apts a ON a.id = fp.apt_id
+WHERE fp.availability_status
+GROUP BY fp.apt_id, a.building_name, fp.bedrooms;
+
+-- Unique indexes let the views be refreshed concurrently, without blocking dashboard reads.
+CREATE UNIQUE INDEX IF NOT EXISTS building_listing_stats_apt_id_bedrooms_idx
+    ON building_listing_stats (apt_id, bedrooms);
+
+-- Daily activity per building, from the change history.
+CREATE MATERIALIZED VIEW IF NOT EXISTS building_daily_events AS
+SELECT
+    apt_id,
+    (created_at AT TIME ZONE 'UTC')::DATE AS day,
+    COUNT(*) FILTER (WHERE event_type = 'new_unit') AS new_units,
+    COUNT(*) FILTER (WHERE event_type = 'unit_removed') AS removed_units,
+    COUNT(*) FILTER (WHERE event_type = 'price_change') AS price_changes,
+    (AVG(price - previous_price) FILTER (WHERE event_type = 'price_change'))::FLOAT8 AS avg_price_change
+FROM floor_plan_events
+GROUP BY apt_id, (created_at AT TIME ZONE 'UTC')::DATE;
+
+CREATE UNIQUE INDEX IF NOT EXISTS building_daily_events_apt_id_day_idx
+    ON building_daily_events (apt_id, day);
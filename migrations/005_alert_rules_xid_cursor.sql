@@ -0,0 +1,15 @@
+-- Evaluate alert rules by the transaction that wrote each event instead of by event id. Ids come from a sequence when
+-- a row is inserted, but rows become visible when their transaction commits, so a sweep writer that commits after
+-- another one can make an event with a lower id visible after a rule's MAX(id) watermark has passed it.
+-- Every transaction older than a snapshot's xmin has finished, so events with xid < xmin can no longer change and a
+-- rule's cursor can safely move up to the xmin (see AlertEvaluator.evaluate).
+
+-- Events written before this migration get xid 1, below every rule's cursor: alert_rules.last_event_id still
+-- excludes the ones a rule has already been evaluated against.
+ALTER TABLE floor_plan_events ADD COLUMN IF NOT EXISTS xid xid8 NOT NULL DEFAULT '1';
+ALTER TABLE floor_plan_events ALTER COLUMN xid SET DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS floor_plan_events_xid_idx ON floor_plan_events (xid);
+
+-- Events of transactions at or above last_xid haven't been evaluated against the rule yet. last_event_id is no longer
+-- advanced: it is the newest event when the rule was added, which it never fires on.
+ALTER TABLE alert_rules ADD COLUMN IF NOT EXISTS last_xid xid8 NOT NULL DEFAULT '1';
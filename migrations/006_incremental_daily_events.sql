@@ -0,0 +1,42 @@
+-- Searches by availability date (ListingFilter.available_by) filter on floor_plan_available_on(date_available), which
+-- is IMMUTABLE, so it can be indexed like the other search columns.
+CREATE INDEX IF NOT EXISTS floor_plans_available_on_idx
+    ON floor_plans (floor_plan_available_on(date_available)) WHERE availability_status;
+
+-- building_daily_events was a materialized view, so every refresh re-aggregated all of floor_plan_events. It is now a
+-- table that DBConfigManager.refresh_listing_stats updates incrementally: only the (building, day) rows that got
+-- events since the last refresh are recomputed. Like alert rules (see 005_alert_rules_xid_cursor.sql), new events are
+-- found by the transaction that wrote them, with a cursor that only moves up to the snapshot's xmin.
+DROP MATERIALIZED VIEW IF EXISTS building_daily_events;
+
+CREATE TABLE building_daily_events (
+    apt_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    new_units BIGINT NOT NULL,
+    removed_units BIGINT NOT NULL,
+    price_changes BIGINT NOT NULL,
+    avg_price_change FLOAT8,
+    PRIMARY KEY (apt_id, day)
+);
+
+-- A single row: events of transactions at or above daily_events_xid aren't in building_daily_events yet.
+CREATE TABLE listing_stats_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    daily_events_xid xid8 NOT NULL
+);
+INSERT INTO listing_stats_state (daily_events_xid) VALUES (pg_snapshot_xmin(pg_current_snapshot()));
+
+INSERT INTO building_daily_events
+SELECT
+    apt_id,
+    (created_at AT TIME ZONE 'UTC')::DATE AS day,
+    COUNT(*) FILTER (WHERE event_type = 'new_unit') AS new_units,
+    COUNT(*) FILTER (WHERE event_type = 'unit_removed') AS removed_units,
+    COUNT(*) FILTER (WHERE event_type = 'price_change') AS price_changes,
+    (AVG(price - previous_price) FILTER (WHERE event_type = 'price_change'))::FLOAT8 AS avg_price_change
+FROM floor_plan_events
+WHERE xid < (SELECT daily_events_xid FROM listing_stats_state)
+GROUP BY apt_id, (created_at AT TIME ZONE 'UTC')::DATE;
+
+-- Recomputing one building's day reads only that day's events.
+CREATE INDEX IF NOT EXISTS floor_plan_events_apt_id_created_at_idx ON floor_plan_events (apt_id, created_at);
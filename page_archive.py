@@ -0,0 +1,358 @@
+"""
+Archive of raw fetched pages, for deterministic offline sweeps and bulk re-parsing.
+
+Record mode (PAGE_ARCHIVE_MODE=record) keeps every page body the fetcher downloads (kind "http") and every page
+source read from a browser (kind "browser"). Bodies are gzipped and stored once per content hash, under
+objects/<first 2 hex chars>/<sha256>.gz, and an SQLite index has one row per recording with its url, kind, time
+and the building it belongs to. Replay mode (PAGE_ARCHIVE_MODE=replay) serves the newest recording of each url (as of
+PAGE_ARCHIVE_AS_OF, if set) to the fetcher and to interact_and_scrape_website, so a whole sweep runs with no network
+and no browser. A replayed sweep writes nothing, since its pages are old (see store_in_db.replay_all_buildings_in_db).
+reparse_pages() runs the current parsers over archived pages in bulk, e.g. to check a parser change, and
+backfill_snapshots() writes the results to the snapshot store, e.g. to backfill a new column.
+
+The mode is read from the environment, so worker processes of a sharded sweep pick it up too.
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from http_cache import FetchedPage
+
+
+PAGE_ARCHIVE_DIR = os.getenv("PAGE_ARCHIVE_DIR", "page_archive")
+ARCHIVE_MODES = ("record", "replay")
+PAGE_KINDS = ("http", "browser")
+
+
+class ArchiveMissError(LookupError):
+    """Replay asked for a page that was never recorded."""
+
+
+@dataclass
+class ArchivedPage:
+    url: str
+    kind: str
+    recorded_at: datetime
+    content_hash: str
+    encoding: str
+    size: int
+    # Building the page was scraped for: building_name, apt_id, page_url, div_id and json_endpoint, as far as known.
+    meta: Dict = field(default_factory=dict)
+
+
+class PageArchive:
+    def __init__(self, root: str = PAGE_ARCHIVE_DIR, mode: Optional[str] = None, as_of: Optional[datetime] = None):
+        if mode is not None and mode not in ARCHIVE_MODES:
+            raise ValueError(f"Unknown page archive mode '{mode}'. Expected one of {ARCHIVE_MODES}")
+        self.root = root
+        self.mode = mode
+        self.as_of = as_of
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._meta_by_url: Dict[str, Dict] = {}
+        # Worker processes of a sharded sweep record into the same index, so wait for each other's writes.
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                recorded_at REAL NOT NULL,
+                content_hash TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                building_name TEXT,
+                meta TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_url_kind_recorded_at_idx ON pages (url, kind, recorded_at);
+            CREATE INDEX IF NOT EXISTS pages_building_name_recorded_at_idx ON pages (building_name, recorded_at);
+            """
+        )
+        self._db.commit()
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def close(self):
+        self._db.close()
+
+    def _object_path(self, content_hash: str) -> str:
+        return os.path.join(self.root, "objects", content_hash[:2], f"{content_hash}.gz")
+
+    def register_buildings(self, buildings: Iterable[Dict]):
+        """Remember which building each url (page or JSON endpoint) of these apts rows belongs to, for recordings."""
+        with self._lock:
+            for b in buildings:
+                json_endpoint = b.get("json_endpoint")
+                meta = {
+                    "building_name": b.get("building_name"),
+                    "apt_id": b.get("id"),
+                    "page_url": b["url"],
+                    "div_id": b.get("div_id"),
+                    "json_endpoint": json_endpoint,
+                }
+                self._meta_by_url[b["url"]] = meta
+                if json_endpoint:
+                    self._meta_by_url[json_endpoint["url"]] = meta
+
+    def record(self, url: str, kind: str, body: bytes, encoding: str = "utf-8", recorded_at: Optional[datetime] = None) -> str:
+        """Archive one fetched page. The body is only written if no page with the same content was archived before."""
+        content_hash = hashlib.sha256(body).hexdigest()
+        path = self._object_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        self._insert(url, kind, content_hash, encoding, len(body), recorded_at or datetime.now(timezone.utc))
+        return content_hash
+
+    def _insert(self, url: str, kind: str, content_hash: str, encoding: str, size: int, recorded_at: datetime):
+        with self._lock:
+            meta = self._meta_by_url.get(url, {"page_url": url})
+            self._db.execute(
+                """
+                INSERT INTO pages (url, kind, recorded_at, content_hash, encoding, size, building_name, meta)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (url, kind, recorded_at.timestamp(), content_hash, encoding, size, meta.get("building_name"), json.dumps(meta)),
+            )
+            self._db.commit()
+
+    def record_chunks(self, url: str, kind: str, chunks: Iterable[bytes], encoding: str = "utf-8") -> Iterator[bytes]:
+        """
+        Pass a streamed page's chunks through while archiving them, without holding the whole page. The recording is
+        only made once the whole page has been read, so a reader that stops early (e.g. on an error) leaves no partial page.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.root, "objects", f"stream.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with gzip.open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            content_hash = hasher.hexdigest()
+            path = self._object_path(content_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self._insert(url, kind, content_hash, encoding, size, datetime.now(timezone.utc))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def read_chunks(self, page: ArchivedPage, chunk_size: int) -> Iterator[bytes]:
+        """An archived page's body, read back in chunks of chunk_size bytes."""
+        with gzip.open(self._object_path(page.content_hash), "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def read_body(self, page: ArchivedPage) -> bytes:
+        with gzip.open(self._object_path(page.content_hash), "rb") as f:
+            return f.read()
+
+    def read_text(self, page: ArchivedPage) -> str:
+        return self.read_body(page).decode(page.encoding, errors="replace")
+
+    @staticmethod
+    def _to_page(row: tuple) -> ArchivedPage:
+        url, kind, recorded_at, content_hash, encoding, size, meta = row
+        return ArchivedPage(
+            url=url,
+            kind=kind,
+            recorded_at=datetime.fromtimestamp(recorded_at, timezone.utc),
+            content_hash=content_hash,
+            encoding=encoding,
+            size=size,
+            meta=json.loads(meta),
+        )
+
+    def find(self, url: str, kind: str, as_of: Optional[datetime] = None) -> Optional[ArchivedPage]:
+        """The newest recording of url (at or before as_of, if given)."""
+        as_of = as_of or self.as_of
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT url, kind, recorded_at, content_hash, encoding, size, meta FROM pages
+                WHERE url = ? AND kind = ? AND recorded_at <= ?
+                ORDER BY recorded_at DESC LIMIT 1
+                """,
+                (url, kind, as_of.timestamp() if as_of else time.time() + 1),
+            ).fetchone()
+        return self._to_page(row) if row else None
+
+    def replay(self, url: str, kind: str) -> ArchivedPage:
+        """The recording to replay for url, as of the archive's as_of time."""
+        page = self.find(url, kind)
+        if page is None:
+            raise ArchiveMissError(f"No archived {kind} page for {url}")
+        return page
+
+    def replay_text(self, url: str, kind: str) -> str:
+        return self.read_text(self.replay(url, kind))
+
+    def replay_page(self, url: str) -> FetchedPage:
+        """An archived http page, as the fetcher would have returned it."""
+        page = self.replay(url, "http")
+        body = self.read_body(page)
+        return FetchedPage(url=url, body=body, text=body.decode(page.encoding, errors="replace"))
+
+    def iter_pages(
+        self,
+        building_names: Optional[List[str]] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        kinds: Iterable[str] = PAGE_KINDS,
+    ) -> Iterator[ArchivedPage]:
+        """Every recording of the given buildings and time range (inclusive), oldest first."""
+        kinds = list(kinds)
+        conditions = [f"kind IN ({', '.join('?' * len(kinds))})"]
+        params: list = list(kinds)
+        if building_names:
+            conditions.append(f"building_name IN ({', '.join('?' * len(building_names))})")
+            params += building_names
+        if start:
+            conditions.append("recorded_at >= ?")
+            params.append(start.timestamp())
+        if end:
+            conditions.append("recorded_at <= ?")
+            params.append(end.timestamp())
+        with self._lock:
+            rows = self._db.execute(
+                f"""
+                SELECT url, kind, recorded_at, content_hash, encoding, size, meta FROM pages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY recorded_at, id
+                """,
+                params,
+            ).fetchall()
+        for row in rows:
+            yield self._to_page(row)
+
+
+_default_archive = None
+_default_archive_lock = threading.Lock()
+
+
+def get_page_archive() -> Optional[PageArchive]:
+    """The process wide archive for the mode in PAGE_ARCHIVE_MODE, or None when neither recording nor replaying."""
+    global _default_archive
+    mode = os.getenv("PAGE_ARCHIVE_MODE")
+    if not mode:
+        return None
+    with _default_archive_lock:
+        if _default_archive is None:
+            as_of = os.getenv("PAGE_ARCHIVE_AS_OF")
+            as_of = datetime.fromisoformat(as_of) if as_of else None
+            if as_of is not None and as_of.tzinfo is None:
+                as_of = as_of.replace(tzinfo=timezone.utc)
+            _default_archive = PageArchive(os.getenv("PAGE_ARCHIVE_DIR", PAGE_ARCHIVE_DIR), mode=mode, as_of=as_of)
+        return _default_archive
+
+
+def configure_page_archive(mode: Optional[str], root: str = PAGE_ARCHIVE_DIR, as_of: Optional[str] = None):
+    """Set the archive mode for this process and the worker processes it starts (through the environment)."""
+    global _default_archive
+    if mode is not None and mode not in ARCHIVE_MODES:
+        raise ValueError(f"Unknown page archive mode '{mode}'. Expected one of {ARCHIVE_MODES}")
+    for name, value in [("PAGE_ARCHIVE_MODE", mode), ("PAGE_ARCHIVE_DIR", root), ("PAGE_ARCHIVE_AS_OF", as_of)]:
+        if value:
+            os.environ[name] = value
+        else:
+            os.environ.pop(name, None)
+    with _default_archive_lock:
+        if _default_archive is not None:
+            _default_archive.close()
+        _default_archive = None
+
+
+def reparse_page(archive: PageArchive, page: ArchivedPage):
+    """Run the current parser and cleaning of the page's website over an archived page and return the df."""
+    from apt_webscraper import parse_and_clean_html, parse_and_clean_json, parse_html_to_df, PARSER_SUBTREES
+    from html_parsing import make_soup
+    from parser_engine import get_site_config
+
+    text = archive.read_text(page)
+    page_url = page.meta.get("page_url", page.url)
+    if page.kind == "browser":
+        soup = make_soup(text, parse_only=PARSER_SUBTREES.get(get_site_config(page_url).parser))
+        return parse_html_to_df(page_url, soup)
+    json_endpoint = page.meta.get("json_endpoint")
+    if json_endpoint and page.url == json_endpoint["url"]:
+        return parse_and_clean_json(text, page_url, json_endpoint)
+    if page.meta.get("div_id"):
+        return parse_and_clean_html(text, page_url, page.meta["div_id"])
+    raise ValueError(f"Don't know how to parse archived page {page.url}: no div_id or json_endpoint recorded for it")
+
+
+_worker_archive = None
+
+
+def _init_reparse_worker(root: str):
+    global _worker_archive
+    _worker_archive = PageArchive(root)
+
+
+def _reparse_in_worker(page: ArchivedPage):
+    try:
+        return reparse_page(_worker_archive, page)
+    except Exception as e:
+        return e
+
+
+def reparse_pages(archive: PageArchive, workers: int = 0, **filters) -> Iterator[Tuple[ArchivedPage, object]]:
+    """
+    Yield (page, df) for every archived page matching filters (see iter_pages), or (page, exception) if it fails.
+    With workers, pages are parsed in that many processes, each with its own connection to the archive.
+    """
+    pages = list(archive.iter_pages(**filters))
+    if not workers:
+        for page in pages:
+            try:
+                yield page, reparse_page(archive, page)
+            except Exception as e:
+                yield page, e
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_reparse_worker, initargs=(archive.root,)) as pool:
+        yield from zip(pages, pool.map(_reparse_in_worker, pages, chunksize=16))
+
+
+def backfill_snapshots(archive: PageArchive, snapshot_store, workers: int = 0, **filters) -> Tuple[int, int]:
+    """
+    Re-parse archived pages and append each df to snapshot_store as of the time its page was recorded, e.g. after
+    adding a column. Snapshots an earlier backfill wrote for the same (building, recording time) are replaced, so
+    running it again doesn't duplicate history. Pages that fail to parse are logged and skipped.
+    Returns (snapshots written, pages failed).
+    """
+    written = failed = 0
+    scraped_ats_by_building, written_paths = {}, set()
+    for page, df in reparse_pages(archive, workers=workers, **filters):
+        if not isinstance(df, Exception) and not page.meta.get("building_name"):
+            df = ValueError("no building recorded for the page")
+        if isinstance(df, Exception):
+            failed += 1
+            print(f"Error re-parsing archived page {page.url} recorded at {page.recorded_at}. Error: {df}")
+            continue
+        written_paths.add(snapshot_store.append(df, page.meta["building_name"], scraped_at=page.recorded_at))
+        scraped_ats_by_building.setdefault(page.meta["building_name"], []).append(page.recorded_at)
+        written += 1
+    for building_name, scraped_ats in scraped_ats_by_building.items():
+        snapshot_store.remove_scrapes(building_name, scraped_ats, keep_paths=written_paths)
+    return written, failed
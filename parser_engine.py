@@ -0,0 +1,174 @@
+"""
+Rule engine that turns configs/website_config.yaml into per website cleaning pipelines.
+
+The YAML is loaded once, each website's cleaning_rules are compiled into a list of column-wide pandas
+operations, and urls are matched to a website with one precompiled regex over every url_pattern.
+Onboarding a new building with a known layout only needs a new entry in the YAML.
+"""
+import functools
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from metrics import timed
+from unit_records import cast_rows_to_schema, report_schema_violations
+from utils.pd_df_ops import rename_and_snakecase_cols
+
+
+WEBSITE_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", "website_config.yaml")
+
+# Type names that can be used in a website's schema.
+SCHEMA_DTYPES = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "float16": np.float16,
+    "float32": np.float32,
+    "bool": bool,
+}
+
+CleaningStep = Callable[[pd.DataFrame], pd.DataFrame]
+CLEANING_RULES: Dict[str, Callable[..., CleaningStep]] = {}
+
+
+def cleaning_rule(name: str):
+    """Register a function that takes a rule's YAML arguments and returns a step that cleans a df."""
+    def register(rule_factory):
+        CLEANING_RULES[name] = rule_factory
+        return rule_factory
+    return register
+
+
+@cleaning_rule("split_bed_bath")
+def split_bed_bath(column: str, new_columns: List[str], separator: str) -> CleaningStep:
+    def step(df: pd.DataFrame) -> pd.DataFrame:
+        split_cols = df[column].astype(str).str.split(separator, n=len(new_columns) - 1, expand=True, regex=False)
+        df[new_columns] = split_cols.reindex(columns=range(len(new_columns)))
+        return df
+    return step
+
+
+@cleaning_rule("extract_digits")
+def extract_digits(columns: List[str]) -> CleaningStep:
+    def step(df: pd.DataFrame) -> pd.DataFrame:
+        df[columns] = df[columns].astype(str).replace(r"\D", "", regex=True)
+        return df
+    return step
+
+
+@cleaning_rule("drop_columns")
+def drop_columns(columns: List[str]) -> CleaningStep:
+    def step(df: pd.DataFrame) -> pd.DataFrame:
+        return df.drop(columns=columns)
+    return step
+
+
+def compile_cleaning_rules(rules: List[Dict]) -> List[CleaningStep]:
+    """Compile YAML cleaning rules (one-key dicts of rule name -> arguments) into a list of steps."""
+    steps = []
+    for rule in rules:
+        (name, args), = rule.items()
+        if name not in CLEANING_RULES:
+            raise ValueError(f"Unknown cleaning rule '{name}'. Known rules: {list(CLEANING_RULES)}")
+        if isinstance(args, dict):
+            steps.append(CLEANING_RULES[name](**args))
+        else:
+            # Rules like drop_columns take a bare list.
+            steps.append(CLEANING_RULES[name](args))
+    return steps
+
+
+@dataclass
+class SiteConfig:
+    url_pattern: str
+    scrape_method: str = "table"
+    col_rename_mapping: Dict[str, str] = field(default_factory=dict)
+    schema: Dict[str, type] = field(default_factory=dict)
+    cleaning_steps: List[CleaningStep] = field(default_factory=list)
+    interaction: Optional[str] = None
+    parser: Optional[str] = None
+    error_signatures: List[str] = field(default_factory=list)
+    # Pages big enough to parse incrementally, in chunks of units (see apt_webscraper.stream_scraped_data).
+    streaming: bool = False
+
+    @classmethod
+    def from_dict(cls, config: Dict) -> "SiteConfig":
+        unknown_dtypes = set(config.get("schema", {}).values()) - set(SCHEMA_DTYPES)
+        if unknown_dtypes:
+            raise ValueError(f"Unknown schema types {unknown_dtypes} for '{config['url_pattern']}'")
+        return cls(
+            url_pattern=config["url_pattern"],
+            scrape_method=config.get("scrape_method", "table"),
+            col_rename_mapping=config.get("col_rename_mapping") or {},
+            schema={col: SCHEMA_DTYPES[dtype] for col, dtype in (config.get("schema") or {}).items()},
+            cleaning_steps=compile_cleaning_rules(config.get("cleaning_rules") or []),
+            interaction=config.get("interaction"),
+            parser=config.get("parser"),
+            error_signatures=config.get("error_signatures") or [],
+            streaming=bool(config.get("streaming", False)),
+        )
+
+    def clean(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the website's cleaning rules in order."""
+        if not self.cleaning_steps:
+            return df
+        df = df.copy()
+        for step in self.cleaning_steps:
+            df = step(df)
+        return df
+
+    def unit_number_column(self, columns: pd.Index) -> Optional[str]:
+        """The column that is renamed to unit_number, if there is one."""
+        renamed = rename_and_snakecase_cols(pd.DataFrame(columns=columns), self.col_rename_mapping).columns
+        return next((column for column, name in zip(columns, renamed) if name == "unit_number"), None)
+
+    def clean_and_cast(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Run the cleaning rules, cast to the website's schema, then rename and snakecase columns.
+        Rows that don't fit the schema are dropped and reported rather than failing the whole df, unless every row
+        was dropped.
+        Websites whose parser already builds typed records have no schema, so nothing is cast again.
+        """
+        with timed("clean") as record:
+            df = self.clean(df)
+            record.rows = len(df)
+        with timed("cast") as record:
+            df = cast_rows_to_schema(df, self.schema, self.unit_number_column(df.columns))
+            df = rename_and_snakecase_cols(df, self.col_rename_mapping)
+            record.rows = len(df)
+        report_schema_violations(df, self.url_pattern)
+        return df
+
+
+class SiteConfigIndex:
+    def __init__(self, site_configs: List[SiteConfig]):
+        self.site_configs = site_configs
+        # One alternation of every url_pattern, with a named group per website, so a lookup is a single regex search.
+        self._pattern = re.compile(
+            "|".join(f"(?P<site{i}>{re.escape(c.url_pattern)})" for i, c in enumerate(site_configs))
+        ) if site_configs else None
+        self.lookup = functools.lru_cache(maxsize=1024)(self._lookup)
+
+    def _lookup(self, url: str) -> SiteConfig:
+        match = self._pattern.search(url) if self._pattern else None
+        if match is None:
+            raise ValueError(f"URL '{url}' is not recognized.")
+        return self.site_configs[int(match.lastgroup[len("site"):])]
+
+
+@functools.lru_cache(maxsize=None)
+def load_site_config_index(config_path: str = WEBSITE_CONFIG_PATH) -> SiteConfigIndex:
+    """Load and compile the website config YAML. Cached, so the file is only read once per process."""
+    with open(config_path) as f:
+        configs = yaml.safe_load(f) or []
+    return SiteConfigIndex([SiteConfig.from_dict(c) for c in configs])
+
+
+def get_site_config(url: str) -> SiteConfig:
+    """Given a url, return the compiled config of the website it belongs to."""
+    return load_site_config_index().lookup(url)
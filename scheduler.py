@@ -0,0 +1,260 @@
+"""
+Long-running scrape scheduler that checks each building as often as its listings actually change.
+
+Buildings sit in a priority queue keyed by their next due time. After each scrape a building's interval
+shrinks if its listings changed and grows if they didn't, failing buildings back off exponentially,
+and every interval gets some jitter so buildings don't bunch up. Buildings on the same domain are kept
+at least DOMAIN_MIN_GAP_SECONDS apart. State is persisted in the scrape_schedule table after every scrape.
+A sweep that fails as a whole (e.g. the DB is down) backs off all of its buildings like failed scrapes, and the
+scheduler logs the error and keeps running.
+
+Usage: python scheduler.py (set METRICS_PORT to serve per-stage metrics at /metrics)
+"""
+import asyncio
+import heapq
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from alerts import AlertEvaluator, print_alerts
+from async_scraper import AsyncScrapeRunner, BuildingScrapeResult
+
+
+MIN_INTERVAL_SECONDS = 15 * 60
+MAX_INTERVAL_SECONDS = 24 * 60 * 60
+DEFAULT_INTERVAL_SECONDS = 60 * 60
+# Multipliers applied to a building's interval after a scrape that did / didn't find a change.
+CHANGED_INTERVAL_FACTOR = 0.5
+UNCHANGED_INTERVAL_FACTOR = 1.25
+MAX_ERROR_BACKOFF_SECONDS = 6 * 60 * 60
+JITTER_FRACTION = 0.1
+CHANGE_RATE_SMOOTHING = 0.3
+DOMAIN_MIN_GAP_SECONDS = 30
+MAX_IDLE_SECONDS = 60
+RELOAD_CONFIG_SECONDS = 10 * 60
+# Pause after an iteration of the scheduler loop failed, e.g. while the DB is unreachable.
+ERROR_RETRY_SECONDS = 60
+
+
+@dataclass(order=True)
+class ScheduleEntry:
+    next_due_at: float
+    apt_id: int = field(compare=False)
+    interval_seconds: float = field(default=DEFAULT_INTERVAL_SECONDS, compare=False)
+    change_rate: float = field(default=0.5, compare=False)
+    consecutive_errors: int = field(default=0, compare=False)
+    last_scraped_at: Optional[float] = field(default=None, compare=False)
+    last_changed_at: Optional[float] = field(default=None, compare=False)
+    last_error: Optional[str] = field(default=None, compare=False)
+
+
+def with_jitter(seconds: float, jitter_fraction: float = JITTER_FRACTION) -> float:
+    return seconds * random.uniform(1 - jitter_fraction, 1 + jitter_fraction)
+
+
+def update_entry(entry: ScheduleEntry, result: BuildingScrapeResult, now: float) -> ScheduleEntry:
+    """Adapt a building's interval to the outcome of its latest scrape and set its next due time."""
+    entry.last_scraped_at = now
+    if result.error:
+        entry.consecutive_errors += 1
+        entry.last_error = result.error
+        # Back off from the normal interval, without changing it, so a recovered site goes back to its usual pace.
+        delay = min(entry.interval_seconds * 2 ** entry.consecutive_errors, MAX_ERROR_BACKOFF_SECONDS)
+    else:
+        changed = not result.unchanged and (result.inserted + result.updated + result.removed) > 0
+        entry.consecutive_errors = 0
+        entry.last_error = None
+        entry.change_rate = (1 - CHANGE_RATE_SMOOTHING) * entry.change_rate + CHANGE_RATE_SMOOTHING * changed
+        if changed:
+            entry.last_changed_at = now
+        factor = CHANGED_INTERVAL_FACTOR if changed else UNCHANGED_INTERVAL_FACTOR
+        entry.interval_seconds = min(max(entry.interval_seconds * factor, MIN_INTERVAL_SECONDS), MAX_INTERVAL_SECONDS)
+        delay = entry.interval_seconds
+    entry.next_due_at = now + with_jitter(delay)
+    return entry
+
+
+def _to_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return None if timestamp is None else datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def _to_timestamp(dt: Optional[datetime]) -> Optional[float]:
+    return None if dt is None else dt.timestamp()
+
+
+class ScrapeScheduler:
+    def __init__(self, config_manager, runner: AsyncScrapeRunner, domain_min_gap_seconds: float = DOMAIN_MIN_GAP_SECONDS):
+        self.config_manager = config_manager
+        self.runner = runner
+        self.domain_min_gap_seconds = domain_min_gap_seconds
+        self._queue: List[ScheduleEntry] = []
+        self._entries: Dict[int, ScheduleEntry] = {}
+        self._buildings: Dict[int, Dict] = {}
+        self._domain_next_allowed: Dict[str, float] = {}
+        self._config_loaded_at = 0.0
+
+    def load_state(self):
+        """Load the apts config and persisted schedule. Buildings without any state are due right away."""
+        self._buildings = {b["id"]: b for b in self.config_manager.load_scraping_config()}
+        self._config_loaded_at = time.time()
+        with self.config_manager.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT apt_id, next_due_at, interval_seconds, change_rate, consecutive_errors,
+                    last_scraped_at, last_changed_at, last_error
+                FROM scrape_schedule
+                """
+            )
+            persisted = {row[0]: row for row in cur.fetchall()}
+
+        now = time.time()
+        for apt_id in self._buildings:
+            if apt_id in self._entries:
+                continue
+            row = persisted.get(apt_id)
+            if row is None:
+                entry = ScheduleEntry(next_due_at=now, apt_id=apt_id)
+            else:
+                entry = ScheduleEntry(
+                    next_due_at=row[1].timestamp(),
+                    apt_id=apt_id,
+                    interval_seconds=row[2],
+                    change_rate=row[3],
+                    consecutive_errors=row[4],
+                    last_scraped_at=_to_timestamp(row[5]),
+                    last_changed_at=_to_timestamp(row[6]),
+                    last_error=row[7],
+                )
+            self._entries[apt_id] = entry
+            heapq.heappush(self._queue, entry)
+
+    def save_entries(self, entries: List[ScheduleEntry]):
+        with self.config_manager.connection() as conn:
+            with conn.cursor() as cur:
+                for e in entries:
+                    cur.execute(
+                        """
+                        INSERT INTO scrape_schedule (
+                            apt_id, next_due_at, interval_seconds, change_rate, consecutive_errors,
+                            last_scraped_at, last_changed_at, last_error, updated_at
+                        )
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                        ON CONFLICT (apt_id) DO UPDATE SET
+                            next_due_at = EXCLUDED.next_due_at,
+                            interval_seconds = EXCLUDED.interval_seconds,
+                            change_rate = EXCLUDED.change_rate,
+                            consecutive_errors = EXCLUDED.consecutive_errors,
+                            last_scraped_at = EXCLUDED.last_scraped_at,
+                            last_changed_at = EXCLUDED.last_changed_at,
+                            last_error = EXCLUDED.last_error,
+                            updated_at = EXCLUDED.updated_at
+                        """,
+                        (
+                            e.apt_id,
+                            _to_datetime(e.next_due_at),
+                            int(e.interval_seconds),
+                            e.change_rate,
+                            e.consecutive_errors,
+                            _to_datetime(e.last_scraped_at),
+                            _to_datetime(e.last_changed_at),
+                            e.last_error,
+                        ),
+                    )
+            conn.commit()
+
+    def pop_due(self, now: float) -> List[ScheduleEntry]:
+        """
+        Pop every building that is due, at most one per domain per domain_min_gap_seconds.
+        Due buildings held back by their domain are pushed back to when the domain is next allowed.
+        """
+        due, deferred = [], []
+        while self._queue and self._queue[0].next_due_at <= now:
+            entry = heapq.heappop(self._queue)
+            building = self._buildings.get(entry.apt_id)
+            if building is None:
+                # Building was removed from the apts table.
+                self._entries.pop(entry.apt_id, None)
+                continue
+            domain = urlparse(building["url"]).netloc
+            next_allowed = self._domain_next_allowed.get(domain, 0.0)
+            if next_allowed > now:
+                entry.next_due_at = next_allowed
+                deferred.append(entry)
+                continue
+            self._domain_next_allowed[domain] = now + self.domain_min_gap_seconds
+            due.append(entry)
+        for entry in deferred:
+            heapq.heappush(self._queue, entry)
+        return due
+
+    async def run_due(self, due: List[ScheduleEntry]):
+        """
+        Scrape the due buildings and push them back on the queue. If the sweep itself fails, every building is
+        counted as failed, so they are still pushed back, with the usual error backoff.
+        """
+        buildings = [self._buildings[e.apt_id] for e in due]
+        try:
+            results = await self.runner.run(buildings)
+        except Exception as e:
+            print(f"Sweep of {len(due)} buildings failed, backing them off. Error: {e}")
+            error = f"{type(e).__name__}: {e}"
+            results = [BuildingScrapeResult(building_name=b["building_name"], apt_id=b["id"], error=error) for b in buildings]
+        now = time.time()
+        for entry, result in zip(due, results):
+            update_entry(entry, result, now)
+            heapq.heappush(self._queue, entry)
+        self.save_entries(due)
+        changed = [r.building_name for r in results if r.inserted or r.updated or r.removed]
+        failed = [r.building_name for r in results if r.error]
+        print(f"Scraped {len(results)} buildings: {len(changed)} changed, {len(failed)} failed.")
+        if changed:
+            with self.config_manager.connection() as conn:
+                print_alerts(AlertEvaluator(conn).evaluate())
+
+    async def run_forever(self):
+        self.load_state()
+        while True:
+            try:
+                now = time.time()
+                if now - self._config_loaded_at > RELOAD_CONFIG_SECONDS:
+                    # Pick up buildings added to (or removed from) the apts table.
+                    self.load_state()
+                due = self.pop_due(now)
+                if due:
+                    await self.run_due(due)
+                    continue
+                next_due_at = self._queue[0].next_due_at if self._queue else now + MAX_IDLE_SECONDS
+                await asyncio.sleep(min(max(next_due_at - now, 0), MAX_IDLE_SECONDS))
+            except Exception as e:
+                # run_due has already pushed its buildings back, so only the schedule save or alerts were lost.
+                print(f"Scheduler iteration failed, retrying in {ERROR_RETRY_SECONDS}s. Error: {e}")
+                await asyncio.sleep(ERROR_RETRY_SECONDS)
+
+
+if __name__ == "__main__":
+    from db_migrations import apply_migrations
+    from http_cache import ResponseCache
+    from metrics import METRICS_PORT, configure_stage_log
+    from snapshot_store import SnapshotStore
+    from store_in_db import DBConfigManager, create_connection_pool
+    from unit_hash_cache import UnitHashCache
+
+    config_manager = DBConfigManager(pool=create_connection_pool())
+    try:
+        with config_manager.connection() as conn:
+            apply_migrations(conn)
+        runner = AsyncScrapeRunner(
+            config_manager, cache=ResponseCache(), snapshot_store=SnapshotStore(), unit_cache=UnitHashCache()
+        )
+        configure_stage_log()
+        if METRICS_PORT:
+            runner.metrics.serve(int(METRICS_PORT))
+            print(f"Serving metrics at http://localhost:{METRICS_PORT}/metrics")
+        asyncio.run(ScrapeScheduler(config_manager, runner).run_forever())
+    except KeyboardInterrupt:
+        print("Scheduler stopped.")
+    finally:
+        config_manager.close_connection()
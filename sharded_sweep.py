@@ -0,0 +1,162 @@
+"""
+Multi-process sweep that splits the apts table into shards scraped by separate worker processes.
+
+Parsing and cleaning are CPU bound and hold the GIL, so a single process tops out at one core on big sweeps.
+Each shard runs in its own single-process executor, with its own DB connection, browser pool and AsyncScrapeRunner
+(parsing on a thread, since the worker process already is the unit of parallelism). Workers don't write to
+floor_plans or the response cache: their scraped dfs (and the urls they found unchanged) are sent back and written by
+the parent, so the sweep is written in one bulk upsert per set of columns and the cache's SQLite index and bodies have
+a single writer. A worker that crashes only fails the buildings of its own shard.
+"""
+import asyncio
+import multiprocessing
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import pandas as pd
+
+from async_scraper import AsyncScrapeRunner, BuildingScrapeResult
+from browser_pool import close_default_browser_pool
+from http_cache import FetchedPage, ResponseCache
+from metrics import METRICS_TEXTFILE_PATH, PipelineMetrics, configure_stage_log
+from snapshot_store import SnapshotStore
+from unit_hash_cache import UnitHashCache
+
+
+DEFAULT_SWEEP_WORKERS = os.cpu_count() or 1
+
+
+@dataclass
+class ShardOutput:
+    results: List[BuildingScrapeResult]
+    scraped: List[Tuple[BuildingScrapeResult, pd.DataFrame, Optional[FetchedPage]]]
+    metrics: PipelineMetrics
+    # Urls found unchanged, for the parent to touch in the response cache.
+    touched: List[str]
+
+
+def shard_buildings(buildings: List[Dict], workers: int) -> List[List[Dict]]:
+    """
+    Split buildings into at most `workers` shards of similar size. All buildings of a domain go to the same shard,
+    so the per host connection limit still holds across the whole sweep.
+    """
+    by_domain = defaultdict(list)
+    for building in buildings:
+        by_domain[urlparse(building["url"]).netloc].append(building)
+    shards = [[] for _ in range(max(min(workers, len(by_domain)), 1))]
+    for domain_buildings in sorted(by_domain.values(), key=len, reverse=True):
+        min(shards, key=len).extend(domain_buildings)
+    return [shard for shard in shards if shard]
+
+
+def scrape_shard(
+    apt_ids: List[int],
+    db_params: Dict,
+    cache_dir: Optional[str],
+    snapshot_dir: Optional[str],
+    runner_kwargs: Dict,
+) -> ShardOutput:
+    """Worker process entry point: scrape the apts rows with the given ids, without writing them to the DB."""
+    import psycopg2
+
+    from store_in_db import DBConfigManager
+
+    configure_stage_log()
+    config_manager = DBConfigManager(db_connection=psycopg2.connect(**db_params))
+    cache = ResponseCache(cache_dir, defer_writes=True) if cache_dir else None
+    try:
+        shard_ids = set(apt_ids)
+        buildings = [b for b in config_manager.load_scraping_config() if b["id"] in shard_ids]
+        runner = AsyncScrapeRunner(
+            config_manager,
+            cache=cache,
+            snapshot_store=SnapshotStore(snapshot_dir) if snapshot_dir else None,
+            parse_workers=0,
+            metrics_textfile_path=None,
+            defer_upserts=True,
+            **runner_kwargs,
+        )
+        results = asyncio.run(runner.run(buildings))
+        return ShardOutput(
+            results=results,
+            scraped=runner.take_pending_upserts(),
+            metrics=runner.metrics,
+            touched=cache.take_pending_touches() if cache else [],
+        )
+    finally:
+        close_default_browser_pool()
+        if cache:
+            cache.close()
+        config_manager.close_connection()
+
+
+def run_sharded_sweep(
+    config_manager,
+    buildings: List[Dict],
+    db_params: Dict,
+    workers: int = DEFAULT_SWEEP_WORKERS,
+    cache: Optional[ResponseCache] = None,
+    snapshot_store: Optional[SnapshotStore] = None,
+    metrics: Optional[PipelineMetrics] = None,
+    metrics_textfile_path: Optional[str] = METRICS_TEXTFILE_PATH,
+    unit_cache: Optional[UnitHashCache] = None,
+    **runner_kwargs,
+) -> List[BuildingScrapeResult]:
+    """
+    Scrape the given apts rows in up to `workers` processes, then upsert every shard's dfs from this process.
+    Returns one result per building, in the order of buildings.
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    shards = shard_buildings(buildings, workers)
+    # Spawned (not forked) workers, so they don't inherit this process' DB connections or browsers.
+    mp_context = multiprocessing.get_context("spawn")
+    # One executor per shard: a worker process that dies only breaks its own executor.
+    executors = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context) for _ in shards]
+    results_by_apt_id, scraped, touched = {}, [], []
+    try:
+        futures = [
+            executor.submit(
+                scrape_shard,
+                [b["id"] for b in shard],
+                db_params,
+                cache.cache_dir if cache else None,
+                snapshot_store.root if snapshot_store else None,
+                runner_kwargs,
+            )
+            for executor, shard in zip(executors, shards)
+        ]
+        for shard, future in zip(shards, futures):
+            try:
+                output = future.result()
+            except Exception as e:
+                print(f"Sweep worker for {len(shard)} buildings failed. Error: {e}")
+                for b in shard:
+                    results_by_apt_id[b["id"]] = BuildingScrapeResult(
+                        building_name=b["building_name"], apt_id=b["id"], error=f"{type(e).__name__}: {e}"
+                    )
+                continue
+            results_by_apt_id.update((r.apt_id, r) for r in output.results)
+            scraped.extend(output.scraped)
+            touched.extend(output.touched)
+            metrics.update(output.metrics)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    if cache:
+        cache.touch(touched)
+    # The result objects in scraped are the ones in results_by_apt_id (unpickled together), so counts land in both.
+    AsyncScrapeRunner(
+        config_manager, cache=cache, snapshot_store=snapshot_store, metrics=metrics, unit_cache=unit_cache
+    ).upsert_batch(scraped)
+    if metrics_textfile_path:
+        metrics.write_textfile(metrics_textfile_path)
+    return [
+        results_by_apt_id.get(b["id"])
+        or BuildingScrapeResult(building_name=b["building_name"], apt_id=b["id"], error="Building not found in apts table")
+        for b in buildings
+    ]
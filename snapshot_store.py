@@ -0,0 +1,201 @@
+"""
+Local archive of every scraped df, stored as Parquet files partitioned by building and scrape date.
+
+Layout: <root>/building=<building>/date=<YYYY-MM-DD>/<time>-<id>.parquet
+Categorical columns are dictionary encoded and files are zstd compressed. Queries only read the columns
+they ask for, and building/date filters prune whole partition directories before any file is opened.
+Every sweep of a building adds one snapshot, so snapshots are evenly spaced samples: a sweep that found the page
+unchanged writes the building's latest snapshot again (append_unchanged) instead of leaving a gap.
+"""
+import os
+import re
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Collection, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+# Every file is written with this schema (missing columns are null), so websites with different columns can be queried together.
+SNAPSHOT_SCHEMA = pa.schema(
+    [
+        ("apt_id", pa.int64()),
+        ("building_name", pa.string()),
+        ("unit_number", pa.string()),
+        ("bedrooms", pa.float32()),
+        ("bathrooms", pa.float32()),
+        ("sq_ft", pa.int64()),
+        ("floor_plan_type", pa.string()),
+        ("price", pa.int64()),
+        ("date_available", pa.string()),
+        ("scraped_at", pa.timestamp("us", tz="UTC")),
+    ]
+)
+DICTIONARY_COLUMNS = ["building_name", "unit_number", "floor_plan_type", "date_available"]
+PARTITION_SCHEMA = pa.schema([("building", pa.string()), ("date", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+
+
+def building_partition_name(building_name: str) -> str:
+    """Make a building name safe to use as a directory name."""
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", building_name.strip())
+
+
+def write_table_atomically(table: pa.Table, path: str):
+    """
+    Write a snapshot file under a hidden temp name, which readers skip, then rename it to path, so readers see either
+    the old file or the whole new one.
+    """
+    # Datasets skip files starting with "." (and nothing here reads files not ending with .parquet).
+    temp_path = os.path.join(os.path.dirname(path), f".writing-{uuid.uuid4().hex[:8]}.tmp")
+    pq.write_table(table, temp_path, compression="zstd", use_dictionary=DICTIONARY_COLUMNS)
+    os.replace(temp_path, path)
+
+
+class SnapshotStore:
+    def __init__(self, root: str = SNAPSHOT_DIR):
+        self.root = root
+
+    def append(self, df: pd.DataFrame, building_name: str, scraped_at: Optional[datetime] = None) -> str:
+        """Write one scraped df of a building as a new file in its building/date partition. Returns the file path."""
+        scraped_at = scraped_at or datetime.now(timezone.utc)
+        df = df.reindex(columns=SNAPSHOT_SCHEMA.names)
+        df["building_name"] = building_name
+        df["scraped_at"] = pd.Timestamp(scraped_at)
+        # Parquet has no float16, so half floats (bedrooms/bathrooms) are stored as float32.
+        df[["bedrooms", "bathrooms"]] = df[["bedrooms", "bathrooms"]].astype("float32")
+
+        partition_dir = os.path.join(
+            self.root, f"building={building_partition_name(building_name)}", f"date={scraped_at.date().isoformat()}"
+        )
+        os.makedirs(partition_dir, exist_ok=True)
+        path = os.path.join(partition_dir, f"{scraped_at:%H%M%S}-{uuid.uuid4().hex[:8]}.parquet")
+        table = pa.Table.from_pandas(df, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+        pq.write_table(table, path, compression="zstd", use_dictionary=DICTIONARY_COLUMNS)
+        return path
+
+    def append_unchanged(self, building_name: str, scraped_at: Optional[datetime] = None) -> Optional[str]:
+        """
+        Record a sweep that found a building's page unchanged, by writing its latest snapshot again as of scraped_at.
+        Returns the file path, or None if the building has no snapshot yet.
+        """
+        building_dir = os.path.join(self.root, f"building={building_partition_name(building_name)}")
+        if not os.path.isdir(building_dir):
+            return None
+        date_dirs = sorted((d.path for d in os.scandir(building_dir) if d.name.startswith("date=")), reverse=True)
+        for date_dir in date_dirs:
+            files = [f.path for f in os.scandir(date_dir) if f.name.endswith(".parquet")]
+            if files:
+                break
+        else:
+            return None
+        table = pa.concat_tables([pq.read_table(f, schema=SNAPSHOT_SCHEMA) for f in files])
+        latest = table.filter(pc.equal(table["scraped_at"], pc.max(table["scraped_at"])))
+        return self.append(latest.to_pandas(), building_name, scraped_at)
+
+    def remove_scrapes(
+        self, building_name: str, scraped_ats: Iterable[datetime], keep_paths: Collection[str] = ()
+    ) -> int:
+        """
+        Remove a building's snapshots taken at the given times, except from the files in keep_paths. Files are
+        rewritten atomically (or deleted if nothing is left). Returns the number of rows removed.
+        """
+        scraped_ats = list(scraped_ats)
+        times = pa.array([pd.Timestamp(t) for t in scraped_ats], pa.timestamp("us", tz="UTC"))
+        building_dir = os.path.join(self.root, f"building={building_partition_name(building_name)}")
+        removed = 0
+        for day in sorted({t.date().isoformat() for t in scraped_ats}):
+            date_dir = os.path.join(building_dir, f"date={day}")
+            if not os.path.isdir(date_dir):
+                continue
+            for f in list(os.scandir(date_dir)):
+                if not f.name.endswith(".parquet") or f.path in keep_paths:
+                    continue
+                table = pq.read_table(f.path, schema=SNAPSHOT_SCHEMA)
+                matches = pc.is_in(table["scraped_at"], value_set=times)
+                matched = pc.sum(matches).as_py() or 0
+                if not matched:
+                    continue
+                if matched == table.num_rows:
+                    os.remove(f.path)
+                else:
+                    write_table_atomically(table.filter(pc.invert(matches)), f.path)
+                removed += matched
+        return removed
+
+    def dataset(self) -> ds.Dataset:
+        schema = pa.schema(list(SNAPSHOT_SCHEMA) + list(PARTITION_SCHEMA))
+        return ds.dataset(self.root, format="parquet", partitioning=PARTITIONING, schema=schema)
+
+    def read(
+        self,
+        columns: Optional[List[str]] = None,
+        building_names: Optional[List[str]] = None,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+    ) -> pa.Table:
+        """Read only the given columns from the partitions of the given buildings and date range (inclusive)."""
+        if not os.path.isdir(self.root):
+            return pa.table({col: [] for col in columns or []})
+        filters = []
+        if building_names:
+            filters.append(pc.field("building").isin([building_partition_name(b) for b in building_names]))
+        if start_date:
+            filters.append(pc.field("date") >= start_date.isoformat())
+        if end_date:
+            filters.append(pc.field("date") <= end_date.isoformat())
+        expression = None
+        for f in filters:
+            expression = f if expression is None else expression & f
+        return self.dataset().to_table(columns=columns, filter=expression)
+
+    def read_df(self, *args, **kwargs) -> pd.DataFrame:
+        return self.read(*args, **kwargs).to_pandas()
+
+    def median_price_per_sq_ft_by_bedrooms(
+        self, days: int = 90, building_names: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """Median price per sq_ft for each bedroom count over the last `days` days of snapshots."""
+        start_date = datetime.now(timezone.utc).date() - timedelta(days=days)
+        table = self.read(columns=["bedrooms", "price", "sq_ft"], building_names=building_names, start_date=start_date)
+        table = table.filter(pc.greater(table["sq_ft"], 0))
+        df = pd.DataFrame(
+            {
+                "bedrooms": table["bedrooms"].to_numpy(),
+                "price_per_sq_ft": pc.divide(
+                    pc.cast(table["price"], pa.float64()), pc.cast(table["sq_ft"], pa.float64())
+                ).to_numpy(),
+            }
+        )
+        return (
+            df.groupby("bedrooms")["price_per_sq_ft"]
+            .agg(median_price_per_sq_ft="median", snapshots="count")
+            .reset_index()
+        )
+
+    def compact(self, before_date: Optional[date] = None):
+        """
+        Merge each building/date partition's files into a single file, for dates before before_date (default today).
+        Hourly sweeps write many small files, and fewer files keeps queries over long date ranges fast.
+        The merged file is written atomically (see write_table_atomically) before the files it replaces are removed,
+        so a reader never sees a partly written file or a partition missing its snapshots.
+        """
+        before_date = before_date or datetime.now(timezone.utc).date()
+        if not os.path.isdir(self.root):
+            return
+        for building_dir in os.scandir(self.root):
+            for date_dir in os.scandir(building_dir.path):
+                if not date_dir.name.startswith("date=") or date_dir.name[len("date="):] >= before_date.isoformat():
+                    continue
+                files = sorted(f.path for f in os.scandir(date_dir.path) if f.name.endswith(".parquet"))
+                if len(files) <= 1:
+                    continue
+                table = pa.concat_tables([pq.read_table(f, schema=SNAPSHOT_SCHEMA) for f in files])
+                write_table_atomically(table, os.path.join(date_dir.path, f"compacted-{uuid.uuid4().hex[:8]}.parquet"))
+                for f in files:
+                    os.remove(f)
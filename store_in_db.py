@@ -1,12 +1,35 @@
+"""
+DB access for the apts (scraping config) and floor_plans tables, and the sweeps that fill floor_plans.
+
+Only psycopg2 is imported at module level, so config work and short queries start fast. pandas and the scraping
+stack (browser, parsers, async runner) are imported by the methods and sweeps that use them. See cli.py for the
+command line entry point.
+"""
+from __future__ import annotations
+
 import os
+import itertools
+import pickle
+import sys
+import tempfile
+import threading
+import uuid
+import weakref
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from datetime import date
+from io import StringIO
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import execute_values, RealDictCursor
-import pandas as pd
-from typing import List
+from psycopg2.extras import Json, RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
 
-from apt_webscraper import given_url_get_latest_scraped_data
+    from unit_hash_cache import UnitHashCache
 
 
 # Set DB info
@@ -23,22 +46,201 @@ db_params = {
     # "password": PASSWORD,
     "port": PORT,
 }
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+
+FLOOR_PLANS_REQUIRED_COLUMNS = [
+    "apt_id",
+    "unit_number",
+    "sq_ft",
+    "bedrooms",
+    "bathrooms",
+    "price",
+    "date_available",
+]
+
+
+# Hot queries that are prepared once per connection (server-side) and then only executed.
+PREPARED_STATEMENTS = {
+    "apt_scraping_info_by_building": ("text", "SELECT id, div_id, json_endpoint, url FROM apts WHERE building_name = $1"),
+    "apt_config_by_url": ("text", "SELECT * FROM apts WHERE url = $1"),
+}
+
+# Rows fetched per round trip (and per df) when streaming listings from a server-side cursor.
+LISTING_CHUNK_ROWS = int(os.getenv("LISTING_CHUNK_ROWS", 10_000))
+LISTING_COLUMNS = [
+    "building_name",
+    "apt_id",
+    "unit_number",
+    "bedrooms",
+    "bathrooms",
+    "sq_ft",
+    "floor_plan_type",
+    "price",
+    "date_available",
+    "availability_status",
+]
+# Materialized views with per building aggregates (migrations/004_listing_search.sql).
+LISTING_STATS_VIEWS = ["building_listing_stats"]
+
+
+@dataclass
+class ListingFilter:
+    """A listing search. Every criterion left as None matches everything; ranges are inclusive."""
+
+    building_name: Optional[str] = None
+    min_bedrooms: Optional[float] = None
+    max_bedrooms: Optional[float] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    min_sq_ft: Optional[int] = None
+    max_sq_ft: Optional[int] = None
+    # Units available on or before this date ('Now' counts as available already).
+    available_by: Optional[date] = None
+    include_unavailable: bool = False
+
+    def where_sql(self) -> tuple:
+        """The WHERE clause (over floor_plans fp and apts a) and its parameters."""
+        conditions, params = [], []
+        if not self.include_unavailable:
+            # Matches the partial indexes' predicate, so they can be used.
+            conditions.append(sql.SQL("fp.availability_status"))
+        for column, low, high in [
+            ("bedrooms", self.min_bedrooms, self.max_bedrooms),
+            ("price", self.min_price, self.max_price),
+            ("sq_ft", self.min_sq_ft, self.max_sq_ft),
+        ]:
+            if low is not None:
+                conditions.append(sql.SQL("fp.{} >= %s").format(sql.Identifier(column)))
+                params.append(low)
+            if high is not None:
+                conditions.append(sql.SQL("fp.{} <= %s").format(sql.Identifier(column)))
+                params.append(high)
+        if self.building_name is not None:
+            conditions.append(sql.SQL("a.building_name = %s"))
+            params.append(self.building_name)
+        if self.available_by is not None:
+            conditions.append(sql.SQL("floor_plan_available_on(fp.date_available) <= %s"))
+            params.append(self.available_by)
+        where = sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("TRUE")
+        return where, params
+
+
+def columns_sql(cols: str) -> sql.Composable:
+    """A comma separated list of column names (or *) as quoted identifiers, so it can't inject SQL."""
+    if cols.strip() == "*":
+        return sql.SQL("*")
+    return sql.SQL(", ").join(sql.Identifier(c.strip()) for c in cols.split(","))
+
+
+class ChunkSpool:
+    """
+    The parsed chunks of a streamed building, pickled one after another to a temporary file. A building is read (from
+    the network or a browser) into a spool before its upsert takes a DB connection, so the transaction never waits on
+    a website, and only one chunk is in memory at a time.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self.chunks = 0
+        self.rows = 0
+
+    def append(self, df: pd.DataFrame):
+        pickle.dump(df, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.chunks += 1
+        self.rows += len(df)
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        self._file.seek(0)
+        for _ in range(self.chunks):
+            yield pickle.load(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+def spool_chunks(chunks: Iterable[pd.DataFrame]) -> ChunkSpool:
+    """Read every chunk into a new ChunkSpool."""
+    spool = ChunkSpool()
+    try:
+        for df in chunks:
+            spool.append(df)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+def create_connection_pool(pool_size: int = DB_POOL_SIZE) -> ThreadedConnectionPool:
+    """Create a thread-safe pool of up to pool_size connections to the DB."""
+    return ThreadedConnectionPool(minconn=1, maxconn=pool_size, **db_params)
 
 
 class DBConfigManager:
-    def __init__(self, db_connection):
+    def __init__(self, db_connection=None, pool: ThreadedConnectionPool = None):
+        """Use either a single connection (calls are serialized with a lock) or a pool shared by concurrent workers."""
+        if (db_connection is None) == (pool is None):
+            raise ValueError("Pass exactly one of db_connection or pool.")
         self.conn = db_connection
+        self.pool = pool
+        # Reentrant, so a thread can borrow the single connection again while it already has it.
+        self._conn_lock = threading.RLock()
+        # The pool raises PoolError instead of waiting when all of its connections are out, so callers wait here.
+        self._pool_slots = threading.BoundedSemaphore(pool.maxconn) if pool else None
+        # Connections (not their ids, which a new connection can reuse) that have every PREPARED_STATEMENTS prepared.
+        self._prepared_conns = weakref.WeakSet()
+        self._scraping_config = None
+
+    @property
+    def max_concurrent_connections(self) -> int:
+        return self.pool.maxconn if self.pool else 1
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block, waiting for one if the pool's are all borrowed.
+        With a pool, nested with blocks borrow one connection each.
+        """
+        if self.pool is None:
+            with self._conn_lock:
+                yield self.conn
+            return
+        with self._pool_slots:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+            finally:
+                # Writes commit explicitly, so end any transaction left open by reads (or a failure) before the next caller gets it.
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self.pool.putconn(conn)
 
     def close_connection(self):
-        if self.conn:
+        if self.pool:
+            self.pool.closeall()
+            print("Database connection pool closed.")
+        elif self.conn:
             self.conn.close()
             print("Database connection closed.")
 
+    def _execute_prepared(self, conn, cur, name: str, params: tuple):
+        """Execute one of PREPARED_STATEMENTS, preparing them first if this connection hasn't yet."""
+        if conn not in self._prepared_conns:
+            with conn.cursor() as prepare_cur:
+                # Prepared statements outlive a rolled back transaction, so an earlier attempt may have prepared some.
+                prepare_cur.execute("SELECT name FROM pg_prepared_statements")
+                already_prepared = {row[0] for row in prepare_cur.fetchall()}
+                for statement_name, (arg_types, query) in PREPARED_STATEMENTS.items():
+                    if statement_name not in already_prepared:
+                        prepare_cur.execute(f"PREPARE {statement_name} ({arg_types}) AS {query}")
+            self._prepared_conns.add(conn)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
     def get_all_cols_in_table(self, table: str):
         """Given a table name, return a list of all the table's column names."""
         try:
             # Get table columns from the database
-            with self.conn.cursor() as cur:
+            with self.connection() as conn, conn.cursor() as cur:
                 cur.execute(
                     """
                     SELECT column_name 
@@ -53,179 +255,692 @@ class DBConfigManager:
             print("Error: ", e)
 
     def select_cols_from_table(self, table: str, cols_list: str = "*"):
-        """Given a table, select a comma separated list of columns and return rows of data."""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(f"SELECT {cols_list} FROM {table}")
+        """
+        Given a table, select a comma separated list of columns and return rows of data.
+        Loads the whole table, so use search_listings / iter_listings for floor_plans.
+        """
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql.SQL("SELECT {} FROM {}").format(columns_sql(cols_list), sql.Identifier(table)))
             return cur.fetchall()
 
     def select_all_rows_from_table(self, table: str):
         """Given a table, select and return all rows of data."""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(f"SELECT * FROM {table}")
-            return cur.fetchall()
+        return self.select_cols_from_table(table)
+
+    def load_scraping_config(self) -> List[Dict]:
+        """
+        Load every row of the apts table in one query, and cache it so per-building and per-url lookups
+        for the rest of the run don't need a round trip. Call again to refresh.
+        """
+        rows = self.select_all_rows_from_table("apts")
+        self._scraping_config = {
+            "by_building": {},
+            "by_url": {},
+        }
+        for row in rows:
+            self._scraping_config["by_building"].setdefault(row["building_name"], []).append(row)
+            self._scraping_config["by_url"].setdefault(row["url"], row)
+        return rows
 
     def get_apt_info_df_given_url(
         self, url_list: List[str], cols: str = "id, div_id"
     ) -> pd.DataFrame:
         """Given a list of urls and string of comma separated SQL column names, return a df of apt specified columns and the url."""
-        url_list_distinct = tuple(set(url_list))
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+        import pandas as pd
+
+        url_list_distinct = list(set(url_list))
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
-                f"SELECT {cols}, url FROM apts WHERE url IN {url_list_distinct}"
+                sql.SQL("SELECT {}, url FROM apts WHERE url = ANY(%s)").format(columns_sql(cols)), (url_list_distinct,)
             )
             df_apt_info = pd.DataFrame(cur.fetchall())
             return df_apt_info
 
     def get_apt_scraping_info_given_building(
-        self, building_name: str, cols: str = "id, div_id"
+        self, building_name: str, cols: str = "id, div_id, json_endpoint"
     ) -> pd.DataFrame:
         """Given a building name and string of comma separated SQL column names, return a df of apt data needed for scraping."""
+        import pandas as pd
+
         # TODO: ensure building_name is Capitalized.
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                f"SELECT {cols}, url FROM apts WHERE building_name='{building_name}'"
-            )
+        col_names = [c.strip() for c in cols.split(",")] + ["url"]
+        if self._scraping_config is not None:
+            rows = self._scraping_config["by_building"].get(building_name, [])
+            return pd.DataFrame([{c: row[c] for c in col_names} for row in rows], columns=col_names)
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if cols == "id, div_id, json_endpoint":
+                self._execute_prepared(conn, cur, "apt_scraping_info_by_building", (building_name,))
+            else:
+                cur.execute(
+                    sql.SQL("SELECT {}, url FROM apts WHERE building_name = %s").format(columns_sql(cols)), (building_name,)
+                )
             df_apt_scraping_info = pd.DataFrame(cur.fetchall())
             return df_apt_scraping_info
 
-    def batch_upsert_floor_plans(self, df: pd.DataFrame):
-        """Upsert (update and insert) floor plans table using a given df."""
-        cursor = self.conn.cursor()
-        columns = df.columns.to_list()
+    def batch_upsert_floor_plans(
+        self, df: pd.DataFrame, unit_cache: UnitHashCache = None, apt_id: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Upsert (update and insert) floor plans table using a given df of a single building.
+        With a unit_cache, only changed units are sent (see upsert_changed_floor_plans).
+        apt_id is the building the df was scraped for, so its units are marked unavailable even if the df is empty.
+        """
+        apt_ids = None if apt_id is None else [apt_id]
+        if unit_cache is not None:
+            counts = self.upsert_changed_floor_plans([df], unit_cache, apt_ids=apt_ids)
+        else:
+            counts = self.bulk_upsert_floor_plans([df], apt_ids=apt_ids)
+        print(f"Processed {len(df)} rows of data for apt_id {apt_id if apt_id is not None else df['apt_id'].unique()}.")
+        print(
+            f"Inserted {counts['inserted'].sum()}, updated {counts['updated'].sum()} and "
+            f"marked {counts['removed'].sum()} rows unavailable in the floor_plans table."
+        )
+        return counts
+
+    def bulk_upsert_floor_plans(
+        self,
+        dfs: Iterable[pd.DataFrame],
+        removed_units: pd.DataFrame = None,
+        apt_ids: Optional[Iterable[int]] = None,
+    ) -> pd.DataFrame:
+        """
+        Upsert the floor plans of many buildings at once. Every df is streamed into a temp staging table with COPY,
+        then one statement inserts new units, updates changed units and marks units missing from the scrape as unavailable.
+        New units, price changes and removed units are recorded in floor_plan_events in the same statement.
+        apt_ids are the buildings that were scraped, on top of the apt_ids in the dfs: a building that scraped no units
+        has an empty df, so only this way are its units marked unavailable.
+        Units whose rows were dropped from a df for not fitting its schema (see unit_records.dropped_unit_numbers) are
+        left as they are rather than marked unavailable.
+        With removed_units (a df of apt_id and unit_number), the dfs only hold changed units (see upsert_changed_floor_plans),
+        so exactly those units are marked unavailable instead of every unit missing from the dfs.
+        All non empty dfs must have the same columns. Returns a df with the inserted, updated and removed row counts
+        per apt_id, with a row for every scraped building.
+        """
+        import pandas as pd
+
+        from unit_records import dropped_unit_numbers
+
+        scraped_apt_ids = {int(apt_id) for apt_id in apt_ids or []}
+        unread_apt_ids, unread_unit_numbers = [], []
+        # An empty df may not even have columns (e.g. a page without a table), and has no units to copy.
+        dfs = (df for df in dfs if not df.empty)
+        first_df = next(dfs, None)
+        if first_df is None and not scraped_apt_ids:
+            return pd.DataFrame(columns=["apt_id", "inserted", "updated", "removed"])
+        columns = first_df.columns.to_list() if first_df is not None else list(FLOOR_PLANS_REQUIRED_COLUMNS)
 
         # Ensure all required columns are in the DataFrame
-        # TODO: Validate this can handle cases where df has floor_plan_type col (it should work lol)
-        columns_check = [
-            "apt_id",
-            "unit_number",
-            "sq_ft",
-            "bedrooms",
-            "bathrooms",
-            "price",
-            "date_available",
-        ]
-        missing_columns = set(columns_check) - set(df.columns)
+        missing_columns = set(FLOOR_PLANS_REQUIRED_COLUMNS) - set(columns)
         if missing_columns:
             raise ValueError(f"Missing columns in DataFrame: {missing_columns}")
 
-        # Prepare the data
-        data_to_upsert = [
-            tuple(row[col_name] for col_name in columns) for _, row in df.iterrows()
-        ]
-
-        # Prepare the SQL for each column
-        column_updates = [
-            sql.SQL(
-                "{0} = CASE WHEN EXCLUDED.{0} IS DISTINCT FROM floor_plans.{0} THEN EXCLUDED.{0} ELSE floor_plans.{0} END"
-            ).format(sql.Identifier(col))
-            for col in columns
-            if col not in ["apt_id", "unit_number"]
-        ]
-
-        # Construct the SQL query
-        insert_clause = sql.SQL("INSERT INTO floor_plans ({}) VALUES %s").format(
-            sql.SQL(", ").join(map(sql.Identifier, columns))
-        )
-
-        update_clause = sql.SQL(
-            "ON CONFLICT (apt_id, unit_number) DO UPDATE SET {}"
-        ).format(sql.SQL(", ").join(column_updates))
-
-        where_clause = sql.SQL("WHERE {}").format(
-            sql.SQL(" OR ").join(
-                sql.SQL("EXCLUDED.{0} IS DISTINCT FROM floor_plans.{0}").format(
-                    sql.Identifier(col)
+        columns_sql = sql.SQL(", ").join(map(sql.Identifier, columns))
+        updatable_columns = [col for col in columns if col not in ["apt_id", "unit_number"]]
+        create_staging_query = sql.SQL(
+            "CREATE TEMP TABLE floor_plans_staging ON COMMIT DROP AS SELECT {} FROM floor_plans WITH NO DATA"
+        ).format(columns_sql)
+        copy_query = sql.SQL("COPY floor_plans_staging ({}) FROM STDIN WITH (FORMAT csv)").format(columns_sql)
+
+        if removed_units is None:
+            removed_query = sql.SQL(
+                """
+                UPDATE floor_plans
+                SET availability_status = FALSE
+                WHERE apt_id = ANY(%(apt_ids)s::integer[])
+                AND availability_status IS DISTINCT FROM FALSE
+                AND NOT EXISTS (
+                    SELECT 1 FROM floor_plans_staging s
+                    WHERE s.apt_id = floor_plans.apt_id AND s.unit_number = floor_plans.unit_number
+                )
+                AND (apt_id, unit_number) NOT IN (
+                    SELECT * FROM UNNEST(%(unread_apt_ids)s::integer[], %(unread_unit_numbers)s::text[])
                 )
-                for col in columns
-                if col not in ["apt_id", "unit_number"]
+                RETURNING apt_id, unit_number, bedrooms, bathrooms, sq_ft, price
+                """
             )
+        else:
+            removed_query = sql.SQL(
+                """
+                UPDATE floor_plans
+                SET availability_status = FALSE
+                FROM floor_plans_removed_staging r
+                WHERE floor_plans.apt_id = r.apt_id AND floor_plans.unit_number = r.unit_number
+                AND floor_plans.availability_status IS DISTINCT FROM FALSE
+                RETURNING floor_plans.apt_id, floor_plans.unit_number, floor_plans.bedrooms, floor_plans.bathrooms,
+                    floor_plans.sq_ft, floor_plans.price
+                """
+            )
+            scraped_apt_ids.update(int(apt_id) for apt_id in removed_units["apt_id"].unique())
+
+        # All data-modifying CTEs see the same snapshot (so previous holds the values from before this statement),
+        # and upserted/removed touch disjoint rows. Every change is also appended to floor_plan_events.
+        merge_query = sql.SQL(
+            """
+            WITH previous AS (
+                SELECT fp.apt_id, fp.unit_number, fp.price, fp.availability_status
+                FROM floor_plans fp
+                JOIN floor_plans_staging s ON s.apt_id = fp.apt_id AND s.unit_number = fp.unit_number
+            ),
+            upserted AS (
+                INSERT INTO floor_plans ({columns})
+                SELECT DISTINCT ON (apt_id, unit_number) {columns} FROM floor_plans_staging
+                ON CONFLICT (apt_id, unit_number) DO UPDATE SET {updates}, availability_status = TRUE
+                WHERE {changed} OR floor_plans.availability_status IS DISTINCT FROM TRUE
+                RETURNING apt_id, unit_number, bedrooms, bathrooms, sq_ft, price, (xmax = 0) AS inserted
+            ),
+            removed AS ({removed}),
+            events AS (
+                INSERT INTO floor_plan_events (apt_id, unit_number, event_type, bedrooms, bathrooms, sq_ft, price, previous_price)
+                SELECT
+                    u.apt_id, u.unit_number,
+                    CASE WHEN u.inserted OR p.availability_status IS FALSE THEN 'new_unit' ELSE 'price_change' END,
+                    u.bedrooms, u.bathrooms, u.sq_ft, u.price, p.price
+                FROM upserted u
+                LEFT JOIN previous p ON p.apt_id = u.apt_id AND p.unit_number = u.unit_number
+                WHERE u.inserted OR p.availability_status IS FALSE OR u.price IS DISTINCT FROM p.price
+                UNION ALL
+                SELECT apt_id, unit_number, 'unit_removed', bedrooms, bathrooms, sq_ft, price, price FROM removed
+            ),
+            counts AS (
+                SELECT apt_id, COUNT(*) FILTER (WHERE inserted) AS inserted, COUNT(*) FILTER (WHERE NOT inserted) AS updated, 0 AS removed
+                FROM upserted GROUP BY apt_id
+                UNION ALL
+                SELECT apt_id, 0, 0, COUNT(*) FROM removed GROUP BY apt_id
+                UNION ALL
+                SELECT UNNEST(%(apt_ids)s::integer[]), 0, 0, 0
+            )
+            SELECT apt_id, SUM(inserted)::int AS inserted, SUM(updated)::int AS updated, SUM(removed)::int AS removed
+            FROM counts GROUP BY apt_id ORDER BY apt_id
+            """
+        ).format(
+            columns=columns_sql,
+            removed=removed_query,
+            updates=sql.SQL(", ").join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col)) for col in updatable_columns
+            ),
+            changed=sql.SQL(" OR ").join(
+                sql.SQL("EXCLUDED.{0} IS DISTINCT FROM floor_plans.{0}").format(sql.Identifier(col))
+                for col in updatable_columns
+            ),
         )
 
-        upsert_query = sql.SQL("{} {} {}").format(
-            insert_clause, update_clause, where_clause
-        )
-
-        execute_values(cursor, upsert_query, data_to_upsert)
-
-        # Get all current unit numbers for this apartment
-        apt_id = int(df['apt_id'].iloc[0])  # Assumes all data in df is from the same apt_id
-        cursor.execute("SELECT unit_number FROM floor_plans WHERE apt_id = %s", (apt_id,))
-        current_units = set(row[0] for row in cursor.fetchall())
-    
-        # Identify units that are no longer available
-        scraped_units = set(df['unit_number'])
-        units_removed = current_units - scraped_units
-
-        # Mark units as unavailable if they're no longer in the scraped data
-        if units_removed:
-            update_query = sql.SQL("""
-                UPDATE floor_plans 
-                SET availability_status = FALSE 
-                WHERE apt_id = %s AND unit_number = ANY(%s)
-            """)
-            cursor.execute(update_query, (apt_id, list(units_removed)))
-
-        # TODO: Fix inconsistencies/inaccuracies with rowcount. Claude suggesting CTE.
-        rows_upserted = cursor.rowcount
-        self.conn.commit()
-        cursor.close()
-        print(
-            f"Processed {len(data_to_upsert)} rows of data for apt_id {df['apt_id'].unique()}."
-        )
-        print(f"Actually upserted {rows_upserted} rows in the floor_plans table.")
+        with self.connection() as conn:
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(create_staging_query)
+                    copy_query_str = copy_query.as_string(cur)
+                    for df in itertools.chain([first_df] if first_df is not None else [], dfs):
+                        if set(df.columns) != set(columns):
+                            raise ValueError(f"All DataFrames must have the same columns. Expected {columns}, got {df.columns.to_list()}")
+                        scraped_apt_ids.update(int(apt_id) for apt_id in df["apt_id"].unique())
+                        unit_numbers = dropped_unit_numbers(df)
+                        unread_apt_ids += [int(df["apt_id"].iat[0])] * len(unit_numbers)
+                        unread_unit_numbers += unit_numbers
+                        buffer = StringIO()
+                        df[columns].to_csv(buffer, index=False, header=False)
+                        buffer.seek(0)
+                        cur.copy_expert(copy_query_str, buffer)
+                    if removed_units is not None:
+                        cur.execute(
+                            "CREATE TEMP TABLE floor_plans_removed_staging (apt_id INTEGER, unit_number TEXT) ON COMMIT DROP"
+                        )
+                        buffer = StringIO()
+                        removed_units[["apt_id", "unit_number"]].to_csv(buffer, index=False, header=False)
+                        buffer.seek(0)
+                        cur.copy_expert("COPY floor_plans_removed_staging (apt_id, unit_number) FROM STDIN WITH (FORMAT csv)", buffer)
+                    # psycopg2 sends lists as ARRAYs.
+                    cur.execute(
+                        merge_query,
+                        {
+                            "apt_ids": sorted(scraped_apt_ids),
+                            "unread_apt_ids": unread_apt_ids,
+                            "unread_unit_numbers": unread_unit_numbers,
+                        },
+                    )
+                    counts = pd.DataFrame(cur.fetchall(), columns=["apt_id", "inserted", "updated", "removed"])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return counts
+
+    def upsert_changed_floor_plans(
+        self, dfs: List[pd.DataFrame], unit_cache: UnitHashCache, apt_ids: Optional[List[int]] = None
+    ) -> pd.DataFrame:
+        """
+        Same as bulk_upsert_floor_plans (one df per building), but only units that changed since the last write
+        according to unit_cache are sent to the DB, and removed units are marked unavailable by unit number.
+        Buildings the cache doesn't know get the full upsert. Nothing is sent if no unit changed.
+        apt_ids holds the building of each df, which an empty df can't tell.
+        """
+        import pandas as pd
+
+        diffs = [unit_cache.diff(df, apt_id) for df, apt_id in zip(dfs, apt_ids or [None] * len(dfs))]
+        full = [d for d in diffs if d.full]
+        incremental = [d for d in diffs if not d.full and not d.is_empty]
+        counts = []
+        if full:
+            counts.append(
+                self.bulk_upsert_floor_plans((d.changed for d in full), apt_ids=[d.apt_id for d in full if d.apt_id is not None])
+            )
+            for d in full:
+                unit_cache.commit(d)
+        if incremental:
+            removed_units = pd.DataFrame(
+                {
+                    "apt_id": [d.apt_id for d in incremental for _ in d.removed],
+                    "unit_number": [u for d in incremental for u in d.removed],
+                },
+                columns=["apt_id", "unit_number"],
+            )
+            counts.append(
+                self.bulk_upsert_floor_plans(
+                    (d.changed for d in incremental), removed_units=removed_units, apt_ids=[d.apt_id for d in incremental]
+                )
+            )
+            for d in incremental:
+                unit_cache.commit(d)
+        unchanged_apt_ids = [d.apt_id for d in diffs if d.is_empty]
+        counts.append(pd.DataFrame({"apt_id": unchanged_apt_ids, "inserted": 0, "updated": 0, "removed": 0}))
+        return pd.concat(counts, ignore_index=True)
+
+    def stream_upsert_floor_plans(
+        self, apt_id: int, chunks: Iterable[pd.DataFrame], unit_cache: UnitHashCache = None
+    ) -> pd.DataFrame:
+        """
+        Upsert one building whose units arrive in chunks (see apt_webscraper.stream_scraped_data). Chunks that aren't
+        already in a ChunkSpool are read into one first, so no connection is held while the page is read. Each chunk is
+        then copied into the staging table and the merge runs once at the end, so units of later chunks aren't marked
+        unavailable. The building is dropped from unit_cache, since its units are never all hashed at once.
+        """
+        spool = chunks if isinstance(chunks, ChunkSpool) else spool_chunks(chunks)
+
+        def tagged_chunks():
+            for df in spool:
+                df["apt_id"] = apt_id
+                yield df
+
+        if unit_cache is not None:
+            unit_cache.invalidate(int(apt_id))
+        try:
+            return self.bulk_upsert_floor_plans(tagged_chunks(), apt_ids=[apt_id])
+        finally:
+            if spool is not chunks:
+                spool.close()
 
     # TODO: modify this to work with a building_name arg
     def get_config_by_url(self, url):
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM apts WHERE url = %s", (url,))
+        if self._scraping_config is not None:
+            return self._scraping_config["by_url"].get(url)
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            self._execute_prepared(conn, cur, "apt_config_by_url", (url,))
             return cur.fetchone()
 
+    def set_json_endpoint(self, apt_id: int, json_endpoint: Optional[Dict]):
+        """Store (or with None, clear) the JSON endpoint a building's floor plans are fetched from."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE apts SET json_endpoint = %s WHERE id = %s",
+                    (Json(json_endpoint) if json_endpoint is not None else None, apt_id),
+                )
+            conn.commit()
+        self._scraping_config = None
+
     def add_config(self, url, building_name, scraper_function):
-        with self.conn.cursor() as cur:
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO scraping_config (url, building_name, scraper_function) VALUES (%s, %s, %s)",
+                    (url, building_name, scraper_function),
+                )
+            conn.commit()
+
+    def update_config(self, id, url, building_name, scraper_function):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE scraping_config SET url = %s, building_name = %s, scraper_function = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (url, building_name, scraper_function, id),
+                )
+            conn.commit()
+
+    def _listings_query(self, listing_filter: ListingFilter, order_by: str, limit: Optional[int]) -> tuple:
+        if order_by not in LISTING_COLUMNS:
+            raise ValueError(f"Can't order listings by {order_by!r}. Expected one of {LISTING_COLUMNS}")
+        where, params = listing_filter.where_sql()
+        query = sql.SQL(
+            """
+            SELECT a.building_name, fp.apt_id, fp.unit_number, fp.bedrooms::FLOAT8 AS bedrooms,
+                fp.bathrooms::FLOAT8 AS bathrooms, fp.sq_ft, fp.floor_plan_type, fp.price, fp.date_available,
+                fp.availability_status
+            FROM floor_plans fp
+            JOIN apts a ON a.id = fp.apt_id
+            WHERE {where}
+            ORDER BY {order_by}, fp.apt_id, fp.unit_number
+            """
+        ).format(where=where, order_by=sql.Identifier(order_by))
+        if limit is not None:
+            query = query + sql.SQL(" LIMIT %s")
+            params.append(limit)
+        return query, params
+
+    def iter_listings(
+        self,
+        listing_filter: ListingFilter = None,
+        order_by: str = "price",
+        limit: Optional[int] = None,
+        chunk_rows: int = LISTING_CHUNK_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Stream the listings matching a filter as dfs of up to chunk_rows rows, from a server-side cursor, so memory
+        stays bounded however many rows match.
+        The iterator holds a DB connection (with a single connection, its lock) until it is exhausted or closed, so
+        wrap it in contextlib.closing() unless it is always read to the end, and don't use this config manager's
+        connections while iterating: another call waits for the connection, and with a single connection that is a
+        deadlock.
+        """
+        import pandas as pd
+
+        query, params = self._listings_query(listing_filter or ListingFilter(), order_by, limit)
+        with self.connection() as conn:
+            try:
+                # Named cursors are server-side: rows are only sent as they are fetched.
+                with conn.cursor(name=f"listings_{uuid.uuid4().hex}") as cur:
+                    cur.itersize = chunk_rows
+                    cur.execute(query, params)
+                    while True:
+                        rows = cur.fetchmany(chunk_rows)
+                        if not rows:
+                            break
+                        yield pd.DataFrame(rows, columns=LISTING_COLUMNS)
+            finally:
+                conn.rollback()
+
+    def search_listings(
+        self, listing_filter: ListingFilter = None, order_by: str = "price", limit: Optional[int] = 1000
+    ) -> pd.DataFrame:
+        """Listings matching a filter, cheapest first by default, e.g. search_listings(ListingFilter(min_bedrooms=2, max_price=3500))."""
+        import pandas as pd
+
+        with closing(self.iter_listings(listing_filter, order_by=order_by, limit=limit)) as listings:
+            chunks = list(listings)
+        if not chunks:
+            return pd.DataFrame(columns=LISTING_COLUMNS)
+        return pd.concat(chunks, ignore_index=True)
+
+    def get_building_listing_stats(self, building_name: Optional[str] = None) -> pd.DataFrame:
+        """Available units and price stats per building and bedroom count, as of the last refresh_listing_stats."""
+        import pandas as pd
+
+        with self.connection() as conn, conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO scraping_config (url, building_name, scraper_function) VALUES (%s, %s, %s)",
-                (url, building_name, scraper_function),
+                """
+                SELECT building_name, apt_id, bedrooms, available_units, min_price, avg_price, max_price, price_per_sq_ft
+                FROM building_listing_stats
+                WHERE %s::text IS NULL OR building_name = %s
+                ORDER BY building_name, bedrooms
+                """,
+                (building_name, building_name),
             )
-        self.conn.commit()
+            return pd.DataFrame(cur.fetchall(), columns=[c.name for c in cur.description])
 
-    def update_config(self, id, url, building_name, scraper_function):
-        with self.conn.cursor() as cur:
+    def get_building_daily_events(self, building_name: Optional[str] = None, days: int = 90) -> pd.DataFrame:
+        """New units, removed units and price changes per building and day, as of the last refresh_listing_stats."""
+        import pandas as pd
+
+        with self.connection() as conn, conn.cursor() as cur:
             cur.execute(
-                "UPDATE scraping_config SET url = %s, building_name = %s, scraper_function = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                (url, building_name, scraper_function, id),
+                """
+                SELECT a.building_name, d.apt_id, d.day, d.new_units, d.removed_units, d.price_changes, d.avg_price_change
+                FROM building_daily_events d
+                JOIN apts a ON a.id = d.apt_id
+                WHERE (%s::text IS NULL OR a.building_name = %s)
+                AND d.day >= CURRENT_DATE - %s
+                ORDER BY d.day DESC, a.building_name
+                """,
+                (building_name, building_name, days),
             )
-        self.conn.commit()
+            return pd.DataFrame(cur.fetchall(), columns=[c.name for c in cur.description])
+
+    def refresh_listing_stats(self):
+        """
+        Recompute the per building aggregate views, concurrently, so dashboards can keep reading the old ones meanwhile.
+        Then update building_daily_events with the events written since the last refresh (see
+        migrations/006_incremental_daily_events.sql), recomputing only the building days they fall on.
+        """
+        with self.connection() as conn:
+            # REFRESH ... CONCURRENTLY can't run inside a transaction block.
+            autocommit = conn.autocommit
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    for view in LISTING_STATS_VIEWS:
+                        cur.execute(sql.SQL("REFRESH MATERIALIZED VIEW CONCURRENTLY {}").format(sql.Identifier(view)))
+            finally:
+                conn.autocommit = autocommit
+            try:
+                with conn.cursor() as cur:
+                    # Locks the cursor, so concurrent refreshes take turns.
+                    cur.execute(
+                        """
+                        SELECT daily_events_xid, pg_snapshot_xmin(pg_current_snapshot())
+                        FROM listing_stats_state
+                        FOR UPDATE
+                        """
+                    )
+                    last_xid, xmin = cur.fetchone()
+                    # Every transaction below the xmin has committed or aborted, so no event below it can still appear.
+                    cur.execute(
+                        """
+                        WITH touched AS (
+                            SELECT DISTINCT apt_id, (created_at AT TIME ZONE 'UTC')::DATE AS day
+                            FROM floor_plan_events
+                            WHERE xid >= %(last_xid)s::xid8 AND xid < %(xmin)s::xid8
+                        )
+                        INSERT INTO building_daily_events
+                        SELECT
+                            t.apt_id,
+                            t.day,
+                            COUNT(*) FILTER (WHERE e.event_type = 'new_unit'),
+                            COUNT(*) FILTER (WHERE e.event_type = 'unit_removed'),
+                            COUNT(*) FILTER (WHERE e.event_type = 'price_change'),
+                            (AVG(e.price - e.previous_price) FILTER (WHERE e.event_type = 'price_change'))::FLOAT8
+                        FROM touched t
+                        JOIN floor_plan_events e
+                            ON e.apt_id = t.apt_id
+                            AND e.created_at >= t.day::TIMESTAMP AT TIME ZONE 'UTC'
+                            AND e.created_at < (t.day + 1)::TIMESTAMP AT TIME ZONE 'UTC'
+                            AND e.xid < %(xmin)s::xid8
+                        GROUP BY t.apt_id, t.day
+                        ON CONFLICT (apt_id, day) DO UPDATE SET
+                            new_units = EXCLUDED.new_units,
+                            removed_units = EXCLUDED.removed_units,
+                            price_changes = EXCLUDED.price_changes,
+                            avg_price_change = EXCLUDED.avg_price_change
+                        """,
+                        {"last_xid": last_xid, "xmin": xmin},
+                    )
+                    cur.execute(
+                        "UPDATE listing_stats_state SET daily_events_xid = %s::xid8 WHERE daily_events_xid < %s::xid8",
+                        (xmin, xmin),
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def add_building(self, building_name: str, url: str, div_id: Optional[str] = None) -> int:
+        """Add a building's website to the apts table, so sweeps start scraping it. Returns its apt_id."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO apts (building_name, url, div_id) VALUES (%s, %s, %s) RETURNING id",
+                    (building_name, url, div_id),
+                )
+                apt_id = cur.fetchone()[0]
+            conn.commit()
+        self._scraping_config = None
+        return apt_id
+
+    def get_floor_plan_history(
+        self, building_name: str, unit_number: Optional[str] = None, days: int = 30, limit: int = 100
+    ) -> List[Dict]:
+        """Newest floor_plan_events of a building (optionally a single unit) from the last `days` days."""
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT e.created_at, e.unit_number, e.event_type, e.bedrooms, e.bathrooms, e.sq_ft, e.price, e.previous_price
+                FROM floor_plan_events e
+                JOIN apts a ON a.id = e.apt_id
+                WHERE a.building_name = %s
+                AND (%s::text IS NULL OR e.unit_number = %s)
+                AND e.created_at >= CURRENT_TIMESTAMP - make_interval(days => %s)
+                ORDER BY e.id DESC
+                LIMIT %s
+                """,
+                (building_name, unit_number, unit_number, days, limit),
+            )
+            return cur.fetchall()
 
-def scrape_all_buildings_in_db():
+
+def raise_if_replaying(archive):
+    """Sweeps that write to the database must not run on replayed pages, see replay_all_buildings_in_db."""
+    if archive is not None and archive.replaying:
+        raise RuntimeError("The page archive is replaying: use replay_all_buildings_in_db, which doesn't write anything")
+
+
+def scrape_all_buildings_in_db(config_manager: DBConfigManager):
     """Scrape all of the building_names in the apts table and upsert the data into the floor_plans table."""
-    buildings = config_manager.select_cols_from_table(table="apts", cols_list="building_name")
-    buildings_list = [list(b.values())[0] for b in buildings]
+    from apt_webscraper import given_url_get_latest_scraped_data, is_streamed, stream_scraped_data
+    from metrics import PipelineMetrics, collect_timings, print_stage_summary, timed
+    from page_archive import get_page_archive
+    from unit_hash_cache import UnitHashCache
+
+    archive = get_page_archive()
+    raise_if_replaying(archive)
+    buildings = config_manager.load_scraping_config()
+    if archive is not None:
+        archive.register_buildings(buildings)
+    buildings_list = [b["building_name"] for b in buildings]
+    metrics = PipelineMetrics()
+    unit_cache = UnitHashCache()
     for b in buildings_list:
         scraping_info = config_manager.get_apt_scraping_info_given_building(b)
         apt_id = scraping_info["id"].iloc[0]
         apt_url = scraping_info["url"].iloc[0]
         apt_div_id = scraping_info["div_id"].iloc[0]
-
-        latest_b_df = given_url_get_latest_scraped_data(
-            url=apt_url, div_id=apt_div_id
-        )
-        latest_b_df["apt_id"] = apt_id
-        config_manager.batch_upsert_floor_plans(latest_b_df)
+        apt_json_endpoint = scraping_info["json_endpoint"].iloc[0]
+
+        with collect_timings() as timings:
+            try:
+                if is_streamed(apt_url, apt_json_endpoint):
+                    counts = config_manager.stream_upsert_floor_plans(
+                        apt_id, stream_scraped_data(apt_url, apt_div_id), unit_cache=unit_cache
+                    )
+                    print(
+                        f"Streamed {b}: inserted {counts['inserted'].sum()}, updated {counts['updated'].sum()} and "
+                        f"marked {counts['removed'].sum()} rows unavailable in the floor_plans table."
+                    )
+                    continue
+                latest_b_df = given_url_get_latest_scraped_data(
+                    url=apt_url, div_id=apt_div_id, json_endpoint=apt_json_endpoint
+                )
+                latest_b_df["apt_id"] = apt_id
+                with timed("upsert") as record:
+                    config_manager.batch_upsert_floor_plans(latest_b_df, unit_cache=unit_cache, apt_id=apt_id)
+                    record.rows = len(latest_b_df)
+            finally:
+                metrics.merge(b, timings)
+    unit_cache.close()
+    print_stage_summary(metrics)
     print(f"Scraped and upserted {len(buildings_list)}, including: {", ".join(buildings_list)}")
 
 
-if __name__ == "__main__":
+def scrape_all_buildings_in_db_concurrently(config_manager: DBConfigManager, workers: int = 1):
+    """
+    Same as scrape_all_buildings_in_db, but fetches/parses buildings concurrently so one slow website doesn't hold up the sweep.
+    With more than one worker, the apts table is split into shards that are scraped in that many processes.
+    """
+    from async_scraper import run_concurrent_sweep
+    from http_cache import ResponseCache
+    from metrics import PipelineMetrics, print_stage_summary
+    from sharded_sweep import run_sharded_sweep
+    from snapshot_store import SnapshotStore
+    from page_archive import get_page_archive
+    from unit_hash_cache import UnitHashCache
+
+    raise_if_replaying(get_page_archive())
+    buildings = config_manager.load_scraping_config()
+    cache = ResponseCache()
+    unit_cache = UnitHashCache()
+    metrics = PipelineMetrics()
     try:
-        conn = psycopg2.connect(**db_params)
-        config_manager = DBConfigManager(conn)
+        if workers > 1:
+            results = run_sharded_sweep(
+                config_manager,
+                buildings,
+                db_params,
+                workers=workers,
+                cache=cache,
+                snapshot_store=SnapshotStore(),
+                metrics=metrics,
+                unit_cache=unit_cache,
+            )
+        else:
+            results = run_concurrent_sweep(
+                config_manager, buildings, cache=cache, snapshot_store=SnapshotStore(), metrics=metrics, unit_cache=unit_cache
+            )
+    finally:
+        cache.close()
+        unit_cache.close()
+    failed = [r for r in results if r.error]
+    unchanged = [r for r in results if r.unchanged]
+    print(
+        f"Scraped and upserted {len(results) - len(failed) - len(unchanged)} of {len(results)} buildings "
+        f"({len(unchanged)} unchanged since the last sweep)."
+    )
+    print(
+        f"Inserted {sum(r.inserted for r in results)}, updated {sum(r.updated for r in results)} and "
+        f"marked {sum(r.removed for r in results)} units unavailable."
+    )
+    for r in failed:
+        print(f"Failed to scrape {r.building_name}: {r.error}")
+    print_stage_summary(metrics)
+
+
+def replay_all_buildings_in_db(config_manager: DBConfigManager):
+    """
+    Sweep every building in the apts table from the page archive (which must be replaying, see page_archive.py) and
+    print what each one parsed to. Nothing is written: the replayed pages are old, so upserting them would roll
+    floor_plans back, add events (and alerts) for the rollback and leave the caches out of step with the websites.
+    To write replayed pages to the snapshot store as of when they were recorded, use `cli.py reparse --snapshots`.
+    """
+    from async_scraper import run_concurrent_sweep
+    from metrics import PipelineMetrics, print_stage_summary
+    from page_archive import get_page_archive
+
+    archive = get_page_archive()
+    if archive is None or not archive.replaying:
+        raise RuntimeError("Replaying a sweep needs the page archive in replay mode, see configure_page_archive")
+    buildings = config_manager.load_scraping_config()
+    metrics = PipelineMetrics()
+    results = run_concurrent_sweep(config_manager, buildings, metrics=metrics, metrics_textfile_path=None, defer_upserts=True)
+    failed = [r for r in results if r.error]
+    for r in results:
+        if not r.error:
+            print(f"Replayed {r.building_name}: {r.rows} units")
+    for r in failed:
+        print(f"Failed to replay {r.building_name}: {r.error}")
+    print(
+        f"Replayed {len(results) - len(failed)} of {len(results)} buildings from the page archive "
+        f"({sum(r.rows for r in results)} units). Nothing was written to the database or the caches."
+    )
+    print_stage_summary(metrics)
 
-        # Start with building name -> scrape -> upsert [DONE]
-        scrape_all_buildings_in_db()
 
-    except psycopg2.Error as e:
-        print(f"Error connecting to the database: {e}")
+if __name__ == "__main__":
+    # Kept for existing cron jobs: same as `python cli.py sweep`.
+    from cli import main
 
-    finally:
-        # Close the connection when done
-        if "config_manager" in locals():
-            config_manager.close_connection()
+    main(["sweep", *sys.argv[1:]])
@@ -0,0 +1,167 @@
+"""
+Per building cache of what was last written to floor_plans, so only changed units are sent to the DB.
+
+For each apt_id it keeps one 64 bit hash per unit (of every column except apt_id and unit_number), in memory and in a
+local SQLite file so it survives restarts. A scraped df is diffed against it with vectorized comparisons: new units
+and units whose hash changed are upserted, units missing from the df are marked unavailable by unit number, and
+unchanged units never leave the process. A building without an entry (first scrape, or an entry older than
+max_age_seconds) gets the full upsert instead, which also resyncs the cache with the DB. Entries are only updated
+after the DB write committed (commit()), so a failed upsert is retried in full next time.
+"""
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from unit_records import dropped_unit_numbers
+
+
+UNIT_HASH_CACHE_DIR = os.getenv("UNIT_HASH_CACHE_DIR", ".unit_hash_cache")
+# Full upsert at least this often per building, in case the DB was changed by something other than this cache's owner.
+UNIT_HASH_MAX_AGE_SECONDS = 24 * 60 * 60
+KEY_COLUMNS = ["apt_id", "unit_number"]
+
+
+def hash_unit_rows(df: pd.DataFrame) -> pd.Series:
+    """One hash per unit, indexed by unit_number. Numbers are hashed as float64, so int and float scrapes agree."""
+    if df.empty:
+        # A page without units may not even have the columns.
+        return pd.Series([], dtype=np.uint64, index=pd.Index([], dtype=object, name="unit_number"))
+    value_columns = sorted(c for c in df.columns if c not in KEY_COLUMNS)
+    values = pd.DataFrame(
+        {
+            c: df[c].astype("float64") if pd.api.types.is_numeric_dtype(df[c]) else df[c].astype("string")
+            for c in value_columns
+        },
+        index=df.index,
+    )
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    # The upsert keeps the first row of a duplicated unit (DISTINCT ON), so the cache does too.
+    unit_numbers = df["unit_number"].astype(str).to_numpy()
+    _, first = np.unique(unit_numbers, return_index=True)
+    first.sort()
+    return pd.Series(hashes[first], index=pd.Index(unit_numbers[first], name="unit_number"))
+
+
+@dataclass
+class UnitDiff:
+    apt_id: int
+    # Rows to upsert: every row if full, else only new and changed units.
+    changed: pd.DataFrame
+    # Units to mark unavailable (only when not full; a full upsert finds them itself).
+    removed: pd.Series = field(default_factory=lambda: pd.Series([], dtype=object))
+    # No cache entry to diff against, so the whole df goes through the full upsert.
+    full: bool = False
+    unchanged: int = 0
+    hashes: Optional[pd.Series] = None
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.full and self.changed.empty and self.removed.empty
+
+
+class UnitHashCache:
+    def __init__(self, cache_dir: str = UNIT_HASH_CACHE_DIR, max_age_seconds: float = UNIT_HASH_MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[float, pd.Series]] = {}
+        self._db = sqlite3.connect(os.path.join(cache_dir, "unit_hashes.sqlite3"), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS synced_buildings (apt_id INTEGER PRIMARY KEY, synced_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS unit_hashes (
+                apt_id INTEGER NOT NULL,
+                unit_number TEXT NOT NULL,
+                row_hash INTEGER NOT NULL,
+                PRIMARY KEY (apt_id, unit_number)
+            );
+            """
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _get_entry(self, apt_id: int) -> Optional[Tuple[float, pd.Series]]:
+        """The building's (synced_at, hashes), from memory or else from disk. Caller must hold the lock."""
+        if apt_id not in self._entries:
+            synced = self._db.execute("SELECT synced_at FROM synced_buildings WHERE apt_id = ?", (apt_id,)).fetchone()
+            if synced is None:
+                return None
+            rows = self._db.execute("SELECT unit_number, row_hash FROM unit_hashes WHERE apt_id = ?", (apt_id,)).fetchall()
+            unit_numbers = [r[0] for r in rows]
+            # SQLite integers are signed, hashes are stored as their int64 view.
+            hashes = np.array([r[1] for r in rows], dtype=np.int64).view(np.uint64)
+            self._entries[apt_id] = (synced[0], pd.Series(hashes, index=pd.Index(unit_numbers, dtype=object, name="unit_number")))
+        return self._entries[apt_id]
+
+    def diff(self, df: pd.DataFrame, apt_id: Optional[int] = None) -> UnitDiff:
+        """
+        Diff one building's scraped df (with an apt_id column) against what was last written for it. Pass apt_id for
+        a df that may be empty, so the building's units are diffed as removed instead of the df being skipped.
+        """
+        if apt_id is None:
+            apt_id = int(df["apt_id"].iloc[0]) if len(df) else None
+        else:
+            apt_id = int(apt_id)
+        hashes = hash_unit_rows(df)
+        with self._lock:
+            entry = self._get_entry(apt_id) if apt_id is not None else None
+        if entry is None or time.time() - entry[0] > self.max_age_seconds:
+            return UnitDiff(apt_id=apt_id, changed=df, full=True, hashes=hashes)
+
+        previous = entry[1]
+        positions = previous.index.get_indexer(hashes.index)
+        is_new = positions < 0
+        changed_units = is_new.copy()
+        changed_units[~is_new] = previous.to_numpy()[positions[~is_new]] != hashes.to_numpy()[~is_new]
+        changed_unit_numbers = hashes.index[changed_units]
+        missing = ~previous.index.isin(hashes.index)
+        # Units whose rows didn't fit the schema weren't read, so they aren't removed and keep their last hash.
+        unread = missing & previous.index.isin(dropped_unit_numbers(df))
+        removed = previous.index[missing & ~unread]
+        return UnitDiff(
+            apt_id=apt_id,
+            changed=df[df["unit_number"].astype(str).isin(changed_unit_numbers)] if len(df) else df,
+            removed=pd.Series(removed, dtype=object),
+            unchanged=len(hashes) - int(changed_units.sum()),
+            hashes=pd.concat([hashes, previous[unread]]),
+        )
+
+    def commit(self, diff: UnitDiff):
+        """Record a diff's df as written. Call only after its upsert committed."""
+        if diff.apt_id is None:
+            return
+        synced_at = time.time()
+        with self._lock:
+            if not diff.full:
+                # An incremental write doesn't resync with the DB, so the entry keeps its age.
+                entry = self._get_entry(diff.apt_id)
+                synced_at = entry[0] if entry else 0
+            self._entries[diff.apt_id] = (synced_at, diff.hashes)
+            self._db.execute("DELETE FROM unit_hashes WHERE apt_id = ?", (diff.apt_id,))
+            self._db.executemany(
+                "INSERT INTO unit_hashes (apt_id, unit_number, row_hash) VALUES (?, ?, ?)",
+                zip([diff.apt_id] * len(diff.hashes), diff.hashes.index, diff.hashes.to_numpy().view(np.int64).tolist()),
+            )
+            self._db.execute(
+                "INSERT INTO synced_buildings (apt_id, synced_at) VALUES (?, ?) "
+                "ON CONFLICT (apt_id) DO UPDATE SET synced_at = excluded.synced_at",
+                (diff.apt_id, synced_at),
+            )
+            self._db.commit()
+
+    def invalidate(self, apt_id: int):
+        """Forget a building, so its next scrape gets the full upsert."""
+        with self._lock:
+            self._entries.pop(apt_id, None)
+            self._db.execute("DELETE FROM unit_hashes WHERE apt_id = ?", (apt_id,))
+            self._db.execute("DELETE FROM synced_buildings WHERE apt_id = ?", (apt_id,))
+            self._db.commit()
@@ -0,0 +1,153 @@
+"""
+Typed, column-oriented storage for scraped units.
+
+Parsers fill preallocated numpy columns (one per column of configs/schema_config.APT_DF_SCHEMA), converting each
+value to its canonical dtype as it is set, and the df is built once from those columns: no list of tuples of
+strings and no astype afterwards. A value that can't be converted only invalidates its own row, which is reported
+as a SchemaViolation and left out of the df instead of failing the whole page. The unit numbers of those rows are
+kept with the df (see dropped_unit_numbers), so the upsert doesn't mark units it couldn't read as removed.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from configs.schema_config import APT_DF_SCHEMA
+
+
+@dataclass
+class SchemaViolation:
+    row: int
+    column: str
+    value: Any
+    error: str
+    # The unit the row was for, if its unit number could be read.
+    unit_number: Optional[str] = None
+
+
+def _storage_dtype(dtype) -> np.dtype:
+    """Strings are kept in object columns, everything else in a column of its own numpy dtype."""
+    return np.dtype(object) if dtype is str else np.dtype(dtype)
+
+
+def _convert(value, dtype):
+    if dtype is str:
+        if value is None:
+            raise ValueError("missing value")
+        return str(value)
+    if value is None or value == "":
+        raise ValueError("missing value")
+    return int(value) if np.dtype(dtype).kind in "iu" else float(value)
+
+
+class UnitRecords:
+    """Preallocated typed columns for the units of one page. Use append() per unit, then to_df() once."""
+
+    __slots__ = ("schema", "size", "columns", "valid", "violations")
+
+    def __init__(self, capacity: int, schema: Dict = APT_DF_SCHEMA):
+        capacity = max(capacity, 1)
+        self.schema = schema
+        self.size = 0
+        self.columns = {name: np.empty(capacity, dtype=_storage_dtype(dtype)) for name, dtype in schema.items()}
+        self.valid = np.ones(capacity, dtype=bool)
+        self.violations: List[SchemaViolation] = []
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _grow(self):
+        capacity = len(self.valid) * 2
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self.size] = column[: self.size]
+            self.columns[name] = grown
+        self.valid = np.concatenate([self.valid, np.ones(capacity - len(self.valid), dtype=bool)])
+
+    def append(self, **values) -> int:
+        """Convert and store one unit's values (keyed by schema column). Returns its row number."""
+        if self.size == len(self.valid):
+            self._grow()
+        row = self.size
+        for name, dtype in self.schema.items():
+            value = values.get(name)
+            try:
+                self.columns[name][row] = _convert(value, dtype)
+            except (TypeError, ValueError, OverflowError) as e:
+                self.valid[row] = False
+                unit_number = values.get("unit_number")
+                self.violations.append(
+                    SchemaViolation(row, name, value, str(e), None if unit_number is None else str(unit_number))
+                )
+        self.size += 1
+        return row
+
+    def to_df(self) -> pd.DataFrame:
+        """Build the df straight from the typed columns, leaving out rows with violations (kept in df.attrs)."""
+        columns = {name: column[: self.size] for name, column in self.columns.items()}
+        df = pd.DataFrame(columns, copy=False)
+        if self.violations:
+            df = df[self.valid[: self.size]].reset_index(drop=True)
+            df.attrs["schema_violations"] = list(self.violations)
+        return df
+
+
+def cast_rows_to_schema(df: pd.DataFrame, schema: Dict, unit_number_column: Optional[str] = None) -> pd.DataFrame:
+    """
+    Same as df.astype(schema), except that rows with values that can't be cast to a numeric column's dtype are
+    dropped and reported in df.attrs["schema_violations"], instead of failing the cast of the whole df.
+    unit_number_column is the column (before renaming) holding unit numbers, to record which units were dropped.
+    """
+    if not schema:
+        return df
+    try:
+        return df.astype(schema)
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    bad_rows = np.zeros(len(df), dtype=bool)
+    violations = list(df.attrs.get("schema_violations", []))
+    for column, dtype in schema.items():
+        kind = _storage_dtype(dtype).kind
+        if kind not in "iuf":
+            continue
+        values = df[column]
+        numeric = pd.to_numeric(values, errors="coerce")
+        # Floats can hold missing values, ints can't.
+        invalid = numeric.isna() if kind in "iu" else numeric.isna() & values.notna()
+        for row in np.flatnonzero(invalid.to_numpy()):
+            unit_number = df[unit_number_column].iat[row] if unit_number_column in df.columns else None
+            violations.append(
+                SchemaViolation(
+                    int(row),
+                    column,
+                    values.iat[row],
+                    f"can't cast to {_storage_dtype(dtype).name}",
+                    None if pd.isna(unit_number) else str(unit_number),
+                )
+            )
+        bad_rows |= invalid.to_numpy()
+
+    df = df[~bad_rows].astype(schema)
+    df.attrs["schema_violations"] = violations
+    return df
+
+
+def dropped_unit_numbers(df: pd.DataFrame) -> List[str]:
+    """The unit numbers of the rows dropped from df because of schema violations."""
+    unit_numbers = {v.unit_number for v in df.attrs.get("schema_violations", []) if v.unit_number is not None}
+    return sorted(unit_numbers)
+
+
+def report_schema_violations(df: pd.DataFrame, source: str):
+    """
+    Print the rows dropped from df because of schema violations. Raises ValueError if every row was dropped, since
+    then the page couldn't be read at all, and an empty df would mark all of the building's units as removed.
+    """
+    violations = df.attrs.get("schema_violations", [])
+    for v in violations:
+        unit = f" (unit {v.unit_number})" if v.unit_number is not None else ""
+        print(f"Dropped row {v.row}{unit} of {source}: {v.column} value {v.value!r} is invalid ({v.error}).")
+    if violations and df.empty:
+        raise ValueError(f"Every row of {source} violates its schema, e.g. {violations[0].column} value {violations[0].value!r}")
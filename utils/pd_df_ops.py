@@ -1,7 +1,7 @@
 import pandas as pd
 from typing import Dict
 
-from string_utils import snakecase_text
+from utils.string_utils import snakecase_text
 
 # For functions that operate on a pandas dataframe
 
@@ -9,7 +9,11 @@ from string_utils import snakecase_text
 def cast_df_and_rename_cols(df: pd.DataFrame, schema: Dict, renamed_col_mapping: Dict) -> pd.DataFrame:
     """Given a pandas df cast as types mentioned in the schema dictionary argument."""
     df = df.astype(schema)
+    return rename_and_snakecase_cols(df, renamed_col_mapping)
+
+
+def rename_and_snakecase_cols(df: pd.DataFrame, renamed_col_mapping: Dict) -> pd.DataFrame:
+    """Rename columns with the mapping, then snakecase every column name."""
     df = df.rename(columns=renamed_col_mapping)
     df.rename(columns=lambda x: snakecase_text(x.strip()), inplace=True)
     return df
-
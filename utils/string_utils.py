@@ -1,12 +1,25 @@
 import re
+from typing import Optional
 
 
-def extract_digits_from_text(text: str) -> int:
-    """Given a string, extract all digits using regex."""
+def extract_digits_from_text(text: str) -> str:
+    """Given a string, extract all digits using regex. Returns a string, so leading zeros (e.g. in unit numbers) are kept."""
     digits = re.sub(r'\D', '', text)
     return digits
 
 
+def extract_int_from_text(text: str) -> Optional[int]:
+    """Given a string, extract all digits as an int (e.g. '$3,500' -> 3500). Returns None if there are no digits."""
+    digits = extract_digits_from_text(text)
+    return int(digits) if digits else None
+
+
+def extract_float_from_text(text: str) -> Optional[float]:
+    """Given a string, return the first number in it as a float (e.g. '1.5 BATH' -> 1.5). Returns None if there is none."""
+    match = re.search(r'\d+(?:\.\d+)?', text)
+    return float(match.group()) if match else None
+
+
 def contains_digits(text: str) -> bool:
     return any(char.isdigit() for char in text)
 